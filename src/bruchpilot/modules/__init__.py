@@ -5,12 +5,13 @@ from shutil import copy2
 from yaml import load_all
 from git import Repo
 
-from modules.camera import CameraManager
+from modules.camera import CameraManager, TrackerProcess
 from modules.trigger import TriggerProcess
 from modules.opto import OptoProcess
 from modules.shared import Shared
 from modules.gui import GuiProcess
 from modules.stimulus import StimulusController
+from modules.metrics import MetricsProcess
 
 
 class BruchpilotApplication(object):
@@ -29,10 +30,21 @@ class BruchpilotApplication(object):
         self.shared = Shared(self.general_settings, self.camera_settings)
         self.trigger = TriggerProcess(self.shared)
         self.opto = OptoProcess(self.shared)
-        self.cps = [CameraManager(my_key, self.camera_settings[my_key], self.shared, debug=False) for my_key in
-                    self.camera_settings.keys()]
+
+        # Cameras can share tracker processes (tracked in a thread pool):
+        group_size = self.general_settings.get("tracker_cameras_per_process", 1)
+        self.cps = [CameraManager(my_key, self.camera_settings[my_key], self.shared, debug=False,
+                                  track=group_size == 1) for my_key in self.camera_settings.keys()]
+
+        self.trackers = []
+        if group_size > 1:
+            names = self.camera_settings.keys()
+            self.trackers = [TrackerProcess(names[idx:idx + group_size], self.camera_settings, self.shared)
+                             for idx in range(0, len(names), group_size)]
+
         self.gui = GuiProcess(self.shared)
         self.stimulus = StimulusController(self.shared)
+        self.metrics = MetricsProcess(self.shared, every=self.general_settings.get("metrics_interval", 5.0))
 
         # Set up data folder:
         stamp = datetime.now().strftime("%Y%m%d%H%M%S")
@@ -52,9 +64,17 @@ class BruchpilotApplication(object):
         """Initiates boot process."""
 
         self.gui.start()
-        self.trigger.start()
-        self.opto.start()
+
+        # Trigger and optogenetic light are only available with the camera hardware:
+        if self.general_settings.get("camera_backend", "pointgrey") == "pointgrey":
+            self.trigger.start()
+            self.opto.start()
+
         self.stimulus.start()
+        self.metrics.start()
 
         for cp in self.cps:
             cp.start()
+
+        for tracker in self.trackers:
+            tracker.start()
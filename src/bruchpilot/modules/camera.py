@@ -1,13 +1,17 @@
-from multiprocessing import Process
-from time import sleep, clock
+from multiprocessing import Process, Pool
+from multiprocessing.pool import ThreadPool
+from time import sleep, time
 from os.path import join
 import csv
 
 import numpy as np
 import cv2
 
-from peripheral import camera
-from modules.helpers import FrameCounter, BackgroundSubtractor
+from peripheral import replay
+from storage.raw import RawWriter
+from storage.columns import open_table_writer
+from tracking.detection import Detector, roi_from_settings, TRACKING_COLUMNS, TRACKING_FORMAT, TRACKING_DTYPES
+from modules.helpers import FrameCounter, LatencyMonitor
 
 
 ## TODOs:
@@ -16,10 +20,39 @@ from modules.helpers import FrameCounter, BackgroundSubtractor
 # Overhaul logging
 # Maybe image arrays need to be LOCKED to circumvent tearing
 
+
+def open_camera(camera_name, camera_settings, gsettings):
+    """Instantiates the configured camera backend: PointGrey hardware ("pointgrey"), a recorded session ("replay",
+    read from <replay_folder>/raw) or generated frames ("synthetic")."""
+
+    backend = gsettings.get("camera_backend", "pointgrey")
+
+    if backend == "pointgrey":
+        # Only imported here, as flycapture2 requires the vendor SDK:
+        from peripheral import camera
+        return camera.PGCamera(serial_number=camera_settings["serial"])
+
+    # Replay at the configured framerate unless a rate is given (0 = as fast as possible):
+    rate = gsettings.get("replay_rate")
+    rate = gsettings["framerate"] if rate is None else rate
+
+    if backend == "replay":
+        folder = join(gsettings["replay_folder"], "raw")
+        source = replay.VideoSource(join(folder, "{0}.avi".format(camera_name)),
+                                    join(folder, "{0}.csv".format(camera_name)))
+    elif backend == "synthetic":
+        frame_size = (camera_settings["f7"]["width"], camera_settings["f7"]["height"])
+        source = replay.SyntheticSource(frame_size, seed=camera_settings["serial"])
+    else:
+        raise ValueError("Unknown camera backend '{0}'!".format(backend))
+
+    return replay.ReplayCamera(source, rate=rate or None)
+
+
 class CameraManager(object):
     """Represents a camera to the tracking system."""
 
-    def __init__(self, camera_name, camera_settings, shared, debug=False):
+    def __init__(self, camera_name, camera_settings, shared, debug=False, track=True):
 
         self.camera_name = camera_name
         self.camera_settings = camera_settings
@@ -32,12 +65,19 @@ class CameraManager(object):
 
         self.camera_process = CameraProcess(self.camera_name, self.camera_settings, self.shared, debug=self.debug)
         self.recorder_process = RecorderProcess(self.camera_name, self.camera_settings, self.shared, debug=self.debug)
-        self.tracker_process = TrackerProcess(self.camera_name, self.camera_settings, self.shared, debug=self.debug)
+
+        # Trackers may also be shared between cameras (see TrackerProcess):
+        self.tracker_process = None
+        if track:
+            self.tracker_process = TrackerProcess([self.camera_name], {self.camera_name: self.camera_settings},
+                                                  self.shared, debug=self.debug)
 
     def start(self):
         self.camera_process.start()
         self.recorder_process.start()
-        self.tracker_process.start()
+
+        if self.tracker_process is not None:
+            self.tracker_process.start()
 
 
 class CameraProcess(Process):
@@ -56,9 +96,7 @@ class CameraProcess(Process):
 
     def set_up(self):
 
-        camera_serial = self.camera_settings["serial"]
-
-        self.cam = camera.PGCamera(serial_number=camera_serial)
+        self.cam = open_camera(self.camera_name, self.camera_settings, self.shared.gsettings)
         self.cam.connect()
 
         self.cam.set_property_values(self.camera_settings)
@@ -81,9 +119,11 @@ class CameraProcess(Process):
         self.set_up()
 
         frame_idx = 0
+        monitor = LatencyMonitor(self.shared.metrics[self.camera_name]["camera"])
 
         while self.shared.running.value == 1:
             image = self.cam.grab()
+            grabbed = time()
             arr, ts = np.array(image), image.get_timestamp()
 
             # It's unclear whether this is just system clock or something else: CHECK!
@@ -92,21 +132,17 @@ class CameraProcess(Process):
             if self.shared.recording.value == 1:
                 frame_idx += 1
 
-            msg = {
-                "frame_index": frame_idx,
-                "image": arr,
-                "camera_timestamp": stamp,
-                "process_timestamp": clock(),
-            }
+            # Written once; recorder and tracker read from the ring buffer:
+            self.shared.frames[self.camera_name].write(arr, frame_idx, stamp, grabbed)
+            enqueued = time()
 
             # Put in shared
             memoryview(self.shared.images_raw[self.camera_name])[:] = arr.reshape((-1))
 
-            self.shared.images_q[self.camera_name].put(msg)
-            self.shared.images_q_tracker[self.camera_name].put(msg)
-
             self.counter.step(mute=not self.debug)
             self.shared.fps_camera[self.camera_name].value = self.counter.get_frequency()
+            monitor.step(enqueued - grabbed, fps=self.counter.get_frequency(),
+                         dropped=self.shared.frames[self.camera_name].dropped_by_writer())
 
         self.tear_down()
 
@@ -127,102 +163,161 @@ class RecorderProcess(Process):
 
     def run(self):
 
-        # Video stream:
+        # Video stream (XVID-compressed or lossless chunked raw frames):
 
         framesize = (self.camera_settings["f7"]["width"], self.camera_settings["f7"]["height"])
-        fourcc = cv2.VideoWriter_fourcc(*"XVID")
-        save_path = join(self.shared.data_folder, "raw", "{0}.avi".format(self.camera_name))
-        writer = cv2.VideoWriter(save_path, fourcc=fourcc, fps=self.shared.framerate.value,
-                                 frameSize=framesize,
-                                 isColor=False)
+        recorder_format = self.shared.gsettings.get("recorder_format", "avi")
+        pool = None
+
+        if recorder_format == "raw":
+            n_workers = self.shared.gsettings.get("raw_compression_workers", 0)
+            pool = Pool(n_workers) if n_workers > 0 else None
+
+            save_path = join(self.shared.data_folder, "raw", self.camera_name)
+            writer = RawWriter(save_path, (framesize[1], framesize[0]),
+                               frames_per_chunk=self.shared.gsettings.get("raw_chunk_frames", 500), pool=pool,
+                               sync_every=self.shared.gsettings.get("raw_sync_frames", 10))
+        else:
+            fourcc = cv2.VideoWriter_fourcc(*"XVID")
+            save_path = join(self.shared.data_folder, "raw", "{0}.avi".format(self.camera_name))
+            writer = cv2.VideoWriter(save_path, fourcc=fourcc, fps=self.shared.framerate.value,
+                                     frameSize=framesize,
+                                     isColor=False)
 
         # Metadata stream:
 
         save_path = join(self.shared.data_folder, "raw", "{0}.csv".format(self.camera_name))
         metadata_file = open(save_path, mode="wb")
         metadata_stream = csv.writer(metadata_file)
-        metadata_stream.writerow(["frame_number", "process_timestamp", "camera_timestamp"])
+        metadata_stream.writerow(["frame_number", "process_timestamp", "camera_timestamp", "gap", "dropped"])
+
+        frames = self.shared.frames[self.camera_name].reader("recorder")
+        last_index = None
+        monitor = LatencyMonitor(self.shared.metrics[self.camera_name]["recorder"])
 
         while self.shared.running.value == 1:
-            msg = self.shared.images_q[self.camera_name].get(block=True)
-            frame = msg["image"].astype("uint8")
+            msg = frames.get(timeout=0.5)
+            if msg is None:
+                continue
+
+            frame = msg["image"]
 
             if self.shared.recording.value == 1:
                 if self.shared.recording_raw.value == 1:
-                    writer.write(frame)
-                    metadata_stream.writerow([msg["frame_index"], msg["process_timestamp"], msg["camera_timestamp"]])
+                    if recorder_format == "raw":
+                        writer.write(frame, msg["frame_index"], msg["process_timestamp"], msg["camera_timestamp"])
+                    else:
+                        writer.write(frame)
+
+                    # Number of frames missing since the last recorded one, and drops so far:
+                    gap = 0 if last_index is None else msg["frame_index"] - last_index - 1
+                    last_index = msg["frame_index"]
+
+                    metadata_stream.writerow([msg["frame_index"], msg["process_timestamp"], msg["camera_timestamp"],
+                                              gap, msg["dropped"]])
+
+            written = time()
 
             self.counter.step(mute=not self.debug)
             self.shared.fps_recorder[self.camera_name].value = self.counter.get_frequency()
+            monitor.step(written - msg["process_timestamp"], fps=self.counter.get_frequency(),
+                         backlog=frames.get_backlog(), dropped=frames.dropped)
+
+        frames.close()
+
+        if recorder_format == "raw":
+            writer.close()
+        else:
+            writer.release()
+
+        if pool is not None:
+            pool.close()
+            pool.join()
 
-        writer.release()
         metadata_file.close()
 
 
 class TrackerProcess(Process):
-    """Implements background subtraction and object identification."""
+    """Implements background subtraction and object identification. Several cameras can share a process; they are
+    then tracked in a thread pool (OpenCV releases the GIL)."""
 
-    def __init__(self, camera_name, camera_settings, shared, debug=False):
+    def __init__(self, camera_names, camera_settings, shared, debug=False):
 
         super(TrackerProcess, self).__init__()
 
-        self.camera_name = camera_name
+        self.camera_names = camera_names
         self.camera_settings = camera_settings
         self.debug = debug
         self.shared = shared
 
-        self.counter = FrameCounter("Tracker {0}".format(self.camera_settings["serial"]), every=1.0)
-
     def run(self):
 
-        alpha = self.shared.gsettings["background_subtraction_alpha"]
-        th = self.shared.gsettings["background_subtraction_threshold"]
-        background_model = BackgroundSubtractor(alpha, th)
+        if len(self.camera_names) == 1:
+            self.track(self.camera_names[0])
+        else:
+            pool = ThreadPool(len(self.camera_names))
+            pool.map(self.track, self.camera_names)
+            pool.close()
 
-        target_buffer = self.shared.targets[self.camera_name]
-        empty_array = np.zeros_like(target_buffer) * 0
+    def get_roi(self, camera_name):
+        return roi_from_settings(self.camera_settings[camera_name], self.shared.gsettings)
 
-        save_path = join(self.shared.data_folder, "tracking", "{0}.csv".format(self.camera_name))
-        metadata_file = open(save_path, mode="wb")
-        metadata_stream = csv.writer(metadata_file)
-        metadata_stream.writerow(
-            ["frame_number", "process_timestamp", "camera_timestamp", "x", "y", "area", "opto_intensity"])
+    def track(self, camera_name):
 
-        while self.shared.running.value == 1:
+        counter = FrameCounter("Tracker {0}".format(self.camera_settings[camera_name]["serial"]), every=1.0)
+
+        # Only the region of interest is processed, optionally coarse-to-fine:
+        roi = self.get_roi(camera_name)
+        x, y, w, h = roi.rect
+        detector = Detector(self.shared.gsettings, roi)
 
-            msg = self.shared.images_q_tracker[self.camera_name].get(block=True)
-            image = msg["image"]
+        f7 = self.camera_settings[camera_name]["f7"]
+        mask_buffer = np.frombuffer(self.shared.images_raw_tracker[camera_name], dtype=np.uint8)
+        mask_buffer = mask_buffer.reshape((f7["height"], f7["width"]))
 
-            mask = background_model.apply(image)
-            _, contours, hierarchy = cv2.findContours(mask.copy(), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        target_buffer = self.shared.targets[camera_name]
+        empty_array = np.zeros_like(target_buffer) * 0
+        n_stored = len(target_buffer) / 2
 
-            self.shared.targets_number[self.camera_name].value = len(contours)
+        save_path = join(self.shared.data_folder, "tracking", "{0}.csv".format(camera_name))
+        metadata_writer = open_table_writer(save_path, TRACKING_COLUMNS, TRACKING_DTYPES, TRACKING_FORMAT,
+                                            table_format=self.shared.gsettings.get("tracking_format", "csv"),
+                                            sorted_by="frame_number")
 
-            # Clear out previous targets
-            memoryview(target_buffer)[:] = empty_array
+        frames = self.shared.frames[camera_name].reader("tracker")
+        monitor = LatencyMonitor(self.shared.metrics[camera_name]["tracker"])
 
-            for idx, cnt in enumerate(contours):
+        while self.shared.running.value == 1:
+
+            msg = frames.get(timeout=0.5)
+            if msg is None:
+                continue
 
-                m = cv2.moments(cnt)
+            centroids, areas, mask = detector.apply(msg["image"])
 
-                if m['m00'] > 0.0:
+            contours_done = time()
 
-                    cx = int(m['m10'] / m['m00'])
-                    cy = int(m['m01'] / m['m00'])
+            self.shared.targets_number[camera_name].value = len(areas)
 
-                    # Filter by various moments:
+            # Write targets out (one block per frame):
+            if self.shared.recording.value == 1 and len(areas) > 0:
+                n = len(areas)
+                block = np.column_stack((np.repeat(msg["frame_index"], n), np.repeat(msg["process_timestamp"], n),
+                                         np.repeat(msg["camera_timestamp"], n), centroids, areas,
+                                         np.repeat(self.shared.opto_intensity.value, n), np.repeat(msg["dropped"], n)))
+                metadata_writer.append(block)
 
-                    # Write target out:
-                    if self.shared.recording.value == 1:
-                        metadata_stream.writerow([msg["frame_index"], msg["process_timestamp"], msg["camera_timestamp"],
-                                                  cx, cy, m['m00'], self.shared.opto_intensity.value])
+            # Store for GUI (clear out previous targets first):
+            memoryview(target_buffer)[:] = empty_array
+            stored = np.round(centroids[:n_stored]).astype(np.uint16).reshape((-1))
+            target_buffer[:stored.size] = stored.tolist()
 
-                    # Store for GUI:
-                    if idx < len(target_buffer) / 2:
-                        target_buffer[2 * idx] = cx
-                        target_buffer[2 * idx + 1] = cy
+            mask_buffer[y:y + h, x:x + w] = mask
 
-            memoryview(self.shared.images_raw_tracker[self.camera_name])[:] = mask.reshape((-1))
+            counter.step(mute=not self.debug)
+            self.shared.fps_tracker[camera_name].value = counter.get_frequency()
+            monitor.step(contours_done - msg["process_timestamp"], fps=counter.get_frequency(),
+                         backlog=frames.get_backlog(), dropped=frames.dropped)
 
-            self.counter.step(mute=not self.debug)
-            self.shared.fps_tracker[self.camera_name].value = self.counter.get_frequency()
+        frames.close()
+        metadata_writer.close()
@@ -1,7 +1,6 @@
 import time
 
 import numpy as np
-import cv2
 
 
 class FrameCounter(object):
@@ -11,18 +10,18 @@ class FrameCounter(object):
         """"""
         self.every = every
         self.name = name
-        self.last = time.clock()
+        self.last = time.time()
         self.counter = 0
         self.last_fps = 0.0
 
     def step(self, mute=False):
         self.counter += 1
-        current = time.clock()
+        current = time.time()
         passed = current - self.last
 
         if passed >= self.every:
             fps = self.counter / float(passed)
-            self.last = time.clock()
+            self.last = time.time()
             self.counter = 0
             self.last_fps = fps
             if not mute:
@@ -32,37 +31,26 @@ class FrameCounter(object):
         return self.last_fps
 
 
-class BackgroundSubtractor(object):
-    """Implementation of a simple low-pass-based background subtraction."""
+class LatencyMonitor(object):
+    """Keeps the latencies of the last `window` frames of a pipeline stage and publishes rolling percentiles to a
+    StageMetrics container every `every` seconds (and immediately whenever frames were dropped)."""
 
-    def __init__(self, alpha, k):
-
-        self.alpha = alpha
-        self.k = k
-        self.initialized = False
-
-        self._mean = None
-        self._mask = None
-        self._rect = None
-
-    def apply(self, frame):
-
-        if not self.initialized:
-
-            self._mean = np.zeros_like(frame, dtype="float64") + frame
-            self._mask = np.zeros_like(frame, dtype="uint8")
-            self._rect = np.zeros_like(frame, dtype="uint8")
-
-            self.initialized = True
-
-        else:
-
-            cv2.accumulateWeighted(frame, self._mean, self.alpha)
-
-            # This call implicitly rectifies!
-            # Only works for dark targets on dark ground
-            cv2.subtract(self._mean.astype("uint8"), frame, self._rect)
-
-            cv2.threshold(self._rect, self.k, 255, cv2.THRESH_BINARY, self._mask)
+    def __init__(self, metrics, window=1000, every=1.0):
+        self.metrics = metrics
+        self.every = every
 
-        return self._mask
+        self.samples = np.zeros(window)
+        self.n = 0
+        self.last = time.time()
+        self.last_dropped = 0
+
+    def step(self, latency, fps=0.0, backlog=0, dropped=0):
+        self.samples[self.n % self.samples.size] = latency
+        self.n += 1
+
+        current = time.time()
+        if current - self.last >= self.every or dropped != self.last_dropped:
+            p50, p99 = np.percentile(self.samples[:min(self.n, self.samples.size)], [50, 99])
+            self.metrics.set(fps=fps, latency_p50=p50, latency_p99=p99, backlog=backlog, dropped=dropped)
+            self.last = current
+            self.last_dropped = dropped
@@ -0,0 +1,35 @@
+from multiprocessing import Process
+from time import sleep, time
+from os.path import join
+import csv
+
+from modules.shared import STAGES, StageMetrics
+
+
+class MetricsProcess(Process):
+    """Periodically appends the per-stage telemetry of all cameras (see Shared.metrics) to metrics.csv."""
+
+    def __init__(self, shared, every=5.0):
+        super(MetricsProcess, self).__init__()
+        self.shared = shared
+        self.every = every
+
+    def run(self):
+
+        save_path = join(self.shared.data_folder, "metrics.csv")
+        metrics_file = open(save_path, mode="wb")
+        metrics_stream = csv.writer(metrics_file)
+        metrics_stream.writerow(["time", "camera", "stage"] + StageMetrics.FIELDS)
+
+        while self.shared.running.value == 1:
+            sleep(self.every)
+
+            current = time()
+            for cname in self.shared.camera_names:
+                for stage in STAGES:
+                    values = self.shared.metrics[cname][stage].get()
+                    metrics_stream.writerow([current, cname, stage] + [values[key] for key in StageMetrics.FIELDS])
+
+            metrics_file.flush()
+
+        metrics_file.close()
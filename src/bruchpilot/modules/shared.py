@@ -1,8 +1,231 @@
 from multiprocessing import Queue, Value, Array
+from time import time, sleep
 import ctypes
 
+import numpy as np
+
 TARGET_STORAGE_N = 20  # defines the maximum number of trackable targets
 
+STAGES = ["camera", "recorder", "tracker"]
+
+# Policies for consumers whose buffer is full:
+BLOCK = "block"  # the camera waits (indefinitely, or at most block_timeout seconds if set)
+DROP_OLDEST = "drop_oldest"  # the consumer skips to the newest frames
+DROP_NEWEST = "drop_newest"  # new frames are not handed to the consumer
+POLICIES = [BLOCK, DROP_OLDEST, DROP_NEWEST]
+
+
+class FrameRing(object):
+    """Shared-memory frame store for one camera (one writer, a fixed set of consumers) with a bounded,
+    lock-free queue per consumer.
+
+    Every frame is written once into a free slot, together with its metadata. The slot index is then handed to the
+    queue of every consumer according to its policy; a slot is reused once all consumers have released it. Each
+    consumer is given as a (name, capacity, policy) tuple. Drop-oldest consumers may run up to twice their capacity
+    behind before the newest frames are dropped; they trim their backlog when reading. Blocking consumers never lose
+    frames unless block_timeout is set, in which case a frame is dropped (and counted) once the writer has waited for
+    that long; a consumer that closes its reader stops receiving frames. Enough slots are allocated that a free one
+    always exists."""
+
+    def __init__(self, frame_size, consumers, block_timeout=None, poll_interval=0.0005):
+        self.frame_size = frame_size
+        self.block_timeout = block_timeout
+        self.poll_interval = poll_interval
+
+        self.names = [name for name, _, _ in consumers]
+        self.capacities = [capacity for _, capacity, _ in consumers]
+        self.policies = [policy for _, _, policy in consumers]
+
+        for policy in self.policies:
+            if policy not in POLICIES:
+                raise ValueError("Unknown drop policy '{0}' (available: {1})".format(policy, ", ".join(POLICIES)))
+
+        self.queue_sizes = [2 * capacity if policy == DROP_OLDEST else capacity
+                            for capacity, policy in zip(self.capacities, self.policies)]
+
+        # Every consumer holds at most queue_size slots, plus the one it is copying:
+        self.n_slots = sum(self.queue_sizes) + len(consumers) + 1
+
+        width, height = frame_size
+        n_consumers = len(consumers)
+
+        self.images = Array(ctypes.c_uint8, self.n_slots * width * height, lock=False)
+        self.sequence = Array(ctypes.c_int64, self.n_slots, lock=False)
+        self.frame_index = Array(ctypes.c_int64, self.n_slots, lock=False)
+        self.camera_timestamp = Array(ctypes.c_double, self.n_slots, lock=False)
+        self.process_timestamp = Array(ctypes.c_double, self.n_slots, lock=False)
+        self.enqueue_timestamp = Array(ctypes.c_double, self.n_slots, lock=False)
+
+        # Slot ownership (set by the writer, cleared by the consumer):
+        self.held = Array(ctypes.c_uint8, n_consumers * self.n_slots, lock=False)
+
+        # Consumer queues of slot indices (head advanced by the writer, tail by the consumer):
+        self.queues = [Array(ctypes.c_int64, size, lock=False) for size in self.queue_sizes]
+        self.queue_head = Array(ctypes.c_int64, n_consumers, lock=False)
+        self.queue_tail = Array(ctypes.c_int64, n_consumers, lock=False)
+
+        # Drops counted by the writer (drop-newest, block timeouts) and by the consumer (drop-oldest):
+        self.dropped_writer = Array(ctypes.c_int64, n_consumers, lock=False)
+        self.dropped_reader = Array(ctypes.c_int64, n_consumers, lock=False)
+
+        # Consumers that still receive frames:
+        self.attached = Array(ctypes.c_uint8, [1] * n_consumers, lock=False)
+
+        self.head = Value(ctypes.c_int64, 0, lock=False)  # sequence number of the next frame
+        self._last_slot = 0
+
+    def get_images(self):
+        """Returns a (n_slots x height x width) view on the frame storage."""
+        width, height = self.frame_size
+        return np.frombuffer(self.images, dtype=np.uint8).reshape((self.n_slots, height, width))
+
+    def _free_slot(self):
+        n_consumers = len(self.names)
+
+        for offset in range(1, self.n_slots + 1):
+            slot = (self._last_slot + offset) % self.n_slots
+            if not any(self.held[cidx * self.n_slots + slot] for cidx in range(n_consumers)):
+                self._last_slot = slot
+                return slot
+
+        raise RuntimeError("No free frame slot!")
+
+    def _deliver(self, cidx, slot):
+        capacity, size = self.capacities[cidx], self.queue_sizes[cidx]
+
+        if self.policies[cidx] == BLOCK:
+            start = time()
+            while (self.queue_head[cidx] - self.queue_tail[cidx] >= capacity and self.attached[cidx] and
+                   (self.block_timeout is None or time() - start < self.block_timeout)):
+                sleep(self.poll_interval)
+
+        if not self.attached[cidx]:
+            return
+
+        if self.queue_head[cidx] - self.queue_tail[cidx] >= size:
+            self.dropped_writer[cidx] += 1
+            return
+
+        self.held[cidx * self.n_slots + slot] = 1
+        self.queues[cidx][self.queue_head[cidx] % size] = slot
+        self.queue_head[cidx] += 1
+
+    def write(self, image, frame_index, camera_timestamp, process_timestamp):
+        seq = self.head.value
+        slot = self._free_slot()
+
+        self.get_images()[slot] = image
+        self.sequence[slot] = seq
+        self.frame_index[slot] = frame_index
+        self.camera_timestamp[slot] = camera_timestamp
+        self.process_timestamp[slot] = process_timestamp
+        self.enqueue_timestamp[slot] = time()
+
+        for cidx in range(len(self.names)):
+            self._deliver(cidx, slot)
+
+        self.head.value = seq + 1
+
+        return seq
+
+    def dropped_by_writer(self):
+        """Number of frames the writer could not hand to a consumer so far (all consumers)."""
+        return sum(self.dropped_writer[:])
+
+    def reader(self, name):
+        return FrameReader(self, self.names.index(name))
+
+
+class FrameReader(object):
+    """Consumer side of a FrameRing. Has to be created in the consuming process."""
+
+    def __init__(self, ring, cidx):
+        self.ring = ring
+        self.cidx = cidx
+
+        self.capacity = ring.capacities[cidx]
+        self.policy = ring.policies[cidx]
+        self.queue = ring.queues[cidx]
+        self.queue_size = ring.queue_sizes[cidx]
+
+        width, height = ring.frame_size
+        self.image = np.zeros((height, width), dtype=np.uint8)
+
+    @property
+    def dropped(self):
+        """Number of frames this consumer has lost so far."""
+        return self.ring.dropped_writer[self.cidx] + self.ring.dropped_reader[self.cidx]
+
+    def get_backlog(self):
+        """Number of frames queued but not yet read."""
+        return self.ring.queue_head[self.cidx] - self.ring.queue_tail[self.cidx]
+
+    def close(self):
+        """Stops delivery to this consumer, so that the writer no longer waits for it."""
+        self.ring.attached[self.cidx] = 0
+
+    def _release(self, tail):
+        slot = self.queue[tail % self.queue_size]
+        self.ring.held[self.cidx * self.ring.n_slots + slot] = 0
+
+    def get(self, timeout=None):
+        """Returns the next frame (a dictionary like the former queue messages) or None after timeout seconds.
+        The image is a buffer owned by the reader and only valid until the next call."""
+
+        start = time()
+
+        while True:
+            tail = self.ring.queue_tail[self.cidx]
+            backlog = self.ring.queue_head[self.cidx] - tail
+
+            if backlog > 0:
+
+                # Skip to the newest frames:
+                if self.policy == DROP_OLDEST and backlog > self.capacity:
+                    for skipped in range(tail, tail + backlog - self.capacity):
+                        self._release(skipped)
+                    self.ring.dropped_reader[self.cidx] += backlog - self.capacity
+                    tail += backlog - self.capacity
+
+                slot = self.queue[tail % self.queue_size]
+
+                self.image[:] = self.ring.get_images()[slot]
+                msg = {
+                    "sequence": self.ring.sequence[slot],
+                    "frame_index": self.ring.frame_index[slot],
+                    "image": self.image,
+                    "camera_timestamp": self.ring.camera_timestamp[slot],
+                    "process_timestamp": self.ring.process_timestamp[slot],
+                    "enqueue_timestamp": self.ring.enqueue_timestamp[slot],
+                    "dropped": self.dropped,
+                }
+
+                self._release(tail)
+                self.ring.queue_tail[self.cidx] = tail + 1
+
+                return msg
+
+            if timeout is not None and time() - start >= timeout:
+                return None
+
+            sleep(self.ring.poll_interval)
+
+
+class StageMetrics(object):
+    """Telemetry of one pipeline stage of one camera (latencies in seconds since the frame was grabbed)."""
+
+    FIELDS = ["fps", "latency_p50", "latency_p99", "backlog", "dropped"]
+
+    def __init__(self):
+        self.values = Array(ctypes.c_double, len(self.FIELDS), lock=False)
+
+    def get(self):
+        return dict(zip(self.FIELDS, self.values[:]))
+
+    def set(self, **kwargs):
+        for key, value in kwargs.iteritems():
+            self.values[self.FIELDS.index(key)] = value
+
 
 class Shared(object):
     """# This defines the big message container. It resembles ROS without the tooling or niceties,
@@ -27,8 +250,7 @@ class Shared(object):
         # Camera containers:
         self.images_raw = dict()
         self.images_raw_tracker = dict()
-        self.images_q = dict()
-        self.images_q_tracker = dict()
+        self.frames = dict()
 
         self.targets = dict()
         self.targets_number = dict()
@@ -37,6 +259,8 @@ class Shared(object):
         self.fps_recorder = dict()
         self.fps_tracker = dict()
 
+        self.metrics = dict()
+
         # Stimulus things:
 
         self.stimulus_commands = Queue()
@@ -47,8 +271,12 @@ class Shared(object):
         self.images_raw[cname] = Array(ctypes.c_uint8, frame_size[0] * frame_size[1], lock=False)
         self.images_raw_tracker[cname] = Array(ctypes.c_uint8, frame_size[0] * frame_size[1], lock=False)
 
-        self.images_q[cname] = Queue()
-        self.images_q_tracker[cname] = Queue()
+        # The recorder never drops frames (unless buffer_block_timeout is set):
+        consumers = [("recorder", self.gsettings.get("recorder_buffer_frames", 64), BLOCK),
+                     ("tracker", self.gsettings.get("tracker_buffer_frames", 8),
+                      self.gsettings.get("tracker_drop_policy", DROP_OLDEST))]
+        self.frames[cname] = FrameRing(frame_size, consumers,
+                                       block_timeout=self.gsettings.get("buffer_block_timeout"))
 
         self.targets[cname] = Array(ctypes.c_uint16, TARGET_STORAGE_N * 2, lock=False)
         self.targets_number[cname] = Value('i', 0)
@@ -56,3 +284,5 @@ class Shared(object):
         self.fps_camera[cname] = Value('f', 0.0)
         self.fps_recorder[cname] = Value('f', 0.0)
         self.fps_tracker[cname] = Value('f', 0.0)
+
+        self.metrics[cname] = {stage: StageMetrics() for stage in STAGES}
@@ -0,0 +1,179 @@
+from time import time, sleep
+
+import numpy as np
+import cv2
+
+
+class ReplayImage(object):
+    """Stand-in for flycapture2.Image: converts to a numpy array and carries a camera timestamp."""
+
+    def __init__(self, array, stamp):
+        self.array = array
+        self.stamp = stamp
+
+    def __array__(self, dtype=None, copy=None):
+        return self.array if dtype is None else self.array.astype(dtype)
+
+    def get_timestamp(self):
+        seconds = int(self.stamp)
+        return {"seconds": seconds, "microSeconds": int(round((self.stamp - seconds) * 1000000.0))}
+
+
+class VideoSource(object):
+    """Replays a recorded camera (raw/<cam>.avi and raw/<cam>.csv) in a loop. Camera timestamps are taken from the
+    metadata file and shifted on every loop so that they keep increasing."""
+
+    def __init__(self, video_path, metadata_path=None):
+        self.video_path = video_path
+
+        self.timestamps = None
+        if metadata_path is not None:
+            self.timestamps = np.loadtxt(metadata_path, delimiter=",", skiprows=1, usecols=(2,), ndmin=1)
+
+        self.capture = None
+        self.index = 0
+        self.offset = 0.0
+
+        self.open()
+        self.frame_size = (int(self.capture.get(cv2.CAP_PROP_FRAME_WIDTH)),
+                           int(self.capture.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+
+    def open(self):
+        if self.capture is not None:
+            self.capture.release()
+
+        self.capture = cv2.VideoCapture(self.video_path)
+        self.index = 0
+
+        if not self.capture.isOpened():
+            raise IOError("Could not open video file {0}!".format(self.video_path))
+
+    def _timestamp(self):
+        if self.timestamps is None or self.index >= self.timestamps.size:
+            return None
+        return self.timestamps[self.index] + self.offset
+
+    def next(self):
+        """Returns the next frame and its camera timestamp (None if unknown)."""
+
+        ok, frame = self.capture.read()
+
+        # Start over:
+        if not ok:
+            if self.index == 0:
+                raise IOError("Video file {0} contains no frames!".format(self.video_path))
+
+            if self.timestamps is not None and self.timestamps.size > 1:
+                n = min(self.index, self.timestamps.size)
+                interval = (self.timestamps[n - 1] - self.timestamps[0]) / (n - 1)
+                self.offset += self.timestamps[n - 1] - self.timestamps[0] + interval
+
+            self.open()
+            ok, frame = self.capture.read()
+
+        if frame.ndim == 3:
+            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+
+        stamp = self._timestamp()
+        self.index += 1
+
+        return frame, stamp
+
+
+class SyntheticSource(object):
+    """Generates frames with dark, randomly walking blobs on a noisy background. A fixed number of frames is
+    rendered up front and cycled, so that generating frames does not limit the achievable rate."""
+
+    def __init__(self, frame_size=(640, 512), n_targets=5, n_frames=500, radius=4, step=3.0, seed=None):
+        self.frame_size = frame_size
+
+        width, height = frame_size
+        random = np.random.RandomState(seed)
+
+        background = random.randint(180, 220, size=(height, width)).astype(np.uint8)
+        positions = random.rand(n_targets, 2) * (width, height)
+
+        self.frames = np.empty((n_frames, height, width), dtype=np.uint8)
+        for fidx in range(n_frames):
+            positions = np.clip(positions + random.randn(n_targets, 2) * step, 0, (width - 1, height - 1))
+
+            frame = background.copy()
+            for x, y in positions:
+                cv2.circle(frame, (int(x), int(y)), radius, 40, -1)
+            self.frames[fidx] = frame
+
+        self.index = 0
+
+    def next(self):
+        frame = self.frames[self.index % self.frames.shape[0]]
+        self.index += 1
+        return frame, None
+
+
+class ReplayCamera(object):
+    """Hardware-free camera that emulates the parts of PGCamera used by the acquisition pipeline.
+
+    Frames are taken from a source (VideoSource or SyntheticSource) and paced at a fixed rate (in Hz); with a rate of
+    None, they are delivered as fast as possible. If the source provides no timestamps, the camera clock starts at
+    zero with capture and advances by 1 / rate per frame (or with the wall clock when unpaced)."""
+
+    def __init__(self, source, rate=None):
+        self.source = source
+        self.rate = rate
+
+        self.connected = False
+        self.capturing = False
+
+        self.start_time = None
+        self.n_grabbed = 0
+
+    def connect(self):
+        self.connected = True
+        return True
+
+    def disconnect(self):
+        self.capturing = False
+        self.connected = False
+        return True
+
+    def get_camera_info(self):
+        return {"model_name": "Replay ({0})".format(type(self.source).__name__)} if self.connected else {}
+
+    def start_capture(self):
+        self.start_time = time()
+        self.n_grabbed = 0
+        self.capturing = True
+        return True
+
+    def stop_capture(self):
+        self.capturing = False
+        return True
+
+    def grab(self):
+        """Returns the next frame, waiting until it is due."""
+
+        if self.rate:
+            delay = self.start_time + self.n_grabbed / float(self.rate) - time()
+            if delay > 0:
+                sleep(delay)
+
+        frame, stamp = self.source.next()
+
+        if stamp is None:
+            stamp = self.n_grabbed / float(self.rate) if self.rate else time() - self.start_time
+
+        self.n_grabbed += 1
+
+        return ReplayImage(frame, stamp)
+
+    def set_format_configuration(self, mode, offset_x, offset_y, width, height):
+        if (width, height) != tuple(self.source.frame_size):
+            raise ValueError("Replay source has a frame size of {0}, but {1} was configured!".format(
+                self.source.frame_size, (width, height)))
+        return True
+
+    def set_trigger(self, on_off):
+        return True
+
+    def set_property_values(self, properties):
+        return True
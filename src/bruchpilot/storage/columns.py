@@ -0,0 +1,302 @@
+import json
+import os
+from os import path
+
+import numpy as np
+import pandas as pd
+
+# Columnar storage for tables of numbers (2D detections, reconstructed points, tracks).
+#
+# A table is a directory (<name>.columns) with a schema (column names and dtypes) and one binary file per column that
+# holds its values back to back. Rows are appended to all column files at once, so live processes can write tables
+# incrementally; rows that only made it into some of the columns (e.g. after a crash) are ignored when reading.
+# Columns are read through np.memmap, so only the columns and rows that are accessed are loaded. Tables that are
+# sorted by a column (usually frame_number) can be restricted to a range of it by binary search.
+
+TABLE_EXTENSION = ".columns"
+SCHEMA_FILE = "schema.json"
+
+
+def table_path(filename):
+    """Path of the table that replaces a CSV file (tracking/Cam1.csv -> tracking/Cam1.columns)."""
+    return path.splitext(filename)[0] + TABLE_EXTENSION
+
+
+def column_path(directory, name):
+    return path.join(directory, "{0}.bin".format(name))
+
+
+class ColumnWriter(object):
+    """Appends rows to a table (replacing an existing one). Columns default to float64."""
+
+    def __init__(self, directory, columns, dtypes=None, sorted_by=None):
+        self.directory = directory
+        self.columns = list(columns)
+        self.dtypes = [np.dtype(dtype).newbyteorder("<") for dtype in (dtypes or ["f8"] * len(self.columns))]
+        self.n_rows = 0
+
+        if len(self.dtypes) != len(self.columns):
+            raise ValueError("Number of dtypes does not match number of columns!")
+
+        if not path.exists(directory):
+            os.makedirs(directory)
+
+        schema = {"columns": self.columns, "dtypes": [dtype.str for dtype in self.dtypes], "sorted_by": sorted_by}
+        with open(path.join(directory, SCHEMA_FILE), "w") as f:
+            json.dump(schema, f)
+
+        self._files = [open(column_path(directory, name), "wb") for name in self.columns]
+
+    def append(self, columns):
+        """Appends rows given as a sequence of columns in schema order, a dictionary or a DataFrame (or an (n x
+        columns) array)."""
+
+        if isinstance(columns, (dict, pd.DataFrame)):
+            columns = [columns[name] for name in self.columns]
+        elif isinstance(columns, np.ndarray) and columns.ndim == 2:
+            columns = columns.T
+
+        values = [np.ascontiguousarray(column, dtype=dtype) for column, dtype in zip(columns, self.dtypes)]
+
+        n = values[0].size
+        if any(value.size != n for value in values):
+            raise ValueError("All columns need the same number of rows!")
+
+        for f, value in zip(self._files, values):
+            f.write(value.tobytes())
+
+        self.n_rows += n
+
+    def flush(self):
+        for f in self._files:
+            f.flush()
+
+    def close(self):
+        for f in self._files:
+            f.close()
+
+
+class ColumnReader(object):
+    """Memory-mapped access to the columns of a table."""
+
+    def __init__(self, directory):
+        self.directory = directory
+
+        with open(path.join(directory, SCHEMA_FILE)) as f:
+            schema = json.load(f)
+
+        self.columns = schema["columns"]
+        self.dtypes = dict(zip(self.columns, [np.dtype(dtype) for dtype in schema["dtypes"]]))
+        self.sorted_by = schema["sorted_by"]
+
+        # Only complete rows count:
+        self.n_rows = min([os.path.getsize(column_path(directory, name)) // self.dtypes[name].itemsize
+                           for name in self.columns] or [0])
+
+    def __len__(self):
+        return self.n_rows
+
+    def column(self, name):
+        if self.n_rows == 0:
+            return np.zeros(0, dtype=self.dtypes[name])
+        return np.memmap(column_path(self.directory, name), dtype=self.dtypes[name], mode="r", shape=(self.n_rows,))
+
+    def rows(self, column, first=None, last=None):
+        """Rows (as a slice or mask) where first <= column <= last (both inclusive, None = unbounded)."""
+
+        values = self.column(column)
+
+        if column == self.sorted_by:
+            start = 0 if first is None else np.searchsorted(values, first, side="left")
+            stop = self.n_rows if last is None else np.searchsorted(values, last, side="right")
+            return slice(int(start), int(stop))
+
+        mask = np.ones(self.n_rows, dtype=bool)
+        if first is not None:
+            mask &= values >= first
+        if last is not None:
+            mask &= values <= last
+        return mask
+
+    def read(self, columns=None, frame_range=None, range_column="frame_number"):
+        """Returns a dictionary with (copies of) the selected columns, optionally restricted to a range of frames."""
+
+        if columns is None:
+            columns = self.columns
+
+        rows = slice(None)
+        if frame_range is not None:
+            rows = self.rows(range_column, *frame_range)
+
+        return dict((name, np.array(self.column(name)[rows])) for name in columns)
+
+
+def read_table(directory, columns=None, frame_range=None, index=None):
+    """Loads (parts of) a table into a DataFrame, with the columns in schema order."""
+
+    reader = ColumnReader(directory)
+    data = reader.read(columns=columns, frame_range=frame_range)
+
+    df = pd.DataFrame(data, columns=[name for name in reader.columns if name in data])
+    if index is not None:
+        df = df.set_index(index)
+
+    return df
+
+
+def write_table(directory, df, dtypes=None, sorted_by=None):
+    """Stores a DataFrame (including its index) as a table."""
+
+    df = df.reset_index() if df.index.names[0] is not None else df
+
+    if dtypes is None:
+        dtypes = [df[name].dtype for name in df.columns]
+
+    writer = ColumnWriter(directory, df.columns, dtypes=dtypes, sorted_by=sorted_by)
+    writer.append(df)
+    writer.close()
+
+
+class CsvWriter(object):
+    """Counterpart of ColumnWriter that writes a CSV file (with the given formats) instead."""
+
+    def __init__(self, filename, columns, formats):
+        self.columns = list(columns)
+        self.formats = formats
+        self.n_rows = 0
+
+        self._file = open(filename, "wb")
+        self._file.write((",".join(self.columns) + "\n").encode("ascii"))
+
+    def append(self, columns):
+
+        if isinstance(columns, (dict, pd.DataFrame)):
+            columns = [columns[name] for name in self.columns]
+        if not (isinstance(columns, np.ndarray) and columns.ndim == 2):
+            columns = np.column_stack(columns)
+
+        np.savetxt(self._file, columns, fmt=self.formats, delimiter=",")
+        self.n_rows += columns.shape[0]
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+def open_table_writer(filename, columns, dtypes, formats, table_format="csv", sorted_by=None):
+    """Writer for a CSV file or, with table_format "columns", the equivalent table (see table_path)."""
+
+    if table_format == "columns":
+        return ColumnWriter(table_path(filename), columns, dtypes=dtypes, sorted_by=sorted_by)
+
+    if table_format != "csv":
+        raise ValueError("Unknown table format '{0}' (available: csv, columns)".format(table_format))
+
+    return CsvWriter(filename, columns, formats)
+
+
+def read_any(filename, columns=None, frame_range=None, index=None):
+    """Loads a CSV file or, if it exists, the equivalent table into a DataFrame. Only tables are read selectively;
+    CSV files are parsed completely (and filtered afterwards)."""
+
+    if path.isdir(table_path(filename)):
+        return read_table(table_path(filename), columns=columns, frame_range=frame_range, index=index)
+
+    df = pd.read_csv(filename, usecols=columns)
+
+    if frame_range is not None:
+        first, last = frame_range
+        df = df[(df.frame_number >= first) & (df.frame_number <= last)]
+
+    if index is not None:
+        df = df.set_index(index)
+
+    return df
+
+
+class FrameStream(object):
+    """Reads a CSV file or table (sorted by frame_number) front to back in frame-ordered pieces, so that files can be
+    processed with bounded memory: read_until(last) returns all rows up to and including frame number last that
+    have not been returned yet."""
+
+    def __init__(self, filename, columns=None, frame_range=None, chunk_rows=100000):
+        self.columns = columns
+        self.first, self.last = frame_range if frame_range is not None else (None, None)
+        self.exhausted = False
+
+        self._table = None
+        self._csv = None
+        self._pending = []
+
+        if path.isdir(table_path(filename)):
+            self._table = ColumnReader(table_path(filename))
+            rows = self._table.rows("frame_number", self.first, self.last)
+            self._position, self._stop = rows.start, rows.stop
+            self.exhausted = self._position >= self._stop
+        else:
+            self._csv = pd.read_csv(filename, usecols=columns, chunksize=chunk_rows)
+
+    def _read_table(self, last):
+        stop = int(np.searchsorted(self._table.column("frame_number")[self._position:self._stop], last,
+                                   side="right")) + self._position
+
+        data = {}
+        for name in (self.columns or self._table.columns):
+            data[name] = np.array(self._table.column(name)[self._position:stop])
+
+        self._position = stop
+        self.exhausted = self._position >= self._stop
+
+        return pd.DataFrame(data, columns=[name for name in self._table.columns if name in data])
+
+    def _read_csv(self, last):
+
+        # Collect pieces until one reaches beyond the requested frame:
+        while not self.exhausted and (not self._pending or self._pending[-1].frame_number.values[-1] <= last):
+            try:
+                piece = next(self._csv)
+            except StopIteration:
+                self.exhausted = True
+                break
+
+            if self.first is not None:
+                piece = piece[piece.frame_number >= self.first]
+            if self.last is not None:
+                if piece.shape[0] > 0 and piece.frame_number.values[0] > self.last:
+                    self.exhausted = True
+                piece = piece[piece.frame_number <= self.last]
+
+            if piece.shape[0] > 0:
+                self._pending.append(piece)
+
+        if not self._pending:
+            return pd.DataFrame(columns=self.columns)
+
+        data = pd.concat(self._pending)
+        split = np.searchsorted(data.frame_number.values, last, side="right")
+
+        self._pending = [data.iloc[split:]] if split < data.shape[0] else []
+
+        return data.iloc[:split]
+
+    def read_until(self, last):
+        if self._table is not None:
+            return self._read_table(last)
+        return self._read_csv(last)
+
+    def next_frame(self):
+        """Frame number of the next row (None if there is none)."""
+
+        if self._table is not None:
+            return None if self.exhausted else int(self._table.column("frame_number")[self._position])
+
+        # Reading up to a frame before the first one only fills the buffer:
+        if not self._pending and not self.exhausted:
+            self._read_csv(-np.inf)
+
+        return int(self._pending[0].frame_number.values[0]) if self._pending else None
+
+    def done(self):
+        return self.exhausted and not self._pending
@@ -0,0 +1,204 @@
+import json
+import os
+import zlib
+from glob import glob
+from os import path
+
+import numpy as np
+
+# Chunked container for raw, fixed-size frames.
+#
+# A recording of one camera is a directory of chunk files. Every chunk is preallocated for a fixed number of frames
+# and consists of a fixed-size header (magic + JSON with shape, dtype, capacity and number of frames), the frames
+# (back to back, no padding) and an index with the frame number and timestamps of every frame. Frames are appended with
+# plain sequential writes and can be read back via np.memmap without any decoding. The index and the number of frames
+# in the header are brought up to date every few frames, so a crash only loses the frames written since. Finished
+# chunks can optionally be compressed (zlib); compressed chunks have to be decompressed as a whole when read.
+
+MAGIC = b"BPRAW001"
+HEADER_SIZE = 4096
+CHUNK_EXTENSION = ".chunk"
+COMPRESSED_EXTENSION = ".chunk.z"
+
+INDEX_DTYPE = np.dtype([("frame_number", "<i8"), ("process_timestamp", "<f8"), ("camera_timestamp", "<f8")])
+
+
+def chunk_path(directory, chunk_idx):
+    return path.join(directory, "{0:06d}{1}".format(chunk_idx, CHUNK_EXTENSION))
+
+
+def encode_header(header):
+    buf = MAGIC + json.dumps(header, sort_keys=True).encode("ascii")
+    if len(buf) > HEADER_SIZE:
+        raise ValueError("Chunk header too large!")
+    return buf + b" " * (HEADER_SIZE - len(buf))
+
+
+def decode_header(buf):
+    if buf[:len(MAGIC)] != MAGIC:
+        raise IOError("Not a raw frame chunk!")
+    return json.loads(buf[len(MAGIC):HEADER_SIZE].decode("ascii"))
+
+
+def read_header(filename):
+    with open(filename, "rb") as f:
+        if not filename.endswith(COMPRESSED_EXTENSION):
+            return decode_header(f.read(HEADER_SIZE))
+
+        # Only decompress as much as needed for the header:
+        decompressor = zlib.decompressobj()
+        buf = b""
+        while len(buf) < HEADER_SIZE:
+            block = f.read(1 << 16)
+            if not block:
+                break
+            buf += decompressor.decompress(block, HEADER_SIZE - len(buf))
+        return decode_header(buf)
+
+
+def frame_bytes(header):
+    return int(np.prod(header["shape"])) * np.dtype(header["dtype"]).itemsize
+
+
+def index_offset(header):
+    return HEADER_SIZE + header["capacity"] * frame_bytes(header)
+
+
+def compress_chunk(filename, block_size=1 << 24):
+    """Compresses a finished chunk into <chunk>.z (removing the original). Returns the new filename."""
+
+    target = filename[:-len(CHUNK_EXTENSION)] + COMPRESSED_EXTENSION
+    temporary = target + ".tmp"
+    compressor = zlib.compressobj(1)
+
+    with open(filename, "rb") as source, open(temporary, "wb") as sink:
+        while True:
+            block = source.read(block_size)
+            if not block:
+                break
+            sink.write(compressor.compress(block))
+        sink.write(compressor.flush())
+
+    os.rename(temporary, target)
+    os.remove(filename)
+
+    return target
+
+
+def load_chunk(filename):
+    """Returns the frames (n x shape, memory-mapped unless compressed) and the index of a chunk."""
+
+    if filename.endswith(COMPRESSED_EXTENSION):
+        with open(filename, "rb") as f:
+            buf = zlib.decompress(f.read())
+        header = decode_header(buf[:HEADER_SIZE])
+        n = header["n_frames"]
+        frames = np.frombuffer(buf, dtype=header["dtype"], count=n * int(np.prod(header["shape"])),
+                               offset=HEADER_SIZE).reshape([n] + header["shape"])
+        index = np.frombuffer(buf, dtype=INDEX_DTYPE, count=n, offset=index_offset(header))
+        return frames, index
+
+    header = read_header(filename)
+    n = header["n_frames"]
+
+    if n == 0:
+        return np.zeros([0] + header["shape"], dtype=header["dtype"]), np.zeros(0, dtype=INDEX_DTYPE)
+
+    frames = np.memmap(filename, dtype=header["dtype"], mode="r", offset=HEADER_SIZE,
+                       shape=tuple([n] + header["shape"]))
+    index = np.memmap(filename, dtype=INDEX_DTYPE, mode="r", offset=index_offset(header), shape=(n,))
+
+    return frames, index
+
+
+def list_chunks(directory):
+    """Chunk files of a recording in order (compressed or not)."""
+    chunks = glob(path.join(directory, "*" + CHUNK_EXTENSION)) + glob(path.join(directory, "*" + COMPRESSED_EXTENSION))
+    return sorted(chunks, key=lambda filename: int(path.basename(filename).split(".")[0]))
+
+
+class RawWriter(object):
+    """Appends frames to a chunked raw container. The header and index of the current chunk are updated every
+    sync_every frames. If a pool is given, finished chunks are compressed in it."""
+
+    def __init__(self, directory, shape, dtype="uint8", frames_per_chunk=500, pool=None, sync_every=10):
+        self.directory = directory
+        self.shape = list(shape)
+        self.dtype = np.dtype(dtype).str
+        self.frames_per_chunk = frames_per_chunk
+        self.pool = pool
+        self.sync_every = sync_every
+
+        if not path.exists(directory):
+            os.makedirs(directory)
+
+        self.chunk_idx = 0
+        self.n_frames = 0
+        self.n_synced = 0
+        self.pending = []
+
+        self._file = None
+        self._index = np.zeros(frames_per_chunk, dtype=INDEX_DTYPE)
+
+    def _header(self):
+        return {"shape": self.shape, "dtype": self.dtype, "capacity": self.frames_per_chunk, "n_frames": self.n_frames}
+
+    def _open(self):
+        self.n_frames = 0
+        self.n_synced = 0
+
+        self._file = open(chunk_path(self.directory, self.chunk_idx), "wb")
+        self._file.write(encode_header(self._header()))
+
+        # Preallocate frames and index:
+        self._file.truncate(index_offset(self._header()) + self.frames_per_chunk * INDEX_DTYPE.itemsize)
+
+    def _sync(self):
+        """Writes the index entries of all frames written since the last sync, then their number into the header
+        (seeking flushes the frames themselves first)."""
+
+        header = self._header()
+        position = self._file.tell()
+
+        self._file.seek(index_offset(header) + self.n_synced * INDEX_DTYPE.itemsize)
+        self._file.write(self._index[self.n_synced:self.n_frames].tobytes())
+        self._file.seek(0)
+        self._file.write(encode_header(header))
+        self._file.seek(position)
+        self._file.flush()
+
+        self.n_synced = self.n_frames
+
+    def _finish(self):
+        self._sync()
+        self._file.close()
+        self._file = None
+
+        if self.pool is not None:
+            self.pending.append(self.pool.apply_async(compress_chunk, (chunk_path(self.directory, self.chunk_idx),)))
+
+        self.chunk_idx += 1
+
+    def write(self, frame, frame_number, process_timestamp, camera_timestamp):
+
+        if self._file is None:
+            self._open()
+
+        self._file.write(np.ascontiguousarray(frame, dtype=self.dtype).data)
+        self._index[self.n_frames] = (frame_number, process_timestamp, camera_timestamp)
+        self.n_frames += 1
+
+        if self.n_frames == self.frames_per_chunk:
+            self._finish()
+        elif self.n_frames - self.n_synced >= self.sync_every:
+            self._sync()
+
+    def close(self):
+        """Finishes the current chunk and waits for pending compressions."""
+
+        if self._file is not None:
+            self._finish()
+
+        for result in self.pending:
+            result.wait()
+        self.pending = []
@@ -0,0 +1,305 @@
+import os
+import struct
+from collections import OrderedDict
+from glob import glob
+from os import path
+
+import numpy as np
+import pandas as pd
+import cv2
+
+from .raw import list_chunks, load_chunk, read_header, COMPRESSED_EXTENSION
+
+# Random access to recorded sessions.
+#
+# A session directory contains raw/<camera>.csv (one metadata row per recorded frame) and the frames of every camera,
+# either as a chunked raw container (raw/<camera>/, see raw.py) or as a video file (raw/<camera>.avi). Raw frames are
+# memory-mapped, so any frame is available without decoding. Videos can only be decoded forward from a keyframe; the
+# position of all keyframes is read from the AVI index once and cached next to the video (or in cache_dir), so that
+# seeking to frame N only decodes the frames between the preceding keyframe and N.
+
+
+### AVI INDEX
+
+AVI_KEYFRAME = 0x10
+AVI_VIDEO_CHUNKS = [struct.unpack("<I", fourcc)[0] for fourcc in (b"00dc", b"00db")]
+
+
+def _walk_chunks(f, start, end):
+    """Yields (fourcc, list type or None, data offset, size) of all chunks between start and end."""
+
+    position = start
+    while position + 8 <= end:
+        f.seek(position)
+        fourcc, size = struct.unpack("<4sI", f.read(8))
+
+        list_type = f.read(4) if fourcc in (b"RIFF", b"LIST") else None
+        yield fourcc, list_type, position + 8, size
+
+        # Chunks are padded to an even size:
+        position += 8 + size + (size & 1)
+
+
+def _is_video_chunk(fourcc):
+    return fourcc[:2] == b"00" and fourcc[2:] in (b"dc", b"db")
+
+
+def build_avi_index(filename):
+    """Scans an AVI file (including OpenDML extensions) and returns the number of video frames and the positions of
+    all keyframes. Without usable index information, only the first frame is considered a keyframe."""
+
+    offsets = []
+    keyframe_offsets = set()
+    legacy_index = []
+    movi_start = None
+
+    with open(filename, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        file_size = f.tell()
+
+        for fourcc, list_type, riff_start, riff_size in _walk_chunks(f, 0, file_size):
+            if fourcc != b"RIFF":
+                continue
+
+            riff_end = min(riff_start + riff_size, file_size)
+
+            for cfourcc, clist_type, cstart, csize in _walk_chunks(f, riff_start + 4, riff_end):
+
+                if cfourcc == b"LIST" and clist_type == b"movi":
+                    if movi_start is None:
+                        movi_start = cstart
+
+                    stack = [(cstart + 4, min(cstart + csize, riff_end))]
+                    while stack:
+                        start, end = stack.pop()
+                        for mfourcc, mlist_type, mstart, msize in _walk_chunks(f, start, end):
+                            if _is_video_chunk(mfourcc):
+                                offsets.append(mstart)
+                            elif mfourcc == b"LIST" and mlist_type == b"rec ":
+                                stack.append((mstart + 4, mstart + msize))
+                            elif mfourcc == b"ix00":
+                                # OpenDML standard index (size without bit 31 = keyframe):
+                                f.seek(mstart)
+                                _, _, _, n_entries, _, base_offset, _ = struct.unpack("<HBBI4sQI", f.read(24))
+                                entries = np.frombuffer(f.read(8 * n_entries), dtype="<u4").reshape((-1, 2))
+                                keys = entries[:, 1] & 0x80000000 == 0
+                                keyframe_offsets.update((base_offset + entries[keys, 0].astype(np.int64)).tolist())
+
+                elif cfourcc == b"idx1":
+                    f.seek(cstart)
+                    legacy_index.append(np.frombuffer(f.read(csize - csize % 16), dtype="<u4").reshape((-1, 4)))
+
+    offsets = np.array(offsets, dtype=np.int64)
+
+    # Legacy index (first RIFF only), with offsets relative to the movi list or absolute:
+    if not keyframe_offsets and legacy_index and offsets.size > 0:
+        entries = np.concatenate(legacy_index)
+        entries = entries[np.isin(entries[:, 0], AVI_VIDEO_CHUNKS)]
+
+        if entries.size > 0:
+            base = 0 if entries[0, 2] + 8 == offsets[0] else movi_start
+            keys = entries[:, 1] & AVI_KEYFRAME != 0
+            keyframe_offsets.update((base + entries[keys, 2].astype(np.int64) + 8).tolist())
+
+    keyframes = np.nonzero(np.isin(offsets, np.array(sorted(keyframe_offsets), dtype=np.int64)))[0]
+    if keyframes.size == 0 or keyframes[0] != 0:
+        keyframes = np.concatenate(([0], keyframes)).astype(np.int64)
+
+    return offsets.size, keyframes
+
+
+def load_avi_index(filename, cache_dir=None):
+    """Loads the keyframe index of a video from the cache, building (and storing) it if necessary. Cached indices
+    are rebuilt if the size or modification time of the video changed."""
+
+    stat = os.stat(filename)
+
+    if cache_dir is None:
+        index_path = filename + ".index.npz"
+    else:
+        index_path = path.join(cache_dir, "{0}.index.npz".format(path.basename(filename)))
+
+    if path.exists(index_path):
+        cached = np.load(index_path)
+        if int(cached["size"]) == stat.st_size and float(cached["mtime"]) == stat.st_mtime:
+            return int(cached["n_frames"]), cached["keyframes"]
+
+    n_frames, keyframes = build_avi_index(filename)
+
+    # Caching is optional (e.g. for read-only data folders):
+    try:
+        if not path.exists(path.dirname(index_path)):
+            os.makedirs(path.dirname(index_path))
+
+        temporary = "{0}.{1}.tmp".format(index_path, os.getpid())
+        with open(temporary, "wb") as f:
+            np.savez(f, n_frames=n_frames, keyframes=keyframes, size=stat.st_size, mtime=stat.st_mtime)
+        os.rename(temporary, index_path)
+    except (IOError, OSError):
+        pass
+
+    return n_frames, keyframes
+
+
+### READERS
+
+class AviReader(object):
+    """Random access to the frames of a video through its keyframe index. Consecutive reads don't seek."""
+
+    def __init__(self, filename, cache_dir=None):
+        self.filename = filename
+        self.n_frames, self.keyframes = load_avi_index(filename, cache_dir=cache_dir)
+
+        self.capture = cv2.VideoCapture(filename)
+        if not self.capture.isOpened():
+            raise IOError("Could not open video file {0}!".format(filename))
+
+        self.position = 0
+
+    def __len__(self):
+        return self.n_frames
+
+    def read(self, n):
+
+        if not 0 <= n < self.n_frames:
+            raise IndexError("Frame {0} out of range ({1} frames)".format(n, self.n_frames))
+
+        # Seek to the preceding keyframe, unless decoding forward from the current position is at most as expensive:
+        keyframe = self.keyframes[np.searchsorted(self.keyframes, n, side="right") - 1]
+        if not keyframe <= self.position <= n:
+            self.capture.set(cv2.CAP_PROP_POS_FRAMES, keyframe)
+            self.position = keyframe
+
+        while self.position < n:
+            self.capture.grab()
+            self.position += 1
+
+        ok, frame = self.capture.read()
+        if not ok:
+            self.position = -1
+            raise IOError("Could not decode frame {0} of {1}!".format(n, self.filename))
+        self.position += 1
+
+        if frame.ndim == 3:
+            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+
+        return frame
+
+    def close(self):
+        self.capture.release()
+
+
+class RawReader(object):
+    """Random access to the frames of a chunked raw container. Uncompressed chunks are memory-mapped; compressed
+    chunks are decompressed as a whole, keeping the max_cached most recently used ones."""
+
+    def __init__(self, directory, max_cached=2):
+        self.directory = directory
+        self.max_cached = max_cached
+
+        self.chunks = list_chunks(directory)
+        self.offsets = np.cumsum([0] + [read_header(chunk)["n_frames"] for chunk in self.chunks])
+
+        self._mapped = {}
+        self._decompressed = OrderedDict()
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def _load(self, chunk_idx):
+        filename = self.chunks[chunk_idx]
+
+        if not filename.endswith(COMPRESSED_EXTENSION):
+            if chunk_idx not in self._mapped:
+                self._mapped[chunk_idx] = load_chunk(filename)[0]
+            return self._mapped[chunk_idx]
+
+        if chunk_idx in self._decompressed:
+            frames = self._decompressed.pop(chunk_idx)
+        else:
+            frames = load_chunk(filename)[0]
+            while len(self._decompressed) >= self.max_cached:
+                self._decompressed.popitem(last=False)
+
+        self._decompressed[chunk_idx] = frames
+        return frames
+
+    def read(self, n):
+
+        if not 0 <= n < len(self):
+            raise IndexError("Frame {0} out of range ({1} frames)".format(n, len(self)))
+
+        chunk_idx = np.searchsorted(self.offsets, n, side="right") - 1
+        return self._load(chunk_idx)[n - self.offsets[chunk_idx]]
+
+    def close(self):
+        self._mapped = {}
+        self._decompressed = OrderedDict()
+
+
+### SESSIONS
+
+class Session(object):
+    """Recorded session (data folder). Frames are addressed by camera name (e.g. Cam<serial>) and either their
+    position in the recording (read) or their frame number (read_frame_number); both return the frame and the
+    matching metadata row. Readers are opened on first use."""
+
+    def __init__(self, data_path, cache_dir=None):
+        self.data_path = data_path
+        self.cache_dir = cache_dir
+
+        raw_path = path.join(data_path, "raw")
+        if not path.isdir(raw_path):
+            raise IOError("No recording found in {0}!".format(data_path))
+
+        self.metadata = {}
+        for filename in sorted(glob(path.join(raw_path, "*.csv"))):
+            name = path.splitext(path.basename(filename))[0]
+            if path.isdir(path.join(raw_path, name)) or path.exists(path.join(raw_path, name + ".avi")):
+                self.metadata[name] = pd.read_csv(filename)
+
+        self._readers = {}
+
+    @property
+    def cameras(self):
+        return sorted(self.metadata.keys())
+
+    def reader(self, camera):
+
+        if camera not in self.metadata:
+            raise KeyError("Camera {0} not found in {1}!".format(camera, self.data_path))
+
+        if camera not in self._readers:
+            raw_path = path.join(self.data_path, "raw", camera)
+            if path.isdir(raw_path):
+                self._readers[camera] = RawReader(raw_path)
+            else:
+                self._readers[camera] = AviReader(raw_path + ".avi", cache_dir=self.cache_dir)
+
+        return self._readers[camera]
+
+    def n_frames(self, camera):
+        return min(len(self.reader(camera)), self.metadata[camera].shape[0])
+
+    def position(self, camera, frame_number):
+        """Position of a frame number in the recording of a camera."""
+
+        numbers = self.metadata[camera].frame_number.values
+        n = np.searchsorted(numbers, frame_number)
+
+        if n >= numbers.size or numbers[n] != frame_number:
+            raise KeyError("Frame number {0} was not recorded by {1}!".format(frame_number, camera))
+
+        return int(n)
+
+    def read(self, camera, n):
+        """Returns the n-th recorded frame of a camera and its metadata row."""
+        return self.reader(camera).read(n), self.metadata[camera].iloc[n]
+
+    def read_frame_number(self, camera, frame_number):
+        return self.read(camera, self.position(camera, frame_number))
+
+    def close(self):
+        for reader in self._readers.values():
+            reader.close()
+        self._readers = {}
@@ -0,0 +1,318 @@
+from time import time
+
+import numpy as np
+from munkres import munkres
+from scipy.optimize import linear_sum_assignment
+
+from .kernels import kernel
+
+# Sparse, component-wise assignment layer shared by the 3D reconstruction and the tracker.
+#
+# Only pairs with a finite cost below max_cost are admissible. Large problems with few admissible pairs are split into
+# the connected components of the bipartite graph of admissible pairs, which are solved independently; small or
+# densely admissible problems are solved as a whole. Inadmissible pairs are filled with a "practical infinity" so that
+# the solution maximizes the number of admissible pairs first and minimizes their cost second -- the same objective as
+# the dense practical-infinity call in munkres_safe.
+
+
+### SOLVERS
+
+def solve_scipy(cost):
+    """Jonker-Volgenant-style O(n^3) solver from scipy."""
+    return linear_sum_assignment(cost)
+
+
+def solve_munkres(cost):
+    """Hungarian algorithm from the munkres package (previous default)."""
+    return np.nonzero(munkres(cost))
+
+
+@kernel("int64[::1](float64[:, ::1])")
+def lap_numba(cost):
+    """Shortest augmenting path Hungarian algorithm (O(n^2 m)) for a finite (n x m) cost matrix with n <= m.
+    Returns the assigned column for every row. Usable from other nopython functions."""
+
+    n, m = cost.shape
+
+    u = np.zeros(n + 1)
+    v = np.zeros(m + 1)
+    p = np.zeros(m + 1, dtype=np.int64)
+    way = np.zeros(m + 1, dtype=np.int64)
+    minv = np.empty(m + 1)
+    used = np.empty(m + 1, dtype=np.bool_)
+
+    for i in range(1, n + 1):
+        p[0] = i
+        j0 = 0
+        minv[:] = np.inf
+        used[:] = False
+
+        while True:
+            used[j0] = True
+            i0 = p[j0]
+            delta = np.inf
+            j1 = 0
+
+            for j in range(1, m + 1):
+                if not used[j]:
+                    cur = cost[i0 - 1, j - 1] - u[i0] - v[j]
+                    if cur < minv[j]:
+                        minv[j] = cur
+                        way[j] = j0
+                    if minv[j] < delta:
+                        delta = minv[j]
+                        j1 = j
+
+            for j in range(m + 1):
+                if used[j]:
+                    u[p[j]] += delta
+                    v[j] -= delta
+                else:
+                    minv[j] -= delta
+
+            j0 = j1
+            if p[j0] == 0:
+                break
+
+        # Augment along the alternating path:
+        while True:
+            j1 = way[j0]
+            p[j0] = p[j1]
+            j0 = j1
+            if j0 == 0:
+                break
+
+    out = np.ones(n, dtype=np.int64) * -1
+    for j in range(1, m + 1):
+        if p[j] != 0:
+            out[p[j] - 1] = j - 1
+
+    return out
+
+
+def solve_numba(cost):
+    """Compiled Hungarian algorithm (lap_numba); also used by the batched reconstruction kernel."""
+
+    cost = np.ascontiguousarray(cost, dtype=np.float64)
+
+    if cost.shape[0] > cost.shape[1]:
+        cols, rows = solve_numba(cost.T)
+        order = np.argsort(rows)
+        return rows[order], cols[order]
+
+    return np.arange(cost.shape[0]), lap_numba(cost)
+
+
+SOLVERS = {
+    "scipy": solve_scipy,
+    "munkres": solve_munkres,
+    "numba": solve_numba,
+}
+
+
+def get_solver(solver):
+    """Looks up a solver by name. Callables with the signature of solve_scipy are passed through."""
+
+    if callable(solver):
+        return solver
+
+    if solver not in SOLVERS:
+        raise ValueError("Unknown assignment solver '{0}' (available: {1})".format(solver, ", ".join(SOLVERS)))
+
+    return SOLVERS[solver]
+
+
+def register_solver(name, solver):
+    SOLVERS[name] = solver
+
+
+class RecordingSolver(object):
+    """Solver wrapper that keeps every (per-component) cost matrix it is handed, e.g. to replay the problems of a
+    recorded session with benchmark_solvers."""
+
+    def __init__(self, solver="scipy"):
+        self.solver = get_solver(solver)
+        self.matrices = []
+
+    def __call__(self, cost):
+        self.matrices.append(cost.copy())
+        return self.solver(cost)
+
+
+### ASSIGNMENT
+
+# Below this number of pairs, or with at least this fraction of admissible pairs, a single dense solve is cheaper than
+# splitting the problem into components:
+DENSE_MAX_PAIRS = 1024
+DENSE_MIN_FILL = 0.25
+
+
+@kernel("int64[::1](int64, int64[::1], int64[::1])")
+def label_components(n_nodes, edge_from, edge_to):
+    """Connected component labels (0..n_components - 1, in order of first appearance) of an undirected graph, via
+    union-find with path halving."""
+
+    parent = np.arange(n_nodes)
+
+    for eidx in range(edge_from.size):
+        a, b = edge_from[eidx], edge_to[eidx]
+
+        while parent[a] != a:
+            parent[a] = parent[parent[a]]
+            a = parent[a]
+        while parent[b] != b:
+            parent[b] = parent[parent[b]]
+            b = parent[b]
+
+        if a != b:
+            parent[max(a, b)] = min(a, b)
+
+    labels = np.empty(n_nodes, dtype=np.int64)
+    n_components = 0
+    for node in range(n_nodes):
+        root = node
+        while parent[root] != root:
+            root = parent[root]
+        if root == node:
+            labels[node] = n_components
+            n_components += 1
+        else:
+            labels[node] = labels[root]
+
+    return labels
+
+
+def cheapest_edges(nodes, costs):
+    """Indices of the cheapest edge of every node, given the node and cost of each edge."""
+
+    order = np.lexsort((costs, nodes))
+    first = np.ones(order.size, dtype=bool)
+    first[1:] = nodes[order][1:] != nodes[order][:-1]
+
+    return order[first]
+
+
+def solve_admissible(cost, admissible, practical_infinity, solve):
+    """Solves a (sub-)problem with inadmissible pairs set to the practical infinity; returns the admissible pairs."""
+
+    cost = np.where(admissible, cost, practical_infinity)
+
+    rows, cols = solve(cost)
+    rows, cols = np.asarray(rows, dtype=np.int64), np.asarray(cols, dtype=np.int64)
+
+    keep = admissible[rows, cols]
+    return rows[keep], cols[keep]
+
+
+def sparse_assignment(cost, max_cost=np.inf, solver="scipy"):
+    """Solves the assignment problem on all admissible pairs (finite cost <= max_cost) of a (rows x cols) cost
+    matrix. Returns the row and column indices of the assigned pairs; unassigned rows/columns are omitted.
+
+    Small or densely admissible problems are solved in one go; otherwise the bipartite graph of admissible pairs is
+    split into connected components that are solved independently."""
+
+    solve = get_solver(solver)
+
+    admissible = cost <= max_cost
+    if np.isinf(max_cost):
+        admissible &= np.isfinite(cost)
+
+    edge_rows, edge_cols = np.nonzero(admissible)
+
+    if edge_rows.size == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+    edge_costs = cost[edge_rows, edge_cols]
+    practical_infinity = 2 * edge_costs.max() + 1
+
+    if cost.size <= DENSE_MAX_PAIRS or edge_rows.size >= DENSE_MIN_FILL * cost.size:
+        return solve_admissible(cost, admissible, practical_infinity, solve)
+
+    # Split into connected components (rows are nodes 0..r-1, columns are nodes r..r+c-1):
+    n_rows, n_cols = cost.shape
+    labels = label_components(n_rows + n_cols, edge_rows.astype(np.int64), (edge_cols + n_rows).astype(np.int64))
+    n_components = labels.max() + 1
+
+    row_labels, col_labels = labels[:n_rows], labels[n_rows:]
+    rows_per_component = np.bincount(row_labels, minlength=n_components)
+    cols_per_component = np.bincount(col_labels, minlength=n_components)
+
+    out_rows, out_cols = [], []
+
+    # Trivial components (1xN or Nx1, so every pair is admissible) are resolved at once, by picking the cheapest edge
+    # of the single row (column); isolated nodes have no edges and drop out:
+    edge_labels = row_labels[edge_rows]
+
+    single_row = np.nonzero(rows_per_component[edge_labels] == 1)[0]
+    single_row = single_row[cheapest_edges(edge_rows[single_row], edge_costs[single_row])]
+    out_rows.append(edge_rows[single_row])
+    out_cols.append(edge_cols[single_row])
+
+    single_col = np.nonzero((cols_per_component[edge_labels] == 1) & (rows_per_component[edge_labels] > 1))[0]
+    single_col = single_col[cheapest_edges(edge_cols[single_col], edge_costs[single_col])]
+    out_rows.append(edge_rows[single_col])
+    out_cols.append(edge_cols[single_col])
+
+    # Everything else is solved per component:
+    large = np.nonzero((rows_per_component > 1) & (cols_per_component > 1))[0]
+
+    if large.size > 0:
+        row_order, col_order = np.argsort(row_labels, kind="mergesort"), np.argsort(col_labels, kind="mergesort")
+        row_splits = np.searchsorted(row_labels[row_order], np.arange(n_components + 1))
+        col_splits = np.searchsorted(col_labels[col_order], np.arange(n_components + 1))
+
+        for cidx in large:
+            rows = row_order[row_splits[cidx]:row_splits[cidx + 1]]
+            cols = col_order[col_splits[cidx]:col_splits[cidx + 1]]
+
+            sub_rows, sub_cols = solve_admissible(cost[np.ix_(rows, cols)], admissible[np.ix_(rows, cols)],
+                                                  practical_infinity, solve)
+            out_rows.append(rows[sub_rows])
+            out_cols.append(cols[sub_cols])
+
+    return np.concatenate(out_rows).astype(np.int64), np.concatenate(out_cols).astype(np.int64)
+
+
+def complete_assignment(n_rows, n_cols, rows, cols):
+    """Turns a partial assignment into a column index per row, pairing up leftover rows and columns in order.
+    Rows that cannot be paired (n_rows > n_cols) are set to -1."""
+
+    out = np.ones(n_rows, dtype=np.int64) * -1
+    out[rows] = cols
+
+    free_rows = np.setdiff1d(np.arange(n_rows), rows)
+    free_cols = np.setdiff1d(np.arange(n_cols), cols)
+    n_free = min(free_rows.size, free_cols.size)
+    out[free_rows[:n_free]] = free_cols[:n_free]
+
+    return out
+
+
+### BENCHMARKING
+
+def benchmark_solvers(matrices, solvers=None, sparse=False, max_cost=np.inf, repeat=1):
+    """Runs every solver on a list of cost matrices (e.g. RecordingSolver.matrices, which holds exactly the problems
+    handed to the solver). With sparse=True, the full matrices are routed through sparse_assignment instead. Returns
+    a dictionary that maps solver names to the elapsed time and the summed cost of all assignments."""
+
+    if solvers is None:
+        solvers = list(SOLVERS.keys())
+
+    results = {}
+
+    for name in solvers:
+        solve = get_solver(name)
+        start = time()
+
+        for _ in range(repeat):
+            total_cost = 0.0
+            for cost in matrices:
+                if sparse:
+                    rows, cols = sparse_assignment(cost, max_cost=max_cost, solver=solve)
+                else:
+                    rows, cols = solve(cost)
+                total_cost += cost[rows, cols].sum()
+
+        results[name] = {"time": (time() - start) / repeat, "cost": total_cost, "n": len(matrices)}
+
+    return results
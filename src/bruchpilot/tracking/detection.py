@@ -0,0 +1,285 @@
+import numpy as np
+import cv2
+
+# 2D detection: background subtraction, blob detection, regions of interest. Used by the live tracker
+# (modules/camera.py) and for re-tracking recorded sessions offline (scripts/postprocessing/retrack.py).
+
+# Columns of the tracking output (tracking/<camera>.csv), with their formats (CSV) and dtypes (columnar tables):
+TRACKING_COLUMNS = ["frame_number", "process_timestamp", "camera_timestamp", "x", "y", "area", "opto_intensity",
+                    "dropped"]
+TRACKING_FORMAT = ["%d", "%.6f", "%.6f", "%.3f", "%.3f", "%d", "%d", "%d"]
+TRACKING_DTYPES = ["i8", "f8", "f8", "f8", "f8", "i8", "i8", "i8"]
+
+
+class BackgroundSubtractor(object):
+    """Implementation of a simple low-pass-based background subtraction.
+
+    The float32 model and all intermediate images are preallocated and written in place. Optionally, the model is
+    only updated every `update_every` frames (with alpha adjusted to keep the time constant) and/or only outside of
+    the foreground (`masked_update`)."""
+
+    def __init__(self, alpha, k, update_every=1, masked_update=False):
+
+        self.alpha = alpha
+        self.k = k
+        self.update_every = update_every
+        self.masked_update = masked_update
+        self.initialized = False
+
+        # Equivalent rate for updating every n-th frame:
+        self._alpha = 1.0 - (1.0 - alpha) ** update_every
+        self._n = 0
+
+        self._mean = None
+        self._mean_u8 = None
+        self._mask = None
+        self._rect = None
+        self._background = None
+
+    def _update(self, frame, mask=None):
+        if self._n % self.update_every == 0:
+            cv2.accumulateWeighted(frame, self._mean, self._alpha, mask)
+        self._n += 1
+
+    def get_background(self):
+        """Current background model as uint8 image."""
+        return self._mean_u8
+
+    def _subtract(self, frame):
+        # Truncate (like astype) rather than round (like convertScaleAbs), as the mask depends on it:
+        np.copyto(self._mean_u8, self._mean, casting="unsafe")
+
+        # This call implicitly rectifies!
+        # Only works for dark targets on dark ground
+        cv2.subtract(self._mean_u8, frame, self._rect)
+
+        cv2.threshold(self._rect, self.k, 255, cv2.THRESH_BINARY, self._mask)
+
+    def apply(self, frame):
+
+        if not self.initialized:
+
+            self._mean = np.zeros_like(frame, dtype="float32") + frame
+            self._mean_u8 = np.zeros_like(frame, dtype="uint8")
+            self._mask = np.zeros_like(frame, dtype="uint8")
+            self._rect = np.zeros_like(frame, dtype="uint8")
+            self._background = np.zeros_like(frame, dtype="uint8")
+
+            self.initialized = True
+
+        elif self.masked_update:
+
+            # Subtract first, then learn only from background pixels:
+            self._subtract(frame)
+            cv2.bitwise_not(self._mask, dst=self._background)
+            self._update(frame, self._background)
+
+        else:
+
+            self._update(frame)
+            self._subtract(frame)
+
+        return self._mask
+
+
+class BlobDetector(object):
+    """Finds all blobs of a binary mask in one call (connected components) and filters them by area.
+
+    The default min_area of 2 pixels rejects single-pixel specks, which the earlier contour-based detection dropped
+    for their zero contour area (m00)."""
+
+    def __init__(self, min_area=2, max_area=None, connectivity=8):
+        self.min_area = min_area
+        self.max_area = np.inf if max_area is None else max_area
+        self.connectivity = connectivity
+
+    def detect(self, mask):
+        """Returns the (n x 2) centroids and the areas (in pixels) of all blobs within the area limits."""
+
+        _, _, stats, centroids = cv2.connectedComponentsWithStats(mask, connectivity=self.connectivity)
+
+        # Label 0 is the background:
+        areas = stats[1:, cv2.CC_STAT_AREA]
+        keep = (areas >= self.min_area) & (areas <= self.max_area)
+
+        return centroids[1:][keep], areas[keep]
+
+
+class RegionOfInterest(object):
+    """Part of a camera view that can contain targets: a rectangle (x, y, width, height) that frames are cropped to
+    and an optional mask (of the size of the rectangle) that detections have to fall into."""
+
+    def __init__(self, rect, mask=None):
+        self.rect = tuple(int(v) for v in rect)
+        self.mask = mask
+
+    @classmethod
+    def from_polygon(cls, polygon, frame_size, margin=0):
+        """Region covering the convex hull of a (n x 2) polygon in image coordinates, grown by margin pixels."""
+
+        width, height = frame_size
+
+        full = np.zeros((height, width), dtype=np.uint8)
+        cv2.fillConvexPoly(full, cv2.convexHull(np.round(polygon).astype(np.int32)), 255)
+
+        if margin > 0:
+            kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (2 * margin + 1, 2 * margin + 1))
+            full = cv2.dilate(full, kernel)
+
+        ys, xs = np.nonzero(full)
+        if xs.size == 0:
+            raise ValueError("Region of interest lies outside of the camera view!")
+
+        x0, x1, y0, y1 = xs.min(), xs.max() + 1, ys.min(), ys.max() + 1
+
+        return cls((x0, y0, x1 - x0, y1 - y0), full[y0:y1, x0:x1].copy())
+
+    def crop(self, image):
+        x, y, w, h = self.rect
+        return image[y:y + h, x:x + w]
+
+    def to_frame(self, centroids, areas):
+        """Converts detections within the crop to frame coordinates, dropping those outside of the mask."""
+
+        if self.mask is not None and len(areas) > 0:
+            h, w = self.mask.shape
+            cols = np.clip(centroids[:, 0].astype(np.int64), 0, w - 1)
+            rows = np.clip(centroids[:, 1].astype(np.int64), 0, h - 1)
+            keep = self.mask[rows, cols] > 0
+            centroids, areas = centroids[keep], areas[keep]
+
+        return centroids + self.rect[:2], areas
+
+
+def roi_from_calibration(calibration_file, camera_name, arena_bounds, frame_size, margin=10):
+    """Projects the corners of the arena box ((min, max) per axis, in calibration coordinates) into a camera of an
+    aligned pymvg calibration and returns the covered region."""
+
+    # Only needed here, so the acquisition system does not depend on pymvg otherwise:
+    from pymvg.multi_camera_system import MultiCameraSystem
+
+    camera_system = MultiCameraSystem.from_pymvg_file(calibration_file)
+
+    corners = np.array([[x, y, z] for x in arena_bounds[0] for y in arena_bounds[1] for z in arena_bounds[2]],
+                       dtype=np.float64)
+    polygon = camera_system.find2d(camera_name, corners, distorted=True).T
+
+    return RegionOfInterest.from_polygon(polygon, frame_size, margin=margin)
+
+
+class CoarseToFineDetector(object):
+    """Runs the background model on a downsampled image and refines the resulting candidate regions at full
+    resolution only: there, the frame is compared against the upsampled background and blobs are detected per
+    region. Regions are the connected components of the coarse mask grown by `margin` (coarse) pixels; a blob is
+    assigned to the region its centroid falls into, so overlapping regions do not produce duplicates."""
+
+    def __init__(self, background_model, detector, factor=4, margin=2):
+        self.background_model = background_model
+        self.detector = detector
+        self.factor = factor
+
+        self._kernel = np.ones((2 * margin + 1, 2 * margin + 1), dtype=np.uint8)
+
+        self._small = None
+        self._grown = None
+        self.mask = None
+
+    def apply(self, frame):
+        """Returns the centroids and areas of all blobs as well as the full resolution foreground mask."""
+
+        f = self.factor
+        height, width = frame.shape
+
+        if self._small is None:
+            self._small = np.zeros((height // f, width // f), dtype=np.uint8)
+            self._grown = np.zeros_like(self._small)
+            self.mask = np.zeros_like(frame)
+
+        cv2.resize(frame, (width // f, height // f), dst=self._small, interpolation=cv2.INTER_AREA)
+        coarse = self.background_model.apply(self._small)
+        cv2.dilate(coarse, self._kernel, dst=self._grown)
+
+        n_regions, labels, stats, _ = cv2.connectedComponentsWithStats(self._grown)
+        background = self.background_model.get_background()
+
+        self.mask[:] = 0
+        gather_centroids, gather_areas = [], []
+
+        for label in range(1, n_regions):
+            x, y, w, h = stats[label, :4]
+            x0, y0, x1, y1 = x * f, y * f, min((x + w) * f, width), min((y + h) * f, height)
+
+            patch = frame[y0:y1, x0:x1]
+            patch_background = cv2.resize(background[y:y + h, x:x + w], (x1 - x0, y1 - y0),
+                                          interpolation=cv2.INTER_LINEAR)
+
+            # Same rectification and threshold as the background model:
+            patch_mask = cv2.threshold(cv2.subtract(patch_background, patch), self.background_model.k, 255,
+                                       cv2.THRESH_BINARY)[1]
+            np.bitwise_or(self.mask[y0:y1, x0:x1], patch_mask, out=self.mask[y0:y1, x0:x1])
+
+            centroids, areas = self.detector.detect(patch_mask)
+            centroids = centroids + (x0, y0)
+
+            rows = np.clip(centroids[:, 1].astype(np.int64) // f, 0, labels.shape[0] - 1)
+            cols = np.clip(centroids[:, 0].astype(np.int64) // f, 0, labels.shape[1] - 1)
+            keep = labels[rows, cols] == label
+
+            gather_centroids.append(centroids[keep])
+            gather_areas.append(areas[keep])
+
+        if not gather_areas:
+            return np.zeros((0, 2)), np.zeros(0, dtype=np.int32), self.mask
+
+        return np.concatenate(gather_centroids), np.concatenate(gather_areas), self.mask
+
+
+def roi_from_settings(camera_settings, gsettings):
+    """Region of interest from the camera settings (roi: [x, y, width, height]), from projecting the arena through
+    the calibration (roi_from_calibration) or the full frame."""
+
+    frame_size = (camera_settings["f7"]["width"], camera_settings["f7"]["height"])
+
+    if camera_settings.get("roi") is not None:
+        return RegionOfInterest(camera_settings["roi"])
+
+    if gsettings.get("roi_from_calibration", False):
+        return roi_from_calibration(gsettings["current_calibration"], str(camera_settings["serial"]),
+                                    gsettings["arena_bounds"], frame_size, margin=gsettings.get("roi_margin", 10))
+
+    return RegionOfInterest((0, 0) + frame_size)
+
+
+class Detector(object):
+    """Complete 2D detection of one camera as configured in the general settings: background subtraction and blob
+    detection within the region of interest, optionally coarse-to-fine."""
+
+    def __init__(self, gsettings, roi):
+        self.roi = roi
+
+        self.background_model = BackgroundSubtractor(gsettings["background_subtraction_alpha"],
+                                                     gsettings["background_subtraction_threshold"],
+                                                     update_every=gsettings.get("background_update_every", 1),
+                                                     masked_update=gsettings.get("background_masked_update", False))
+        self.detector = BlobDetector(gsettings.get("blob_min_area", 2), gsettings.get("blob_max_area"))
+
+        self.coarse_to_fine = None
+        if gsettings.get("coarse_to_fine_factor", 1) > 1:
+            self.coarse_to_fine = CoarseToFineDetector(self.background_model, self.detector,
+                                                       factor=gsettings["coarse_to_fine_factor"])
+
+    def apply(self, frame):
+        """Returns the centroids (in frame coordinates) and areas of all targets and the foreground mask of the
+        region of interest."""
+
+        image = self.roi.crop(frame)
+
+        if self.coarse_to_fine is not None:
+            centroids, areas, mask = self.coarse_to_fine.apply(image)
+        else:
+            mask = self.background_model.apply(image)
+            centroids, areas = self.detector.detect(mask)
+
+        centroids, areas = self.roi.to_frame(centroids, areas)
+
+        return centroids, areas, mask
@@ -1,25 +1,66 @@
 from os import path, makedirs
 
 import numpy as np
-import pandas as pd
 import cv2
 from tqdm import tqdm_notebook
+from yaml import load_all, SafeLoader
 
+from ..storage.session import Session, AviReader
 
-def render_projection_video(camera_system, cam_id, data_path, tracked, twod, upto=None):
+
+def estimate_fps(timestamps):
+    """Frame rate from the median interval between camera timestamps, or None if there are no usable intervals
+    (single frame, repeated or zeroed timestamps)."""
+
+    intervals = np.diff(np.asarray(timestamps, dtype=np.float64))
+    intervals = intervals[intervals > 0]
+
+    if intervals.size == 0:
+        return None
+
+    return 1.0 / np.median(intervals)
+
+
+def session_fps(session, data_path, camera):
+    """Frame rate of a recorded camera: the frame rate of the video container (AVI), else estimated from its camera
+    timestamps, else the framerate configured in the settings.yaml stored with the session."""
+
+    reader = session.reader(camera)
+    if isinstance(reader, AviReader):
+        fps = reader.capture.get(cv2.CAP_PROP_FPS)
+        if fps > 0:
+            return fps
+
+    fps = estimate_fps(session.metadata[camera].camera_timestamp)
+    if fps is not None:
+        return fps
+
+    settings_file = path.join(data_path, "settings.yaml")
+    if path.exists(settings_file):
+        with open(settings_file) as f:
+            gsettings = next(load_all(f, Loader=SafeLoader))
+        if gsettings.get("framerate"):
+            return float(gsettings["framerate"])
+
+    raise ValueError("Cannot determine the frame rate of {0}, please pass fps!".format(camera))
+
+
+def render_projection_video(camera_system, cam_id, data_path, tracked, twod, upto=None, start=0, fps=None):
 
     # Create directory iff it doesn't exist:
     dirname = path.join(data_path, "diagnostics")
     if not path.exists(dirname):
         makedirs(dirname)
 
-    # Load up video:
-    r = cv2.VideoCapture(path.join(data_path, "raw", "Cam{0}.avi".format(cam_id)))
-    width, height = int(r.get(cv2.CAP_PROP_FRAME_WIDTH)), int(r.get(cv2.CAP_PROP_FRAME_HEIGHT))
-    fps = r.get(cv2.CAP_PROP_FPS)
+    # Load up recording (random access, so rendering can start anywhere):
+    session = Session(data_path)
+    camera = "Cam{0}".format(cam_id)
+    height, width = session.read(camera, 0)[0].shape[:2]
 
     # Load frame IDs:
-    frame_n = pd.read_csv(path.join(data_path, "raw", "Cam{0}.csv".format(cam_id))).frame_number
+    frame_n = session.metadata[camera].frame_number
+    if fps is None:
+        fps = session_fps(session, data_path, camera)
 
     fourcc = cv2.VideoWriter_fourcc(*"X264")
     filename = path.join(data_path, "diagnostics", "Cam{0}_tracked.avi".format(cam_id))
@@ -28,18 +69,15 @@ def render_projection_video(camera_system, cam_id, data_path, tracked, twod, upt
     if upto is None:
         upto = frame_n.max()
 
+    upto = min(upto, session.n_frames(camera))
+
     failures = []
 
     my2d = twod.xs(cam_id, level="camera_id").sort_index()
 
-    for frame_idx in tqdm_notebook(range(upto)):
-
-        retval, current_frame = r.read()
-
-        if not retval:
-            break
+    for frame_idx in tqdm_notebook(range(start, upto)):
 
-        # current_frame = cv2.cvtColor(current_frame, cv2.COLOR_GRAY2BGR)
+        current_frame = cv2.cvtColor(session.read(camera, frame_idx)[0], cv2.COLOR_GRAY2BGR)
 
         # Pick targets:
         frame_ = frame_n[frame_idx]
@@ -76,6 +114,6 @@ def render_projection_video(camera_system, cam_id, data_path, tracked, twod, upt
     failures = np.array(failures)
 
     w.release()
-    r.release()
+    session.close()
 
     return failures
@@ -0,0 +1,68 @@
+from multiprocessing import Pool
+from time import time
+
+from numba import jit
+
+try:
+    from numba import set_num_threads
+except ImportError:
+    # Before numba 0.49 (the last release for Python 2.7 is 0.47), the number of threads is fixed by NUMBA_NUM_THREADS:
+    set_num_threads = None
+
+# Registry of the compiled (nopython) kernels of the tracking package.
+#
+# Kernels are declared with an explicit signature and cached on disk by numba (in __pycache__ next to the source), so
+# only the first run after a change pays for compilation. compile_kernels builds (or loads) all registered signatures
+# up front, e.g. in the initializer of worker processes, so that compilation does not end up in the timing of the
+# first frames. Calls with other argument types still work; they are compiled (and cached) on first use.
+#
+# Note that numba only checks the source file of a kernel to invalidate its cache; after changing a kernel that
+# others call from a different file, remove the __pycache__ folder of the tracking package.
+
+KERNELS = []
+
+
+def kernel(signature, **options):
+    """Decorator for a nopython kernel with an explicit signature (numba signature string) and on-disk caching."""
+
+    def decorate(function):
+        dispatcher = jit(nopython=True, cache=True, **options)(function)
+        KERNELS.append((dispatcher, signature))
+        return dispatcher
+
+    return decorate
+
+
+def compile_kernels():
+    """Compiles all registered kernels (loading them from the cache where possible). Returns the time spent in
+    seconds."""
+
+    start = time()
+
+    for dispatcher, signature in KERNELS:
+        dispatcher.compile(signature)
+
+    return time() - start
+
+
+def prebuild_kernels():
+    """Runs compile_kernels in a separate process, so that the on-disk cache is complete before worker processes
+    start. Loading parallel kernels starts numba's thread pool, which does not survive fork (processes that fork
+    afterwards hang on exit), so processes that start worker pools should not compile kernels themselves."""
+
+    pool = Pool(processes=1)
+
+    try:
+        return pool.apply(compile_kernels)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def single_threaded():
+    """Runs the parallel kernels of the calling process on a single thread. Meant for the initializer of pool
+    workers: the pool already uses every core, and workers that each start a thread per core oversubscribe them.
+    Without numba.set_num_threads (numba < 0.49), this does nothing; set NUMBA_NUM_THREADS=1 for such runs instead."""
+
+    if set_num_threads is not None:
+        set_num_threads(1)
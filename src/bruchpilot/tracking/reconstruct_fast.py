@@ -1,17 +1,20 @@
 import numpy as np
-from numba import jit
-import cv2
-from munkres import munkres
+import pandas as pd
+from numba import jit, prange
 from itertools import permutations
 from sys import stdout
 
+from .assignment import sparse_assignment, complete_assignment, lap_numba
+from .undistortion import UndistortionMaps
+from .kernels import kernel, compile_kernels
+
 # Hungarian algorithm-based tracking system
 # Adapted from Ardekani et al. 2013
 
 
 ### HELPER FUNCTIONS
 
-@jit(nopython=True)
+@kernel("int64[:, ::1](int64)")
 def cartesian_numba(n):
     """Returns the Cartesian product of range(n)"""
 
@@ -24,35 +27,19 @@ def cartesian_numba(n):
     return out
 
 
-def count_above(arr, above=0):
-    k, n = arr.shape
-    out = np.zeros(n, dtype=np.int64)
-    for nidx in range(n):
-        subarr = arr[:, nidx]
-        out[nidx] = (subarr[subarr >= above]).size
-    return out
-
-
-def munkres_safe(e):
-    """Wrapper around Hungarian algorithm that allows infinite values"""
+def munkres_safe(e, solver="scipy"):
+    """Wrapper around the assignment solver that allows infinite values. Returns a column for every row."""
 
     e = e.copy()
-
-    try:
-        practicalInfinity = 2 * e[e < np.inf].max() + 1
-    except ValueError:
-        practicalInfinity = 1
-
-    e[e == np.inf] = practicalInfinity
     e[e == -np.inf] = 0.0
 
-    assignment = munkres(e)
-    return np.argwhere(assignment)[:, 1]
+    rows, cols = sparse_assignment(e, solver=solver)
+    return complete_assignment(e.shape[0], e.shape[1], rows, cols)
 
 
 ### TRIANGULATION METHODS
 
-@jit(nopython=True)
+@kernel("float64[:, ::1](float64[:, ::1], float64[:, ::1], float64[:, ::1], float64[:, ::1])")
 def fast_triangulation_numba(mat1, mat2, pts1, pts2):
     """Implementation of SVD-based triangulation method."""
     
@@ -78,71 +65,187 @@ def fast_triangulation_numba(mat1, mat2, pts1, pts2):
     return output_pts / output_pts[3, :]
 
 
-@jit
-def fast_triangulation_opencv(mat1, mat2, pts1, pts2):
-    """OpenCV implementation of triangulation."""
-    output_pts = cv2.triangulatePoints(mat1, mat2, pts1, pts2)
-    return output_pts / output_pts[3, :]
-
-
-@jit(nopython=True)
+@kernel("float64[:, ::1](float64[:, ::1], float64[:, ::1])")
 def multi_dot(a, B):
     pts = np.dot(a, B)
     return pts[:2, :] / pts[2, :]
 
 
-def multi_dist(a, b):
-    return np.sqrt(np.sum((a - b) ** 2, axis=0))
+# Degenerate geometry (parallel rays, points at infinity) divides by zero; as in numpy, this yields inf/nan (which the
+# matching treats as inadmissible) instead of raising:
+@kernel("UniTuple(float64, 3)(float64[:, ::1], float64[:, ::1], float64, float64, float64, float64)",
+        error_model="numpy")
+def triangulate_pair(m1, m2, x1, y1, x2, y2):
+    """Closed-form linear triangulation from two views: least-squares solution of the inhomogeneous DLT system,
+    with the 3x3 normal equations solved via Cramer's rule."""
 
+    # Accumulate normal equations of the 4x3 system A * X = b:
+    a00, a01, a02, a11, a12, a22 = 0.0, 0.0, 0.0, 0.0, 0.0, 0.0
+    b0, b1, b2 = 0.0, 0.0, 0.0
 
-@jit
-def backprojection_error(m1, m2, pts1, pts2):
-    """Calculates backprojection error after triangulation."""
+    for view in range(2):
+        if view == 0:
+            m, x, y = m1, x1, y1
+        else:
+            m, x, y = m2, x2, y2
+
+        for row in range(2):
+            c = x if row == 0 else y
+            r0 = c * m[2, 0] - m[row, 0]
+            r1 = c * m[2, 1] - m[row, 1]
+            r2 = c * m[2, 2] - m[row, 2]
+            rb = m[row, 3] - c * m[2, 3]
+
+            a00 += r0 * r0
+            a01 += r0 * r1
+            a02 += r0 * r2
+            a11 += r1 * r1
+            a12 += r1 * r2
+            a22 += r2 * r2
+            b0 += r0 * rb
+            b1 += r1 * rb
+            b2 += r2 * rb
+
+    c00 = a11 * a22 - a12 * a12
+    c01 = a02 * a12 - a01 * a22
+    c02 = a01 * a12 - a02 * a11
+    det = a00 * c00 + a01 * c01 + a02 * c02
+
+    c11 = a00 * a22 - a02 * a02
+    c12 = a01 * a02 - a00 * a12
+    c22 = a00 * a11 - a01 * a01
+
+    X = (c00 * b0 + c01 * b1 + c02 * b2) / det
+    Y = (c01 * b0 + c11 * b1 + c12 * b2) / det
+    Z = (c02 * b0 + c12 * b1 + c22 * b2) / det
+
+    return X, Y, Z
+
+
+@kernel("float64(float64[:, ::1], float64, float64, float64, float64, float64)", error_model="numpy")
+def reprojection_distance(m, X, Y, Z, x, y):
+    w = m[2, 0] * X + m[2, 1] * Y + m[2, 2] * Z + m[2, 3]
+    u = (m[0, 0] * X + m[0, 1] * Y + m[0, 2] * Z + m[0, 3]) / w
+    v = (m[1, 0] * X + m[1, 1] * Y + m[1, 2] * Z + m[1, 3]) / w
+    return np.sqrt((u - x) ** 2 + (v - y) ** 2)
+
+
+def triangulate_many(ms, pts, matchings):
+    """Linear (SVD-based) triangulation of all columns of a (k x n) matching at once, as in pymvg's find3d.
+
+    The DLT systems of all points are stacked into an (n x 2k x 4) array; rows of cameras that do not see a point are
+    zeroed, which leaves its solution unchanged. Returns the (n x 3) points and their mean reprojection errors."""
+
+    k, n = matchings.shape
 
-    pts3d = fast_triangulation_opencv(m1, m2, pts1, pts2)
+    if n == 0:
+        return np.zeros((0, 3)), np.zeros(0)
 
-    bp1 = multi_dot(m1, pts3d)
-    bp2 = multi_dot(m2, pts3d)
+    xy = pts[np.arange(k)[:, np.newaxis], np.maximum(matchings, 0)]
+    valid = (matchings >= 0) & np.logical_not(np.isnan(xy[:, :, 0]))
+    xy[np.logical_not(valid)] = 0.0
 
-    dists = 0.5 * (multi_dist(bp1, pts1) + multi_dist(bp2, pts2))
+    rows_x = xy[:, :, 0, np.newaxis] * ms[:, np.newaxis, 2, :] - ms[:, np.newaxis, 0, :]
+    rows_y = xy[:, :, 1, np.newaxis] * ms[:, np.newaxis, 2, :] - ms[:, np.newaxis, 1, :]
+    rows_x[np.logical_not(valid)] = 0.0
+    rows_y[np.logical_not(valid)] = 0.0
 
-    # Fix errors for NaN:
-    nan_mask1 = np.isnan(pts1[0, :])
-    nan_mask2 = np.isnan(pts2[0, :])
+    mat_a = np.concatenate((rows_x, rows_y), axis=0).transpose((1, 0, 2))
+    _, _, vt = np.linalg.svd(mat_a)
+    pts_h = vt[:, 3, :] / vt[:, 3, 3:]
 
-    dists[np.logical_and(nan_mask1, nan_mask2)] = -np.inf
-    dists[np.logical_xor(nan_mask1, nan_mask2)] = np.inf
+    # Reproject into all cameras:
+    projected = np.einsum("kij,nj->kni", ms, pts_h)
+    distances = np.sqrt(((projected[:, :, :2] / projected[:, :, 2:] - xy) ** 2).sum(axis=2))
+    errors = (distances * valid).sum(axis=0) / valid.sum(axis=0)
 
-    return dists
+    return pts_h[:, :3], errors
 
 
 ## SEQH MACHINERY
 
-@jit
-def generate_error_matrix(ms, pts):
-    """Populates the error matrix using backprojection of current assignment to targets."""
+def camera_pairs(k):
+    """All camera index pairs (kidx1 < kidx2) as a (k * (k - 1) / 2 x 2) array."""
+    return np.array([(kidx1, kidx2) for kidx1 in range(k - 1) for kidx2 in range(kidx1 + 1, k)],
+                    dtype=np.int64).reshape((-1, 2))
 
-    # Pre-allocate matrix:
-    k, n = pts.shape[0], pts.shape[1]
-    e = np.zeros((k, k, n, n)) * np.NaN
 
-    idx_select = cartesian_numba(n)
+@kernel("void(float64[:, :, ::1], float64[:, :, ::1], int64, int64, float64[:, :, :, ::1])")
+def fill_error_pair(ms, pts, kidx1, kidx2, e):
+    """Populates the error matrix blocks of one camera pair with the mean backprojection error of every pair of
+    points. Pairs in which both points are missing get -inf, pairs with one missing point get inf."""
+
+    n = pts.shape[1]
+    m1, m2 = ms[kidx1], ms[kidx2]
+
+    for idx1 in range(n):
+        x1, y1 = pts[kidx1, idx1, 0], pts[kidx1, idx1, 1]
+        missing1 = np.isnan(x1)
+
+        for idx2 in range(n):
+            x2, y2 = pts[kidx2, idx2, 0], pts[kidx2, idx2, 1]
+            missing2 = np.isnan(x2)
+
+            if missing1 and missing2:
+                err = -np.inf
+            elif missing1 or missing2:
+                err = np.inf
+            else:
+                X, Y, Z = triangulate_pair(m1, m2, x1, y1, x2, y2)
+                err = 0.5 * (reprojection_distance(m1, X, Y, Z, x1, y1) +
+                             reprojection_distance(m2, X, Y, Z, x2, y2))
+
+            e[kidx1, kidx2, idx1, idx2] = err
+            e[kidx2, kidx1, idx2, idx1] = err
+
+
+@kernel("void(float64[:, :, ::1], float64[:, :, ::1], int64[:, ::1], float64[:, :, :, ::1])", parallel=True)
+def fill_error_matrix(ms, pts, pairs, e):
+    """Populates the error matrix e (k x k x n x n) for all camera pairs in parallel."""
+
+    k = pts.shape[0]
 
-    for kidx1 in np.arange(k - 1):
-        for kidx2 in np.arange(kidx1 + 1, k):
-            m1, m2 = ms[kidx1, :, :], ms[kidx2, :, :]
+    for kidx in range(k):
+        e[kidx, kidx, :, :] = np.nan
 
-            pt_buffer1 = pts[kidx1, idx_select[:, 0], :].T
-            pt_buffer2 = pts[kidx2, idx_select[:, 1], :].T
+    for pidx in prange(pairs.shape[0]):
+        fill_error_pair(ms, pts, pairs[pidx, 0], pairs[pidx, 1], e)
 
-            errs = backprojection_error(m1, m2, pt_buffer1, pt_buffer2).reshape((n, n))
-            e[kidx1, kidx2, :, :] = errs
-            e[kidx2, kidx1, :, :] = errs.T
+
+class ErrorMatrixBuffer(object):
+    """Reusable storage for error matrices, so that no frame allocates a fresh k x k x n x n array."""
+
+    def __init__(self):
+        self._storage = np.zeros(0)
+        self._pairs = {}
+
+    def get(self, k, n):
+        size = k * k * n * n
+        if self._storage.size < size:
+            self._storage = np.empty(2 * size)
+        return self._storage[:size].reshape((k, k, n, n))
+
+    def get_pairs(self, k):
+        if k not in self._pairs:
+            self._pairs[k] = camera_pairs(k)
+        return self._pairs[k]
+
+
+def generate_error_matrix(ms, pts, buffer=None):
+    """Populates the error matrix using backprojection of current assignment to targets."""
+
+    if buffer is None:
+        buffer = ErrorMatrixBuffer()
+
+    k, n = pts.shape[0], pts.shape[1]
+    e = buffer.get(k, n)
+
+    fill_error_matrix(ms, np.ascontiguousarray(pts, dtype=np.float64), buffer.get_pairs(k), e)
 
     return e
 
 
-@jit(nopython=True)
+@kernel("float64[:, ::1](int64, int64[:, ::1], float64[:, :, :, ::1])")
 def gather_errors(current_camera, assignments, error_matrix):
 
     k, n = assignments.shape
@@ -164,7 +267,7 @@ def gather_errors(current_camera, assignments, error_matrix):
     return errors
 
 
-@jit(nopython=True)
+@kernel("void(float64[:, :, ::1], int64[:, ::1], int64[::1], int64, float64[:, ::1], float64)")
 def update_matching(pts, assignments, matching, current_camera, local_errors, threshold):
 
     n = assignments.shape[1]
@@ -184,7 +287,7 @@ def update_matching(pts, assignments, matching, current_camera, local_errors, th
                     assignments[current_camera, update_idx] = matching[update_idx]
 
 
-@jit(nopython=True)
+@kernel("float64(float64[:, :, ::1], int64[:, ::1], float64[:, :, :, ::1], int64)")
 def calculate_matching_cost(pts, assignment, error_matrix, failure_penalty):
 
     overall_cost = 0.0
@@ -207,8 +310,21 @@ def calculate_matching_cost(pts, assignment, error_matrix, failure_penalty):
     return overall_cost + failure_penalty * failures
 
 
+def step_camera(pts, assignments, current_camera, error_matrix, threshold, solver="scipy"):
+    """Matches the points of one additional camera into the current assignment (in place)."""
+
+    # Construct error matrix:
+    local_errors = gather_errors(current_camera, assignments, error_matrix)
+
+    # Calculate matching:
+    matching = munkres_safe(local_errors, solver=solver)
+
+    # Update C:
+    update_matching(pts, assignments, matching, current_camera, local_errors, threshold)
+
+
 @jit
-def step(ms, pts, permutation, error_matrix, threshold):
+def step(ms, pts, permutation, error_matrix, threshold, solver="scipy"):
     
     k, n = pts.shape[0], pts.shape[1]
     assignments = np.ones((k, n)).astype(np.int64) * -1
@@ -216,49 +332,485 @@ def step(ms, pts, permutation, error_matrix, threshold):
     assignments[permutation[0], :] = range(n)
 
     for cidx in range(1, k):
-        
-        current_camera = permutation[cidx]
+        step_camera(pts, assignments, permutation[cidx], error_matrix, threshold, solver)
 
-        # Construct error matrix:
-        local_errors = gather_errors(current_camera, assignments, error_matrix)
-        
-        # Calculate matching:
-        matching = munkres_safe(local_errors)
+    return assignments
 
-        # Update C:
-        update_matching(pts, assignments, matching, current_camera, local_errors, threshold)
 
-    return assignments
+## SEARCH OVER CAMERA ORDERINGS
+#
+# The sequential matching depends on the order in which cameras are added. The exhaustive search tries all k!
+# orderings; the other modes work with a fixed budget:
+#
+# * beam: beam search over orderings, keeping the best `budget` partial orderings after each added camera
+# * ranked: ranks all orderings by a cheap proxy cost (pairwise camera agreement) and evaluates the best `budget`
+# * count: a single ordering, cameras sorted by number of detections (descending)
+
+SEARCH_MODES = ("exhaustive", "beam", "ranked", "count")
+DEFAULT_BUDGETS = {"beam": 3, "ranked": 6}
+
+
+def check_search(search, budget=None):
+    """Validates a search mode and its budget. Returns the budget (the default of the mode for None)."""
+
+    if search not in SEARCH_MODES:
+        raise ValueError("Unknown search mode '{0}' (available: {1})".format(search, ", ".join(SEARCH_MODES)))
+
+    if budget is None:
+        return DEFAULT_BUDGETS.get(search, 0)
+
+    if search in DEFAULT_BUDGETS and budget < 1:
+        raise ValueError("The budget of search mode '{0}' must be at least 1 (got {1})".format(search, budget))
+
+    return budget
+
+
+def detection_counts(pts):
+    return np.sum(np.logical_not(np.isnan(pts[:, :, 0])), axis=1)
+
+
+def detection_order(pts):
+    """Cameras sorted by their number of detections, descending."""
+    return tuple(np.argsort(-detection_counts(pts), kind="mergesort"))
+
+
+def camera_agreement(pts, error_matrix, failure_penalty, solver="scipy"):
+    """Pairwise camera cost: error of the best matching between the points of two cameras, plus the failure penalty
+    for every detection that remains unmatched."""
+
+    k = pts.shape[0]
+    counts = detection_counts(pts)
+    agreement = np.zeros((k, k))
+
+    for kidx1 in range(k - 1):
+        for kidx2 in range(kidx1 + 1, k):
+            e = error_matrix[kidx1, kidx2, :, :]
+            valid = np.isfinite(e)
+            rows, cols = sparse_assignment(np.where(valid, e, np.inf), solver=solver)
+            unmatched = max(counts[kidx1], counts[kidx2]) - rows.size
+            agreement[kidx1, kidx2] = agreement[kidx2, kidx1] = e[rows, cols].sum() + failure_penalty * unmatched
+
+    return agreement
+
+
+def rank_orderings(orderings, agreement, counts, failure_penalty):
+    """Proxy cost of every ordering: the seed camera is charged the failure penalty for every detection it misses
+    compared to the best camera, and each added camera is charged its agreement with the best earlier camera."""
+
+    orderings = np.asarray(orderings)
+    proxy = failure_penalty * (counts.max() - counts[orderings[:, 0]]).astype(np.float64)
+
+    for cidx in range(1, orderings.shape[1]):
+        pair_costs = agreement[orderings[:, :cidx], orderings[:, cidx:cidx + 1]]
+        proxy += pair_costs.min(axis=1)
+
+    return np.argsort(proxy, kind="mergesort")
+
+
+def beam_search(pts, error_matrix, threshold, failure_penalty, width, solver="scipy"):
+    """Beam search over camera orderings. Returns the best full assignment and the number of camera steps."""
+
+    k, n = pts.shape[0], pts.shape[1]
+
+    # Every camera is tried as a seed; pruning starts once two cameras have been matched:
+    beam = []
+    for seed in detection_order(pts):
+        assignments = np.ones((k, n)).astype(np.int64) * -1
+        assignments[seed, :] = range(n)
+        beam.append(((seed,), assignments))
+
+    n_steps = 0
+
+    for _ in range(1, k):
+        candidates = []
+
+        for ordering, assignments in beam:
+            for current_camera in range(k):
+                if current_camera in ordering:
+                    continue
+
+                new_assignments = assignments.copy()
+                step_camera(pts, new_assignments, current_camera, error_matrix, threshold, solver)
+                cost = calculate_matching_cost(pts, new_assignments, error_matrix, failure_penalty)
+                candidates.append((cost, ordering + (current_camera,), new_assignments))
+                n_steps += 1
+
+        candidates.sort(key=lambda c: c[0])
+        beam = [(ordering, assignments) for _, ordering, assignments in candidates[:width]]
+
+    return beam[0][1], n_steps
+
+
+def search_matching(ms, pts, error_matrix, threshold, failure_penalty, solver="scipy", search="exhaustive",
+                    budget=None):
+    """Runs the selected search mode. Returns the best assignment, its cost and the number of camera steps spent."""
+
+    k = pts.shape[0]
+    budget = check_search(search, budget)
+
+    if search == "beam":
+        assignments, n_steps = beam_search(pts, error_matrix, threshold, failure_penalty, budget, solver=solver)
+        return assignments, calculate_matching_cost(pts, assignments, error_matrix, failure_penalty), n_steps
+
+    if search == "exhaustive":
+        perms = list(permutations(range(k)))
+    elif search == "count":
+        perms = [detection_order(pts)]
+    else:
+        perms = list(permutations(range(k)))
+        agreement = camera_agreement(pts, error_matrix, failure_penalty, solver=solver)
+        ranking = rank_orderings(perms, agreement, detection_counts(pts), failure_penalty)
+        perms = [perms[pidx] for pidx in ranking[:budget]]
+
+    matchings = np.zeros((len(perms), k, pts.shape[1])).astype(np.int64)
+    costs = np.zeros(len(perms))
+
+    for pidx in range(len(perms)):
+        matchings[pidx, :, :] = step(ms, pts, perms[pidx], error_matrix, threshold, solver)
+        costs[pidx] = calculate_matching_cost(pts, matchings[pidx, :, :], error_matrix, failure_penalty)
+
+    min_idx = np.argmin(costs)
+    return matchings[min_idx, :, :], costs[min_idx], len(perms) * (k - 1)
 
 
 @jit
-def match(ms, pts, threshold=None, failure_penalty=100000):
+def match(ms, pts, threshold=None, failure_penalty=100000, solver="scipy", search="exhaustive", budget=None,
+          buffer=None):
 
     k, n = pts.shape[:2]
     assert k == ms.shape[0]
 
-    perms = list(permutations(range(k)))
-    error_matrix = generate_error_matrix(ms, pts)
+    error_matrix = generate_error_matrix(ms, pts, buffer=buffer)
 
     if threshold is None:
         threshold = np.inf
 
-    matchings = np.zeros((len(perms), k, n)).astype(np.int64)
-    costs = np.zeros(len(perms))
+    if solver == "numba":
+        perms, search_code, budget = compiled_search_arguments(k, search, budget)
+        return search_matching_numba(np.ascontiguousarray(pts, dtype=np.float64), error_matrix, threshold,
+                                     failure_penalty, perms, search_code, budget)
 
-    for pidx in range(len(perms)):
-        matchings[pidx, :, :] = step(ms, pts, perms[pidx], error_matrix, threshold)
-        costs[pidx] = calculate_matching_cost(pts, matchings[pidx, :, :], error_matrix, failure_penalty)
+    return search_matching(ms, pts, error_matrix, threshold, failure_penalty, solver=solver, search=search,
+                           budget=budget)[0]
+
+
+def search_gap(ms, pts, threshold=None, failure_penalty=100000, solver="scipy", search="exhaustive", budget=None,
+               buffer=None):
+    """Compares a search mode against the exhaustive search on one frame."""
+
+    error_matrix = generate_error_matrix(ms, pts, buffer=buffer)
+
+    if threshold is None:
+        threshold = np.inf
+
+    _, cost, n_steps = search_matching(ms, pts, error_matrix, threshold, failure_penalty, solver=solver,
+                                       search=search, budget=budget)
+    _, exhaustive_cost, exhaustive_steps = search_matching(ms, pts, error_matrix, threshold, failure_penalty,
+                                                           solver=solver)
+
+    return {
+        "cost": cost,
+        "exhaustive_cost": exhaustive_cost,
+        "gap": cost - exhaustive_cost,
+        "steps": n_steps,
+        "exhaustive_steps": exhaustive_steps,
+    }
+
+
+## COMPILED SEARCH AND BATCH RECONSTRUCTION
+#
+# nopython counterparts of the search modes above, built on the compiled Hungarian solver (lap_numba). They are
+# used by match() for solver="numba" and by reconstruct_batch, which processes many frames per call.
+
+SEARCH_CODES = {"exhaustive": 0, "beam": 1, "ranked": 2, "count": 3}
+
+
+def compiled_search_arguments(k, search, budget):
+    """Orderings array, search code and budget as expected by search_matching_numba."""
+
+    budget = check_search(search, budget)
+
+    perms = np.array(list(permutations(range(k))), dtype=np.int64)
+    return perms, SEARCH_CODES[search], budget
+
+
+@kernel("int64[::1](float64[:, ::1])")
+def munkres_safe_numba(e):
+    """nopython version of munkres_safe: returns a column for every row of a square matrix."""
+
+    e = e.copy()
+    n = e.shape[0]
+
+    largest = -np.inf
+    for idx1 in range(n):
+        for idx2 in range(e.shape[1]):
+            if e[idx1, idx2] == -np.inf:
+                e[idx1, idx2] = 0.0
+            if np.isfinite(e[idx1, idx2]) and e[idx1, idx2] > largest:
+                largest = e[idx1, idx2]
+
+    practical_infinity = 2 * largest + 1 if np.isfinite(largest) else 1.0
+
+    for idx1 in range(n):
+        for idx2 in range(e.shape[1]):
+            if not np.isfinite(e[idx1, idx2]):
+                e[idx1, idx2] = practical_infinity
+
+    return lap_numba(e)
+
+
+@kernel("void(float64[:, :, ::1], int64[:, ::1], int64, float64[:, :, :, ::1], float64)")
+def step_camera_numba(pts, assignments, current_camera, error_matrix, threshold):
+    local_errors = gather_errors(current_camera, assignments, error_matrix)
+    matching = munkres_safe_numba(local_errors)
+    update_matching(pts, assignments, matching, current_camera, local_errors, threshold)
+
+
+@kernel("int64[:, ::1](float64[:, :, ::1], int64[::1], float64[:, :, :, ::1], float64)")
+def evaluate_ordering_numba(pts, ordering, error_matrix, threshold):
+
+    k, n = pts.shape[0], pts.shape[1]
+    assignments = np.ones((k, n), dtype=np.int64) * -1
+    assignments[ordering[0], :] = np.arange(n)
+
+    for cidx in range(1, k):
+        step_camera_numba(pts, assignments, ordering[cidx], error_matrix, threshold)
+
+    return assignments
+
+
+@kernel("Tuple((int64[::1], int64[::1]))(float64[:, :, ::1])")
+def detection_order_numba(pts):
+    k = pts.shape[0]
+    counts = np.zeros(k, dtype=np.int64)
+    for kidx in range(k):
+        for nidx in range(pts.shape[1]):
+            if not np.isnan(pts[kidx, nidx, 0]):
+                counts[kidx] += 1
+    return np.argsort(-counts, kind="mergesort"), counts
+
+
+@kernel("float64[:, ::1](float64[:, :, ::1], float64[:, :, :, ::1], int64[::1], int64)")
+def camera_agreement_numba(pts, error_matrix, counts, failure_penalty):
+
+    k, n = pts.shape[0], pts.shape[1]
+    agreement = np.zeros((k, k))
+
+    for kidx1 in range(k - 1):
+        for kidx2 in range(kidx1 + 1, k):
+            e = np.empty((n, n))
+            for idx1 in range(n):
+                for idx2 in range(n):
+                    e[idx1, idx2] = error_matrix[kidx1, kidx2, idx1, idx2]
+                    if not np.isfinite(e[idx1, idx2]):
+                        e[idx1, idx2] = np.inf
+
+            cols = munkres_safe_numba(e)
+
+            cost, matched = 0.0, 0
+            for idx1 in range(n):
+                if np.isfinite(e[idx1, cols[idx1]]):
+                    cost += e[idx1, cols[idx1]]
+                    matched += 1
+
+            unmatched = max(counts[kidx1], counts[kidx2]) - matched
+            agreement[kidx1, kidx2] = cost + failure_penalty * unmatched
+            agreement[kidx2, kidx1] = agreement[kidx1, kidx2]
+
+    return agreement
 
-    min_idx = np.argmin(costs)
-    return matchings[min_idx, :, :]
+
+@kernel("int64[:, ::1](float64[:, :, ::1], float64[:, :, :, ::1], float64, int64, int64)")
+def beam_search_numba(pts, error_matrix, threshold, failure_penalty, width):
+
+    k, n = pts.shape[0], pts.shape[1]
+    seeds, _ = detection_order_numba(pts)
+
+    n_beam = k
+    beam_orders = np.zeros((k, k), dtype=np.int64)
+    beam_assignments = np.ones((k, k, n), dtype=np.int64) * -1
+    for bidx in range(k):
+        beam_orders[bidx, 0] = seeds[bidx]
+        beam_assignments[bidx, seeds[bidx], :] = np.arange(n)
+
+    for depth in range(1, k):
+        n_candidates = n_beam * (k - depth)
+        candidate_orders = np.zeros((n_candidates, k), dtype=np.int64)
+        candidate_assignments = np.empty((n_candidates, k, n), dtype=np.int64)
+        candidate_costs = np.empty(n_candidates)
+
+        cidx = 0
+        for bidx in range(n_beam):
+            for current_camera in range(k):
+                taken = False
+                for didx in range(depth):
+                    if beam_orders[bidx, didx] == current_camera:
+                        taken = True
+                if taken:
+                    continue
+
+                candidate_assignments[cidx] = beam_assignments[bidx]
+                step_camera_numba(pts, candidate_assignments[cidx], current_camera, error_matrix, threshold)
+                candidate_costs[cidx] = calculate_matching_cost(pts, candidate_assignments[cidx], error_matrix,
+                                                                failure_penalty)
+                candidate_orders[cidx, :depth] = beam_orders[bidx, :depth]
+                candidate_orders[cidx, depth] = current_camera
+                cidx += 1
+
+        keep = np.argsort(candidate_costs, kind="mergesort")[:width]
+        n_beam = keep.size
+        beam_orders = candidate_orders[keep]
+        beam_assignments = candidate_assignments[keep]
+
+    return beam_assignments[0]
+
+
+@kernel("int64[:, ::1](float64[:, :, ::1], float64[:, :, :, ::1], float64, int64, int64[:, ::1], int64, int64)")
+def search_matching_numba(pts, error_matrix, threshold, failure_penalty, perms, search_code, budget):
+    """Compiled search over camera orderings; perms holds all k! orderings as rows."""
+
+    k = pts.shape[0]
+
+    if search_code == 1:
+        return beam_search_numba(pts, error_matrix, threshold, failure_penalty, budget)
+
+    order, counts = detection_order_numba(pts)
+
+    if search_code == 3:
+        candidates = order.reshape((1, k))
+    elif search_code == 2:
+        agreement = camera_agreement_numba(pts, error_matrix, counts, failure_penalty)
+        proxy = np.zeros(perms.shape[0])
+        max_count = counts.max()
+        for pidx in range(perms.shape[0]):
+            proxy[pidx] = failure_penalty * (max_count - counts[perms[pidx, 0]])
+            for cidx in range(1, k):
+                best = np.inf
+                for didx in range(cidx):
+                    best = min(best, agreement[perms[pidx, didx], perms[pidx, cidx]])
+                proxy[pidx] += best
+        candidates = perms[np.argsort(proxy, kind="mergesort")[:budget]]
+    else:
+        candidates = perms
+
+    best_assignments = evaluate_ordering_numba(pts, candidates[0], error_matrix, threshold)
+    best_cost = calculate_matching_cost(pts, best_assignments, error_matrix, failure_penalty)
+
+    for pidx in range(1, candidates.shape[0]):
+        assignments = evaluate_ordering_numba(pts, candidates[pidx], error_matrix, threshold)
+        cost = calculate_matching_cost(pts, assignments, error_matrix, failure_penalty)
+        if cost < best_cost:
+            best_cost = cost
+            best_assignments = assignments
+
+    return best_assignments
+
+
+@kernel("int64(float64[:, :, ::1], int64[:])")
+def count_views(pts, matching):
+    """Number of cameras that contribute an actual (non-missing) point to a matching column."""
+
+    n_views = 0
+    for kidx in range(matching.size):
+        if matching[kidx] >= 0 and not np.isnan(pts[kidx, matching[kidx], 0]):
+            n_views += 1
+    return n_views
+
+
+def count_views_all(pts, matching):
+    """count_views for every column of a (k x n) matching."""
+    return np.array([count_views(pts, matching[:, nidx]) for nidx in range(matching.shape[1])], dtype=np.int64)
+
+
+@kernel("UniTuple(float64, 4)(float64[:, :, ::1], float64[:, :, ::1], int64[:])")
+def triangulate_matching(ms, pts, matching):
+    """Linear (SVD-based) triangulation of one matched point from all cameras that see it, as in pymvg's find3d.
+    Missing points are skipped. Returns the 3D point and the mean reprojection error."""
+
+    n_views = count_views(pts, matching)
+
+    mat_a = np.zeros((2 * n_views, 4))
+    ridx = 0
+    for kidx in range(matching.size):
+        if matching[kidx] >= 0 and not np.isnan(pts[kidx, matching[kidx], 0]):
+            x, y = pts[kidx, matching[kidx], 0], pts[kidx, matching[kidx], 1]
+            for col in range(4):
+                mat_a[ridx, col] = x * ms[kidx, 2, col] - ms[kidx, 0, col]
+                mat_a[ridx + 1, col] = y * ms[kidx, 2, col] - ms[kidx, 1, col]
+            ridx += 2
+
+    u, w, vt = np.linalg.svd(mat_a)
+    X = vt[3, 0] / vt[3, 3]
+    Y = vt[3, 1] / vt[3, 3]
+    Z = vt[3, 2] / vt[3, 3]
+
+    error = 0.0
+    for kidx in range(matching.size):
+        if matching[kidx] >= 0 and not np.isnan(pts[kidx, matching[kidx], 0]):
+            error += reprojection_distance(ms[kidx], X, Y, Z, pts[kidx, matching[kidx], 0],
+                                           pts[kidx, matching[kidx], 1])
+
+    return X, Y, Z, error / n_views
+
+
+@kernel("Tuple((float64[:, :, ::1], float64[:, ::1], int64[::1]))"
+        "(float64[:, :, ::1], float64[:, :, :, ::1], int64[:, ::1], int64[:, ::1], int64, int64, float64, int64, int64)",
+        parallel=True)
+def reconstruct_batch(ms, pts, counts, perms, search_code, budget, threshold, failure_penalty, minimum_tracks):
+    """Matches and triangulates all frames of a padded (frames x k x max_n x 2) point array in parallel.
+
+    Returns per-frame output: points (frames x max_n x 3), reconstruction errors (frames x max_n) and the number of
+    valid points per frame."""
+
+    n_frames, k, max_n = pts.shape[0], pts.shape[1], pts.shape[2]
+
+    out_points = np.empty((n_frames, max_n, 3))
+    out_errors = np.empty((n_frames, max_n))
+    out_n = np.zeros(n_frames, dtype=np.int64)
+
+    for fidx in prange(n_frames):
+
+        n = 0
+        for kidx in range(k):
+            n = max(n, counts[fidx, kidx])
+        if n == 0:
+            continue
+
+        frame_pts = np.ascontiguousarray(pts[fidx, :, :n, :])
+
+        # Error matrix:
+        error_matrix = np.empty((k, k, n, n))
+        for kidx in range(k):
+            error_matrix[kidx, kidx, :, :] = np.nan
+        for kidx1 in range(k - 1):
+            for kidx2 in range(kidx1 + 1, k):
+                fill_error_pair(ms, frame_pts, kidx1, kidx2, error_matrix)
+
+        # Match:
+        matching = search_matching_numba(frame_pts, error_matrix, threshold, failure_penalty, perms, search_code,
+                                         budget)
+
+        # Filter & triangulate:
+        for nidx in range(n):
+            if count_views(frame_pts, matching[:, nidx]) < minimum_tracks:
+                continue
+
+            X, Y, Z, error = triangulate_matching(ms, frame_pts, matching[:, nidx])
+            out_points[fidx, out_n[fidx], 0] = X
+            out_points[fidx, out_n[fidx], 1] = Y
+            out_points[fidx, out_n[fidx], 2] = Z
+            out_errors[fidx, out_n[fidx]] = error
+            out_n[fidx] += 1
+
+    return out_points, out_errors, out_n
 
 
 ### WRAPPER CLASS
 
 class FastSeqH(object):
 
-    def __init__(self, camera_system, minimum_tracks=3, failure_penalty=100000, threshold=None):
+    def __init__(self, camera_system, minimum_tracks=3, failure_penalty=100000, threshold=None, solver="scipy",
+                 search="exhaustive", search_budget=None, undistortion_cache=None):
         self.camera_system = camera_system
         self.camera_names = self.camera_system.get_names()
         self.ms = np.array(
@@ -267,6 +819,13 @@ class FastSeqH(object):
         self.minimum_tracks = minimum_tracks
         self.failure_penalty = failure_penalty
         self.threshold = threshold
+        self.solver = solver
+        self.search = search
+        self.search_budget = search_budget
+
+        self._error_buffer = ErrorMatrixBuffer()
+        self._undistortion = UndistortionMaps(self.camera_system, cache_dir=undistortion_cache)
+        self._search_arguments = compiled_search_arguments(len(self.camera_names), self.search, self.search_budget)
 
     def _transform_points(self, pt_dic, undistort):
 
@@ -280,60 +839,146 @@ class FastSeqH(object):
                 continue
 
             if undistort:
-                current_camera = self.camera_system.get_camera(name)
-                pts_ = current_camera.undistort(pts_)
+                pts_ = self._undistortion.undistort(name, pts_)
 
             n = pts_.shape[0]
             pts[cidx, :n, :] = pts_
 
         return pts
 
-    def _triangulate_point(self, pts, matching, diagnostics=False):
+    def _undistort_batch(self, pts):
 
-        k_take = np.where(matching >= 0)[0].astype(np.int)
-        pt_collection = [(self.camera_names[kidx], np.atleast_2d(pts[kidx, matching[kidx], :])) for kidx in k_take]
-        pt3d = self.camera_system.find3d(pt_collection, undistort=False)
+        # One lookup per camera for all frames (padding is NaN and stays NaN):
+        for cidx, name in enumerate(self.camera_names):
+            shape = pts[:, cidx].shape
+            pts[:, cidx] = self._undistortion.undistort(name, pts[:, cidx].reshape((-1, 2))).reshape(shape)
 
-        if diagnostics:
-            error = self._reconstruction_error(pt3d, pt_collection)
-        else:
-            error = np.nan
+    def search_gap(self, pt_dic, undistort=True):
+        """Cost gap of the configured search mode against the exhaustive search for one frame."""
 
-        return pt3d, error
+        pts = self._transform_points(pt_dic, undistort)
+        return search_gap(self.ms, pts, threshold=self.threshold, failure_penalty=self.failure_penalty,
+                          solver=self.solver, search=self.search, budget=self.search_budget,
+                          buffer=self._error_buffer)
 
-    def _reconstruction_error(self, pt3d, points):
+    def _reconstruct_points(self, pts):
 
-        # Project out to cameras:
-        errors = []
-        for name, initial_point in points:
-            pt2d = self.camera_system.find2d(name, pt3d, distorted=False)
-            errors.append(np.linalg.norm(pt2d - initial_point))
-        errors = np.array(errors)
+        # Reconstruct:
+        matching = match(self.ms, pts, threshold=self.threshold, failure_penalty=self.failure_penalty,
+                         solver=self.solver, search=self.search, budget=self.search_budget,
+                         buffer=self._error_buffer)
 
-        # Calculate average error:
-        error = errors.mean()
+        # Filter (same criterion as reconstruct_batch):
+        filter_mask = count_views_all(pts, matching) >= self.minimum_tracks
+        matching_filtered = matching[:, filter_mask]
 
-        return error
+        # Triangulate (reprojection errors come for free, so they are returned regardless of diagnostics):
+        return triangulate_many(self.ms, pts, matching_filtered)
 
     def reconstruct(self, pt_dic, diagnostics=False, undistort=True):
 
-        # Prepare data:
-        pts = self._transform_points(pt_dic, undistort)
+        return self._reconstruct_points(self._transform_points(pt_dic, undistort))
 
-        # Reconstruct:
-        matching = match(self.ms, pts, threshold=self.threshold, failure_penalty=self.failure_penalty)
+    def warm_up(self):
+        """Compiles all kernels (see kernels.py) and reconstructs a dummy frame (one point in the image center of every
+        camera), so that the first real batch does not pay for the JIT. Returns the compilation time in seconds."""
 
-        # Filter:
-        filter_mask = count_above(matching) >= self.minimum_tracks
-        matching_filtered = matching[:, filter_mask]
+        compile_time = compile_kernels()
+
+        cameras = [self.camera_system.get_camera(name) for name in self.camera_names]
+        pts = np.array([[[camera.width / 2.0, camera.height / 2.0]] for camera in cameras])[np.newaxis]
+
+        self.reconstruct_many(pts, np.ones((1, len(cameras)), dtype=np.int64))
+
+        return compile_time
+
+    def reconstruct_many(self, pts, counts, undistort=True):
+        """Reconstructs a batch of frames. With the compiled solver (solver="numba"), the whole batch is processed in
+        a single compiled call; other solvers reconstruct frame by frame, as reconstruct does.
+
+        pts is a (frames x cameras x max_n x 2) array of 2D points, cameras ordered as in camera_system.get_names();
+        counts (frames x cameras) holds the number of valid points per frame and camera. Returns a flat (N x 3)
+        table of 3D points, their reconstruction errors and frame offsets, so that the points of frame i are
+        points[offsets[i]:offsets[i + 1]]."""
+
+        pts = np.array(pts, dtype=np.float64)
+        counts = np.ascontiguousarray(counts, dtype=np.int64)
+
+        # Blank out padding:
+        pts[np.arange(pts.shape[2])[np.newaxis, np.newaxis, :] >= counts[:, :, np.newaxis]] = np.nan
+
+        if undistort:
+            self._undistort_batch(pts)
+
+        if self.solver != "numba":
+            return self._reconstruct_frames(pts, counts)
+
+        threshold = np.inf if self.threshold is None else self.threshold
+        perms, search_code, budget = self._search_arguments
+
+        out_points, out_errors, out_n = reconstruct_batch(self.ms, pts, counts, perms, search_code, budget,
+                                                          float(threshold), int(self.failure_penalty),
+                                                          int(self.minimum_tracks))
+
+        valid = np.arange(pts.shape[2])[np.newaxis, :] < out_n[:, np.newaxis]
+        offsets = np.concatenate(([0], np.cumsum(out_n)))
+
+        return out_points[valid], out_errors[valid], offsets
+
+    def _reconstruct_frames(self, pts, counts):
+
+        points, errors = [np.zeros((0, 3))], [np.zeros(0)]
+        out_n = np.zeros(pts.shape[0], dtype=np.int64)
+
+        for fidx in range(pts.shape[0]):
+            n = counts[fidx].max()
+            if n == 0:
+                continue
+
+            frame_points, frame_errors = self._reconstruct_points(np.ascontiguousarray(pts[fidx, :, :n, :]))
+            points.append(frame_points)
+            errors.append(frame_errors)
+            out_n[fidx] = frame_points.shape[0]
+
+        return np.concatenate(points), np.concatenate(errors), np.concatenate(([0], np.cumsum(out_n)))
+
+
+### DATAFRAME HELPERS
+
+def to_padded(data, camera_names, first, last):
+    """Converts the 2D detections of frames first..last into a padded (frames x cameras x max_n x 2) array and the
+    (frames x cameras) point counts expected by FastSeqH.reconstruct_many."""
+
+    n_frames = last - first + 1
+
+    camera_idx = pd.Index(camera_names).get_indexer(data.index.get_level_values("camera_id"))
+    frame_idx = np.asarray(data.index.get_level_values("frame_number")) - first
+    slot_idx = data.groupby(level=["camera_id", "frame_number"]).cumcount().values
+
+    max_n = slot_idx.max() + 1 if slot_idx.size > 0 else 0
+
+    pts = np.ones((n_frames, len(camera_names), max_n, 2)) * np.nan
+    pts[frame_idx, camera_idx, slot_idx, 0] = data.x.values
+    pts[frame_idx, camera_idx, slot_idx, 1] = data.y.values
+
+    counts = np.zeros((n_frames, len(camera_names)), dtype=np.int64)
+    np.add.at(counts, (frame_idx, camera_idx), 1)
+
+    return pts, counts
+
+
+def batch_reconstruct(data, rec, first, last):
+    """Reconstructs the 2D detections (indexed by camera_id and frame_number) of frames first..last with
+    rec.reconstruct_many. Returns a data frame of 3D points indexed by frame_number and point_id."""
+
+    pts, counts = to_padded(data, rec.camera_names, first, last)
+    points, errors, offsets = rec.reconstruct_many(pts, counts, undistort=True)
 
-        # Triangulate:
-        pts_triangulated = []
-        pts_error = []
+    n_per_frame = np.diff(offsets)
 
-        for nidx in range(matching_filtered.shape[1]):
-            pt_triangulated, pt_error = self._triangulate_point(pts, matching_filtered[:, nidx], diagnostics=diagnostics)
-            pts_triangulated.append(pt_triangulated)
-            pts_error.append(pt_error)
+    df = pd.DataFrame(points, columns=['x', 'y', 'z'])
+    df["frame_number"] = np.repeat(np.arange(first, last + 1), n_per_frame)
+    df["point_id"] = np.arange(points.shape[0]) - np.repeat(offsets[:-1], n_per_frame)
+    df["reconstruction_error"] = errors
 
-        return np.array(pts_triangulated), np.array(pts_error)
+    return df.set_index(["frame_number", "point_id"])
@@ -2,21 +2,165 @@ import csv
 
 import numpy as np
 import pandas as pd
-from filterpy.kalman import KalmanFilter
-from munkres import munkres
 from tqdm import tqdm_notebook, tqdm
 
+from .assignment import sparse_assignment
 
-def no_tqdm(x):
+
+def no_tqdm(x, **kwargs):
     return x
 
 
-def euclidean_distance(pt1, pt2):
-    return np.linalg.norm(pt1 - pt2)
+def group_frames(frames, start, stop):
+    """Sorts points once into a contiguous (N x 3) block and builds CSR-style offsets, so that the points of frame
+    start + i are points[offsets[i]:offsets[i + 1]]."""
+
+    frame_numbers = np.asarray(frames.index.get_level_values("frame_number"))
+    order = np.argsort(frame_numbers, kind="mergesort")
+
+    frame_numbers = frame_numbers[order]
+    points = np.ascontiguousarray(frames[["x", "y", "z"]].values[order], dtype=np.float64)
+
+    offsets = np.searchsorted(frame_numbers, np.arange(start, stop + 1))
+
+    return points, offsets
+
+
+FIELDNAMES = [
+    "frame_number",
+    "target_id",
+    "n_missed_observations",
+    "x",
+    "x_variance",
+    "x_velocity",
+    "y",
+    "y_variance",
+    "y_velocity",
+    "z",
+    "z_variance",
+    "z_velocity",
+]
+
+# Column dtypes for columnar track tables (see storage.columns):
+DTYPES = ["i8", "i8", "i8"] + ["f8"] * 9
+
+# Row format of the CSV output (\r\n line terminator, as csv.writer). Floats are written with 12 significant digits
+# (relative error < 1e-11), which is about twice as fast as their full repr:
+ROW_FORMAT = "%d,%d,%d" + ",%.12g" * 9 + "\r\n"
+
+
+class TargetBank(object):
+    """Stacked representation of all live Kalman filters.
+
+    States of every target are kept in an (N x 6) array so that prediction and update run for all targets in a single
+    vectorized pass. The constant-velocity model uses the state layout [x, vx, y, vy, z, vz]. All three axes share
+    the same (decoupled) model and initial covariance, so their [position, velocity] covariance blocks stay identical:
+    only one such block is stored per target, as the columns [position variance, covariance, velocity variance] of an
+    (N x 3) array, and the filter equations are written out for it."""
+
+    def __init__(self, max_frames_without_observation, max_uncertainty, dt):
+
+        self.dt = dt
+        self.max_frames = max_frames_without_observation
+        self.max_P = max_uncertainty
+
+        # Per axis: process matrix [[1, dt], [0, 1]], observation of the position only.
+        self.R = 2.0**2  # STD = 2cm
+        self.Q_pos, self.Q_vel = 1.0**2, 50.0**2  # Straw parameters: STD_pos = 10mm, STD_vel = 50cm/s
+        self.P0 = np.array([10.0**2, 0.0, 100.0**2])
+
+        # Per-target storage:
+        self.ids = np.zeros(0, dtype=np.int64)
+        self.x = np.zeros((0, 6))
+        self.P = np.zeros((0, 3))
+        self.frames_without_observation = np.zeros(0, dtype=np.int64)
+
+    def __len__(self):
+        return self.ids.size
+
+    def add(self, target_ids, starting_positions):
+        """Appends new targets at rest at the given (M x 3) positions."""
+
+        n = len(target_ids)
+
+        x = np.zeros((n, 6))
+        x[:, 0::2] = starting_positions
+
+        self.ids = np.concatenate((self.ids, np.asarray(target_ids, dtype=np.int64)))
+        self.x = np.concatenate((self.x, x))
+        self.P = np.concatenate((self.P, np.repeat(self.P0[np.newaxis, :], n, axis=0)))
+        self.frames_without_observation = np.concatenate(
+            (self.frames_without_observation, np.zeros(n, dtype=np.int64)))
+
+    def keep(self, mask):
+        """Drops all targets for which mask is False."""
+
+        self.ids = self.ids[mask]
+        self.x = self.x[mask]
+        self.P = self.P[mask]
+        self.frames_without_observation = self.frames_without_observation[mask]
+
+    def get_predictions(self):
+        """Returns predicted (N x 3) positions without changing the filter state."""
+        return self.x[:, 0::2] + self.dt * self.x[:, 1::2]
+
+    def get_covariances(self):
+        """Returns the full (N x 6 x 6) state covariances."""
+
+        blocks = np.empty((len(self), 2, 2))
+        blocks[:, 0, 0], blocks[:, 0, 1], blocks[:, 1, 0], blocks[:, 1, 1] = \
+            self.P[:, 0], self.P[:, 1], self.P[:, 1], self.P[:, 2]
+
+        P = np.zeros((len(self), 6, 6))
+        for dim in range(3):
+            P[:, 2 * dim:2 * dim + 2, 2 * dim:2 * dim + 2] = blocks
+        return P
+
+    def get_innovation_covariances(self):
+        """Returns the (N x 3 x 3) innovation covariances of the predicted observations."""
+        dt = self.dt
+        P_pos = self.P[:, 0] + 2.0 * dt * self.P[:, 1] + dt * dt * self.P[:, 2] + self.Q_pos
+        return (P_pos + self.R)[:, np.newaxis, np.newaxis] * np.eye(3)
+
+    def advance(self, observations, observed):
+        """Predicts all targets and updates those flagged in observed with the rows of observations.
+
+        Returns a boolean mask of targets that are still alive."""
+
+        dt, R = self.dt, self.R
+        a, b, c = self.P[:, 0], self.P[:, 1], self.P[:, 2]
+
+        # Predict (x = F x, P = F P F' + Q):
+        self.x[:, 0::2] += dt * self.x[:, 1::2]
+        a, b, c = a + 2.0 * dt * b + dt * dt * c + self.Q_pos, b + dt * c, c + self.Q_vel
+
+        # Update (Joseph form, as in filterpy). Targets without observation get a zero gain, which leaves them as
+        # predicted, so all targets are updated at once:
+        k0 = np.where(observed, a / (a + R), 0.0)
+        k1 = np.where(observed, b / (a + R), 0.0)
+
+        y = np.zeros((len(self), 3))
+        y[observed] = observations - self.x[observed, 0::2]
+        self.x[:, 0::2] += k0[:, np.newaxis] * y
+        self.x[:, 1::2] += k1[:, np.newaxis] * y
+
+        self.P = np.column_stack(((1.0 - k0) ** 2 * a + R * k0 ** 2,
+                                  (1.0 - k0) * (b - k1 * a) + R * k0 * k1,
+                                  k1 ** 2 * a - 2.0 * k1 * b + c + R * k1 ** 2))
+
+        self.frames_without_observation = np.where(observed, 0, self.frames_without_observation + 1)
+
+        alive = np.logical_not(np.any(self.P > self.max_P, axis=1))
+        alive &= self.frames_without_observation <= self.max_frames
+
+        return alive
 
 
 class Target(object):
-    """Representation of an individual Kalman filter object."""
+    """Representation of an individual Kalman filter object.
+
+    Kept for compatibility: Tracker advances all targets at once in a TargetBank; this wraps a bank of one. filter
+    stands in for the filterpy filter of earlier versions (read-only x and P)."""
 
     def __init__(self, target_id, starting_position, max_frames_without_observation, max_uncertainty, dt):
 
@@ -24,58 +168,37 @@ class Target(object):
 
         self.dt = dt
         self.is_alive = True
-        self.frames_without_observation = 0
         self.max_frames = max_frames_without_observation
         self.max_P = max_uncertainty
 
-        # Initialize Kalman filter:
-        self.filter = KalmanFilter(dim_x=6, dim_z=3)
-
-        self.filter.F = np.array([
-            [1.0, dt, 0.0, 0.0, 0.0, 0.0],
-            [0.0, 1.0, 0.0, 0.0, 0.0, 0.0],
-            [0.0, 0.0, 1.0, dt, 0.0, 0.0],
-            [0.0, 0.0, 0.0, 1.0, 0.0, 0.0],
-            [0.0, 0.0, 0.0, 0.0, 1.0, dt],
-            [0.0, 0.0, 0.0, 0.0, 0.0, 1.0],
-        ])  # Process matrix
+        self._bank = TargetBank(max_frames_without_observation, max_uncertainty, dt)
+        self._bank.add([target_id], np.asarray(starting_position, dtype=np.float64).reshape((1, 3)))
 
-        self.filter.H = np.array([
-            [1.0, 0.0, 0.0, 0.0, 0.0, 0.0],
-            [0.0, 0.0, 1.0, 0.0, 0.0, 0.0],
-            [0.0, 0.0, 0.0, 0.0, 1.0, 0.0],
-        ])  # Observation matrix
+    @property
+    def filter(self):
+        return self
 
-        self.filter.R *= 2.0**2  # STD = 2cm
+    @property
+    def x(self):
+        return self._bank.x[0].copy()
 
-        Q_pos, Q_vel = 1.0**2, 50.0**2  # Straw parameters: STD_pos = 10mm, STD_vel = 50cm/s
-        self.filter.Q = np.diag([Q_pos, Q_vel, Q_pos, Q_vel, Q_pos, Q_vel])
+    @property
+    def P(self):
+        return self._bank.get_covariances()[0]
 
-        P_pos, P_vel = 10.0**2, 100.0**2
-        self.filter.P = np.diag([P_pos, P_vel, P_pos, P_vel, P_pos, P_vel])
-
-        self.filter.x = np.array([
-            starting_position[0], 0.0,
-            starting_position[1], 0.0,
-            starting_position[2], 0.0,
-        ])
+    @property
+    def frames_without_observation(self):
+        return int(self._bank.frames_without_observation[0])
 
     def get_prediction(self):
-        return self.filter.get_prediction()[0][[0, 2, 4]]
+        return self._bank.get_predictions()[0]
 
     def advance(self, observation=None):
 
-        self.filter.predict()
-        self.frames_without_observation += 1
-        
-        if observation is not None:
-            self.filter.update(z=observation)
-            self.frames_without_observation = 0
-        
-        if np.any(self.filter.P > self.max_P):
-            self.is_alive = False
+        observed = np.array([observation is not None])
+        observations = np.asarray(observation, dtype=np.float64).reshape((1, 3)) if observed[0] else np.zeros((0, 3))
 
-        if self.frames_without_observation > self.max_frames:
+        if not self._bank.advance(observations, observed)[0]:
             self.is_alive = False
 
         return self.is_alive
@@ -85,36 +208,43 @@ class Tracker(object):
     """Basic Kalman Filter for target tracking."""
 
     def __init__(self, storage_file=None, maximum_distance=np.inf, maximum_missed_frames=np.inf,
-                 maximum_uncertainty=np.inf, dt=0.01):
-        
-        self._targets = []
+                 maximum_uncertainty=np.inf, dt=0.01, gating_threshold=None, solver="scipy",
+                 strict_assignment=False):
+        """gating_threshold is a bound on the squared Mahalanobis distance between a target's predicted position and
+        an observation, using the target's innovation covariance (e.g. 11.34 for 99% at 3 degrees of freedom).
+        Observations outside a target's gate are never associated with it. None disables gating.
+
+        solver selects the assignment solver (see tracking.assignment).
+
+        By default, observations are assigned to targets on all pairs; an observation assigned beyond
+        maximum_distance starts a new target instead, and observations left without a target are dropped. With
+        strict_assignment, pairs beyond maximum_distance are excluded before the assignment and every observation left
+        without a target starts a new one (more targets and rows than the default).
+
+        storage_file is a file object (written as CSV) or a table writer with an append method taking a list of
+        columns (e.g. storage.columns.ColumnWriter with FIELDNAMES and DTYPES)."""
 
         self.standard_dt = dt
         self.max_distance = maximum_distance
+        self.gating_threshold = gating_threshold
+        self.solver = solver
+        self.strict_assignment = strict_assignment
         self.max_missed = maximum_missed_frames
         self.max_uncertainty = maximum_uncertainty
 
+        self._targets = TargetBank(max_frames_without_observation=self.max_missed,
+                                   max_uncertainty=self.max_uncertainty, dt=self.standard_dt)
+
         self._next_target_id = 0
 
         # Set up storage:
         if storage_file:
             self._file = storage_file
-            fieldnames = [
-                "frame_number",
-                "target_id",
-                "n_missed_observations",
-                "x",
-                "x_variance",
-                "x_velocity",
-                "y",
-                "y_variance",
-                "y_velocity",
-                "z",
-                "z_variance",
-                "z_velocity",
-            ]
-            self._storage = csv.DictWriter(self._file, fieldnames=fieldnames, extrasaction="ignore")
-            self._storage.writeheader()
+            if hasattr(storage_file, "append"):
+                self._storage = None
+            else:
+                self._storage = csv.writer(self._file)
+                self._storage.writerow(FIELDNAMES)
             self._document = True
         else:
             self._document = False
@@ -122,92 +252,111 @@ class Tracker(object):
     def __del__(self):
         self._file.close()
 
-    def _add_target(self, starting_position):
+    def _add_targets(self, starting_positions):
 
-        self._next_target_id += 1
-        new_target = Target(target_id=self._next_target_id, starting_position=starting_position,
-                            max_frames_without_observation=self.max_missed,
-                            max_uncertainty=self.max_uncertainty, dt=self.standard_dt)
-        self._targets.append(new_target)
+        n = starting_positions.shape[0]
+        target_ids = np.arange(self._next_target_id + 1, self._next_target_id + n + 1)
+        self._next_target_id += n
+
+        self._targets.add(target_ids, starting_positions)
 
     def _calculate_matching_matrix(self, observations):
-        incoming_n = observations.shape[0]
-        target_n = len(self._targets)
+        """Euclidean distances between predictions and observations. Pairs outside a target's gate are set to inf."""
 
-        matching_matrix = np.zeros((target_n, incoming_n))
+        predictions = self._targets.get_predictions()
+        residuals = observations[np.newaxis, :, :] - predictions[:, np.newaxis, :]
 
-        predictions = [target.get_prediction() for target in self._targets]
+        matching_matrix = np.sqrt(np.sum(residuals ** 2, axis=2))
 
-        for target_idx in range(target_n):
-            for observation_idx in range(incoming_n):
-                observed_point = observations[observation_idx, :]
-                error = euclidean_distance(predictions[target_idx], observed_point)
-                matching_matrix[target_idx, observation_idx] = error
+        if self.gating_threshold is not None:
+            S_inv = np.linalg.inv(self._targets.get_innovation_covariances())
+            mahalanobis = np.einsum("nmi,nij,nmj->nm", residuals, S_inv, residuals)
+            matching_matrix[mahalanobis > self.gating_threshold] = np.inf
 
         return matching_matrix
-        
+
+    def _document_frame(self, frame_number):
+
+        bank = self._targets
+        n = len(bank)
+
+        if self._storage is None:
+            columns = [
+                [frame_number] * n,
+                bank.ids.tolist(),
+                bank.frames_without_observation.tolist(),
+            ]
+            for dim in range(3):
+                columns.append(bank.x[:, 2 * dim].tolist())
+                columns.append(bank.P[:, 0].tolist())
+                columns.append(bank.x[:, 2 * dim + 1].tolist())
+            self._file.append(columns)
+            return
+
+        if not n:
+            return
+
+        # One preformatted block per frame; csv.writer costs more than the tracking itself:
+        block = np.empty((n, len(FIELDNAMES)))
+        block[:, 0] = frame_number
+        block[:, 1] = bank.ids
+        block[:, 2] = bank.frames_without_observation
+        block[:, 3::3] = bank.x[:, 0::2]
+        block[:, 4::3] = bank.P[:, 0:1]
+        block[:, 5::3] = bank.x[:, 1::2]
+
+        self._file.write((ROW_FORMAT * n) % tuple(block.ravel().tolist()))
+
     def process_frame(self, frame_number, observations):
 
         incoming_n = observations.shape[0]
+        target_n = len(self._targets)
 
-        if len(self._targets) == 0:
+        if target_n == 0:
 
             # No targets, so initialize everything:
-            for idx in range(incoming_n):
-                self._add_target(observations[idx, :])
+            self._add_targets(observations)
             return
-        
-        elif incoming_n == 0:
-            assignment = np.full((len(self._targets), 1), False, dtype=np.bool)
-        
-        else:
-            # We have observations & targets, so matching is required:
-            matching_matrix = self._calculate_matching_matrix(observations)
-            assignment = munkres(matching_matrix)
-            
-        # Advance all targets:
-        new_target_starts = []
-
-        for tidx, target in enumerate(self._targets):
 
-            my_match = assignment[tidx, :]
-            if np.any(my_match):
-                data_point = observations[my_match, :].squeeze()
-                associated_cost = matching_matrix[tidx, my_match]
-                if associated_cost > self.max_distance:
-                    new_target_starts.append(data_point)
-                    data_point = None
-            else:
-                data_point = None
+        # Match observations to targets, considering only pairs within the gate (and the maximum distance, if strict):
+        if incoming_n > 0:
+            matching_matrix = self._calculate_matching_matrix(observations)
+            max_cost = self.max_distance if self.strict_assignment else np.inf
+            rows, cols = sparse_assignment(matching_matrix, max_cost=max_cost, solver=self.solver)
+        else:
+            matching_matrix = np.zeros((target_n, 0))
+            rows, cols = np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+        if self.strict_assignment:
+            # Observations that were not assigned to any target start new targets:
+            assigned = np.zeros(incoming_n, dtype=bool)
+            assigned[cols] = True
+            new_target_starts = observations[np.logical_not(assigned), :]
+        else:
+            # Observations assigned beyond the maximum distance start new targets (in target order) instead:
+            order = np.argsort(rows, kind="mergesort")
+            rows, cols = rows[order], cols[order]
+            distant = matching_matrix[rows, cols] > self.max_distance
+            new_target_starts = observations[cols[distant], :]
+            rows, cols = rows[np.logical_not(distant)], cols[np.logical_not(distant)]
+
+        observed = np.zeros(target_n, dtype=bool)
+        observed[rows] = True
+        matched = np.zeros(target_n, dtype=np.int64)
+        matched[rows] = cols
 
-            target.advance(data_point)
+        # Advance all targets:
+        alive = self._targets.advance(observations[matched[observed], :], observed)
 
         # Clean out targets:
-        self._targets = [target for target in self._targets if target.is_alive]
+        self._targets.keep(alive)
 
         # Create new targets:
-        for starting_point in new_target_starts:
-            self._add_target(starting_point)
-        
+        self._add_targets(new_target_starts)
+
         # Document what's happening:
         if self._document:
-            for tidx, target in enumerate(self._targets):
-                values = {}
-
-                values["frame_number"] = frame_number
-                values["target_id"] = target.id
-                values["x"] = target.filter.x[0]
-                values["y"] = target.filter.x[2]
-                values["z"] = target.filter.x[4]
-                values["x_velocity"] = target.filter.x[1]
-                values["y_velocity"] = target.filter.x[3]
-                values["z_velocity"] = target.filter.x[5]
-                values["x_variance"] = target.filter.P[0, 0]
-                values["y_variance"] = target.filter.P[2, 2]
-                values["z_variance"] = target.filter.P[4, 4]
-                values["n_missed_observations"] = target.frames_without_observation
-
-                self._storage.writerow(values)
+            self._document_frame(frame_number)
 
     def process_batch(self, frames, start=None, stop=None, pg_mode="notebook"):
 
@@ -216,7 +365,7 @@ class Tracker(object):
         if start is None:
             start = frames.index.levels[0].min()
 
-        frames = frames[["x", "y", "z"]]
+        points, offsets = group_frames(frames, start, stop)
 
         if pg_mode == "terminal":
             my_tqdm = tqdm
@@ -226,9 +375,5 @@ class Tracker(object):
             my_tqdm = no_tqdm
 
         for fidx in my_tqdm(range(start, stop), smoothing=0.9):
-            if fidx in frames.index:
-                # THIS IS SLOW: Make faster!
-                frame = frames.xs(fidx, level="frame_number").values
-            else:
-                frame = np.zeros((0, 3))
-            self.process_frame(fidx, frame)
+            oidx = fidx - start
+            self.process_frame(fidx, points[offsets[oidx]:offsets[oidx + 1]])
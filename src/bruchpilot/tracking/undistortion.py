@@ -0,0 +1,115 @@
+import hashlib
+import os
+from os import path
+
+import numpy as np
+
+from .kernels import kernel
+
+# Undistortion through per-camera lookup tables.
+#
+# The undistorted coordinates of every integer pixel position of a sensor are computed once with pymvg and stored in
+# a (height x width x 2) table. Sub-pixel points are undistorted by bilinear interpolation between the four
+# surrounding pixels; points outside of the sensor fall back to pymvg. The tables only depend on the calibration, so
+# they are cached on disk under its hash and reused across runs.
+
+
+def calibration_hash(camera_system):
+    """SHA-1 of the serialized calibration (i.e. the contents of the pymvg calibration file)."""
+    return hashlib.sha1(camera_system.get_pymvg_str().encode("utf-8")).hexdigest()
+
+
+def build_lut(camera):
+    """Undistorted coordinates of all integer pixel positions of a camera."""
+
+    v, u = np.mgrid[0:camera.height, 0:camera.width]
+    grid = np.column_stack((u.ravel(), v.ravel())).astype(np.float64)
+
+    return np.ascontiguousarray(camera.undistort(grid).reshape((camera.height, camera.width, 2)))
+
+
+def load_lut(camera, key=None, cache_dir=None):
+    """Loads the lookup table of a camera from the cache, building (and storing) it if necessary."""
+
+    if cache_dir is None or key is None:
+        return build_lut(camera)
+
+    # Camera names are not necessarily valid file names:
+    filename = path.join(cache_dir, "{0}.npy".format(hashlib.sha1((key + camera.name).encode("utf-8")).hexdigest()))
+
+    if path.exists(filename):
+        return np.load(filename)
+
+    lut = build_lut(camera)
+
+    if not path.exists(cache_dir):
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            # Created concurrently by another process:
+            pass
+
+    # Write to a temporary file first, so that concurrent workers never read a partial table:
+    temporary = "{0}.{1}.tmp".format(filename, os.getpid())
+    with open(temporary, "wb") as f:
+        np.save(f, lut)
+    os.rename(temporary, filename)
+
+    return lut
+
+
+@kernel("void(float64[:, :, ::1], float64[:, ::1], float64[:, ::1])")
+def interpolate_lut(lut, pts, out):
+    """Bilinear lookup of an (n x 2) array of points. Points outside of the table (and NaNs) are set to NaN."""
+
+    h, w = lut.shape[0], lut.shape[1]
+
+    for i in range(pts.shape[0]):
+        u, v = pts[i, 0], pts[i, 1]
+
+        # Negated so that NaNs end up here as well:
+        if not (u >= 0 and v >= 0 and u <= w - 1 and v <= h - 1):
+            out[i, 0] = np.nan
+            out[i, 1] = np.nan
+            continue
+
+        u0 = min(int(u), w - 2)
+        v0 = min(int(v), h - 2)
+        a = u - u0
+        b = v - v0
+
+        for d in range(2):
+            out[i, d] = ((1 - a) * (1 - b) * lut[v0, u0, d] + a * (1 - b) * lut[v0, u0 + 1, d] +
+                         (1 - a) * b * lut[v0 + 1, u0, d] + a * b * lut[v0 + 1, u0 + 1, d])
+
+
+class UndistortionMaps(object):
+    """Lookup tables for all cameras of a camera system, loaded on first use."""
+
+    def __init__(self, camera_system, cache_dir=None):
+        self.camera_system = camera_system
+        self.cache_dir = cache_dir
+        self.key = calibration_hash(camera_system)
+
+        self._luts = {}
+
+    def get(self, name):
+
+        if name not in self._luts:
+            self._luts[name] = load_lut(self.camera_system.get_camera(name), key=self.key, cache_dir=self.cache_dir)
+
+        return self._luts[name]
+
+    def undistort(self, name, pts):
+        """Undistorts an (n x 2) array of points of one camera; NaN rows are passed through."""
+
+        pts = np.ascontiguousarray(pts, dtype=np.float64)
+        out = np.empty_like(pts)
+        interpolate_lut(self.get(name), pts, out)
+
+        # Fall back to pymvg for points outside of the sensor:
+        outside = np.isnan(out[:, 0]) & np.logical_not(np.isnan(pts[:, 0]))
+        if np.any(outside):
+            out[outside] = self.camera_system.get_camera(name).undistort(pts[outside])
+
+        return out
@@ -0,0 +1,197 @@
+import sys
+from os import path
+import os
+import argparse
+from collections import deque
+from multiprocessing import Pool
+
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+from pymvg.multi_camera_system import MultiCameraSystem
+
+sys.path.append("../../")
+from bruchpilot.tracking.reconstruct_fast import FastSeqH, to_padded, check_search
+from bruchpilot.tracking.kernels import prebuild_kernels, single_threaded
+from bruchpilot.tracking.tracker import Tracker, FIELDNAMES, DTYPES
+from bruchpilot.storage.columns import FrameStream, ColumnWriter, open_table_writer, table_path
+
+# Streaming post-processing: 2D detections are read in frame-ordered windows, reconstructed in a process pool and fed
+# into the tracker in order, without intermediate files. Only a bounded number of windows is in flight at any time,
+# so memory use does not grow with the length of a session.
+
+POINT_COLUMNS = ["frame_number", "point_id", "x", "y", "z", "reconstruction_error"]
+POINT_FORMAT = ["%d", "%d", "%.6f", "%.6f", "%.6f", "%.6f"]
+POINT_DTYPES = ["i8", "i8", "f8", "f8", "f8", "f8"]
+
+# Reconstruction of the current worker (set up once per process):
+rec = None
+
+
+def init_child(cam_path, args):
+    global rec
+
+    single_threaded()
+
+    rec = FastSeqH(MultiCameraSystem.from_pymvg_file(cam_path), minimum_tracks=args.minimum_tracks,
+                   solver=args.solver, search=args.search, search_budget=args.search_budget,
+                   undistortion_cache=args.undistortion_cache)
+    rec.warm_up()
+
+
+def reconstruct_chunk(task):
+    pts, counts = task
+    return rec.reconstruct_many(pts, counts, undistort=True)
+
+
+def read_windows(streams, camera_names, first, last, window_size, area_filter):
+    """Yields the padded 2D points (see to_padded) of consecutive windows of frames first..last (last may be None,
+    i.e. until all streams are exhausted)."""
+
+    start = first
+
+    while not all(stream.done() for stream in streams) and (last is None or start <= last):
+        stop = start + window_size - 1 if last is None else min(start + window_size - 1, last)
+
+        gather = []
+        for name, stream in zip(camera_names, streams):
+            data = stream.read_until(stop)
+            gather.append(data[data.area > area_filter].assign(camera_id=name))
+
+        data = pd.concat(gather).set_index(["camera_id", "frame_number"]).sort_index()
+        pts, counts = to_padded(data, camera_names, start, stop)
+
+        yield start, stop, pts, counts
+
+        start = stop + 1
+
+
+def main(args):
+
+    if not path.exists(args.data):
+        raise ValueError("Data path does not exist!")
+
+    # Load calibration:
+    cam_path = path.join(args.data, "camera_system_aligned.json")
+    camera_system = MultiCameraSystem.from_pymvg_file(cam_path)
+    camera_names = camera_system.get_names()
+
+    # Open 2D detections (CSV or columnar tables):
+    streams = [FrameStream(path.join(args.data, args.tracking, "Cam{0}.csv".format(name)),
+                           columns=["frame_number", "x", "y", "area"], frame_range=args.frame_range)
+               for name in camera_names]
+
+    if args.frame_range is None:
+        firsts = [frame for frame in (stream.next_frame() for stream in streams) if frame is not None]
+        if not firsts:
+            raise ValueError("No detections found!")
+        first, last = min(firsts), None
+    else:
+        first, last = args.frame_range
+
+    # Outputs:
+    output_directory = path.join(args.data, "reconstruction")
+    if not path.exists(output_directory):
+        os.mkdir(output_directory)
+
+    tracked_path = path.join(output_directory, "tracked.csv")
+    if args.output_format == "columns":
+        storage_file = ColumnWriter(table_path(tracked_path), FIELDNAMES, dtypes=DTYPES, sorted_by="frame_number")
+    else:
+        storage_file = open(tracked_path, "wb")
+
+    points_writer = None
+    if args.points:
+        points_writer = open_table_writer(path.join(output_directory, "points.csv"), POINT_COLUMNS, POINT_DTYPES,
+                                          POINT_FORMAT, table_format=args.output_format, sorted_by="frame_number")
+
+    tracker = Tracker(storage_file=storage_file, maximum_distance=args.maximum_distance,
+                      maximum_missed_frames=args.maximum_missed, dt=args.delta,
+                      gating_threshold=args.gating_threshold, solver=args.track_solver,
+                      strict_assignment=args.strict_assignment)
+
+    progress = tqdm(unit="frames", total=None if last is None else last - first + 1)
+
+    def consume(start, stop, result):
+        points, errors, offsets = result
+
+        if points_writer is not None:
+            n_per_frame = np.diff(offsets)
+            points_writer.append([np.repeat(np.arange(start, stop + 1), n_per_frame),
+                                  np.arange(points.shape[0]) - np.repeat(offsets[:-1], n_per_frame),
+                                  points[:, 0], points[:, 1], points[:, 2], errors])
+
+        keep = errors < args.maximum_reconstruction_error
+        for fidx in range(start, stop + 1):
+            i = fidx - start
+            frame_points = points[offsets[i]:offsets[i + 1]]
+            tracker.process_frame(fidx, frame_points[keep[offsets[i]:offsets[i + 1]]])
+
+        progress.update(stop - start + 1)
+
+    # Compile the kernels once (or load them from numba's cache), so that workers only load them:
+    print "Compiled reconstruction kernels in {0:.2f} s".format(prebuild_kernels())
+
+    # Windows are reconstructed in parallel but consumed in order:
+    pool = Pool(processes=args.cores, initializer=init_child, initargs=(cam_path, args))
+    pending = deque()
+
+    for start, stop, pts, counts in read_windows(streams, camera_names, first, last, args.window_size,
+                                                 args.area_filter):
+        pending.append((start, stop, pool.apply_async(reconstruct_chunk, ((pts, counts),))))
+
+        while len(pending) >= args.max_pending:
+            start, stop, result = pending.popleft()
+            consume(start, stop, result.get())
+
+    while pending:
+        start, stop, result = pending.popleft()
+        consume(start, stop, result.get())
+
+    pool.close()
+    pool.join()
+    progress.close()
+
+    storage_file.close()
+    if points_writer is not None:
+        points_writer.close()
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser("Streaming reconstruction and tracking (2D detections to tracks in one pass)")
+
+    parser.add_argument("--data", action="store", type=str)
+    parser.add_argument("--tracking", action="store", type=str, default="tracking")
+    parser.add_argument("--frame-range", action="store", type=int, nargs=2)
+    parser.add_argument("--points", action="store_true", help="Also store the reconstructed points")
+    parser.add_argument("--output-format", action="store", type=str, default="csv", choices=["csv", "columns"])
+    parser.add_argument("--cores", action="store", type=int, default=4)
+    parser.add_argument("--window-size", action="store", type=int, default=2000)
+    parser.add_argument("--max-pending", action="store", type=int, default=8)
+
+    # Reconstruction:
+    parser.add_argument("--area-filter", action="store", type=float, default=0.0)
+    parser.add_argument("--minimum-tracks", action="store", type=int, default=3)
+    parser.add_argument("--solver", action="store", type=str, default="numba",
+                        help="Assignment solver; solvers other than numba reconstruct frame by frame (slow)")
+    parser.add_argument("--search", action="store", type=str, default="exhaustive",
+                        choices=["exhaustive", "beam", "ranked", "count"])
+    parser.add_argument("--search-budget", action="store", type=int, default=None)
+    parser.add_argument("--undistortion-cache", action="store", type=str,
+                        default=path.join(path.expanduser("~"), ".bruchpilot", "undistortion"))
+
+    # Tracking:
+    parser.add_argument("--maximum-reconstruction-error", action="store", type=float, default=5.0)
+    parser.add_argument("--maximum-distance", action="store", type=float, default=1.0)
+    parser.add_argument("--maximum-missed", action="store", type=int, default=20)
+    parser.add_argument("--delta", action="store", type=float, default=0.01)
+    parser.add_argument("--gating-threshold", action="store", type=float, default=None)
+    parser.add_argument("--track-solver", action="store", type=str, default="scipy")
+    parser.add_argument("--strict-assignment", action="store_true",
+                        help="Exclude pairs beyond the maximum distance before the assignment and start new targets "
+                             "from all unassigned points")
+
+    args = parser.parse_args()
+    check_search(args.search, args.search_budget)
+    main(args)
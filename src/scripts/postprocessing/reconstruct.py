@@ -2,7 +2,12 @@ import sys
 from os import path
 import os
 import argparse
-from multiprocessing import Pool, Lock
+import hashlib
+import json
+import shutil
+import socket
+import tempfile
+from multiprocessing import Pool
 
 import numpy as np
 import pandas as pd
@@ -11,16 +16,32 @@ from pymvg.multi_camera_system import MultiCameraSystem
 
 
 sys.path.append("../../")
-from bruchpilot.tracking.reconstruct_fast import FastSeqH
+from bruchpilot.tracking.reconstruct_fast import FastSeqH, batch_reconstruct, check_search
+from bruchpilot.tracking.kernels import prebuild_kernels, single_threaded
+from bruchpilot.storage.columns import read_any, write_table, table_path, read_table, ColumnReader, ColumnWriter
 
+# Reconstruction, (memory-mapped) detections and arguments of the current worker (set up once per process):
+rec = None
+detections = None
+options = None
 
-def load_data(data_path, camera_system):
+# Columns of the reconstructed points (followed by search_gap with --search-gap):
+POINT_COLUMNS = ["frame_number", "point_id", "x", "y", "z", "reconstruction_error"]
+POINT_DTYPES = ["i8", "i8", "f8", "f8", "f8", "f8"]
+
+# Arguments that change the reconstructed points; runs that differ in any of them keep separate checkpoints:
+CHECKPOINT_PARAMETERS = ["tracking", "output_format", "area_filter", "minimum_tracks", "solver", "search",
+                         "search_budget", "search_gap", "chunk_size"]
+
+
+def load_data(data_path, camera_system, tracking="tracking", frame_range=None):
     names = camera_system.get_names()
 
     gather = []
     for name in names:
-        pt_path = path.join(data_path, "tracking", "Cam{0}.csv".format(name))
-        data = pd.read_csv(pt_path)
+        # Columnar tables are read selectively (only the needed columns and frames):
+        pt_path = path.join(data_path, tracking, "Cam{0}.csv".format(name))
+        data = read_any(pt_path, columns=["frame_number", "x", "y", "area"], frame_range=frame_range)
         data["camera_id"] = name
         gather.append(data)
         
@@ -30,7 +51,23 @@ def load_data(data_path, camera_system):
     return fd
 
 
-def reconstruct_wrapper(df, rec, diagnostics):
+def input_signature(data_path, camera_names, tracking="tracking"):
+    """Names, sizes and modification times of the detection files (CSV file or table) of every camera, so that
+    checkpoints are not reused once the detections change (e.g. after retrack.py)."""
+
+    signature = {}
+    for name in camera_names:
+        pt_path = path.join(data_path, tracking, "Cam{0}.csv".format(name))
+        if path.isdir(table_path(pt_path)):
+            files = [path.join(table_path(pt_path), f) for f in sorted(os.listdir(table_path(pt_path)))]
+        else:
+            files = [pt_path]
+        signature[name] = [[path.basename(f), os.path.getsize(f), os.path.getmtime(f)] for f in files]
+
+    return signature
+
+
+def reconstruct_wrapper(df, rec, search_gap=False):
     
     d = {}
     for name in rec.camera_system.get_names():
@@ -40,13 +77,14 @@ def reconstruct_wrapper(df, rec, diagnostics):
         pts_[:, 1] = pts.y
         d[name] = pts_
         
-    out = rec.reconstruct(d, diagnostics=diagnostics, undistort=True)
+    out = rec.reconstruct(d, undistort=True)
 
     if out[0].size > 0:
         df = pd.DataFrame(out[0], columns=['x', 'y', 'z'])
         df["point_id"] = range(out[0].shape[0])
-        if diagnostics:
-            df["reconstruction_error"] = out[1]
+        df["reconstruction_error"] = out[1]
+        if search_gap:
+            df["search_gap"] = rec.search_gap(d, undistort=True)["gap"]
         df.set_index("point_id", inplace=True)
     else:
         df = pd.DataFrame()
@@ -54,37 +92,321 @@ def reconstruct_wrapper(df, rec, diagnostics):
     return df
 
 
-def single_reconstruct(argtuple):
-    data, rec, args, idx = argtuple
-    tqdm.pandas(position=idx, leave=True)
-    return data.groupby(["frame_number"]).progress_apply(reconstruct_wrapper,
-                                                         rec=rec, diagnostics=args.diagnostics)
+def write_detections(data, camera_names, directory):
+    """Stores the detections as a table sorted by frame number, so that workers can memory-map them and look up any
+    range of frames instead of receiving them with every task."""
+
+    data = data.reset_index()
+    order = np.argsort(data.frame_number.values, kind="mergesort")
+
+    write_table(directory, pd.DataFrame({
+        "frame_number": data.frame_number.values[order],
+        "camera": pd.Index(camera_names).get_indexer(data.camera_id.values[order]),
+        "x": data.x.values[order],
+        "y": data.y.values[order],
+    }, columns=["frame_number", "camera", "x", "y"]), dtypes=["i8", "i8", "f8", "f8"], sorted_by="frame_number")
+
+
+def load_detections(first, last):
+    """Detections of frames first..last from the table of the current worker (indexed like load_data)."""
+
+    rows = detections.rows("frame_number", first, last)
+    camera_names = np.array(rec.camera_names)
+
+    data = pd.DataFrame({"camera_id": camera_names[detections.column("camera")[rows]],
+                         "frame_number": np.array(detections.column("frame_number")[rows]),
+                         "x": np.array(detections.column("x")[rows]),
+                         "y": np.array(detections.column("y")[rows])})
+
+    return data.set_index(["camera_id", "frame_number"]).sort_index()
+
+
+def init_child(cam_path, args, detections_path):
+    global rec, detections, options
+
+    single_threaded()
+
+    rec = FastSeqH(MultiCameraSystem.from_pymvg_file(cam_path), minimum_tracks=args.minimum_tracks,
+                   solver=args.solver, search=args.search, search_budget=args.search_budget,
+                   undistortion_cache=args.undistortion_cache)
+    rec.warm_up()
+
+    detections = ColumnReader(detections_path)
+    options = args
+
+
+def single_reconstruct(task):
+    chunk_idx, first, last = task
+    args = options
+
+    data = load_detections(first, last)
+    if data.shape[0] == 0:
+        return chunk_idx, first, last, pd.DataFrame()
+
+    # Frame-by-frame path (needed to compare against the exhaustive search):
+    if args.search_gap:
+        return chunk_idx, first, last, data.groupby(["frame_number"]).apply(reconstruct_wrapper, rec=rec,
+                                                                             search_gap=args.search_gap)
+
+    results = []
+    for start in range(first, last + 1, args.batch_size):
+        stop = min(start + args.batch_size - 1, last)
+        block = data.loc[pd.IndexSlice[:, start:stop], :]
+        results.append(batch_reconstruct(block, rec, start, stop))
+
+    return chunk_idx, first, last, pd.concat(results)
+
+
+def grid_chunks(first, last, chunk_size):
+    """Frame ranges (inclusive) of all chunks that cover first..last. Chunks are aligned to multiples of chunk_size,
+    so that runs on different (sub-)ranges, e.g. shards on several machines, produce compatible chunks."""
+
+    chunks = []
+    start = first
+    while start <= last:
+        stop = min((start // chunk_size + 1) * chunk_size - 1, last)
+        chunks.append((start, stop))
+        start = stop + 1
+
+    return chunks
+
+
+def uncovered(first, last, ranges):
+    """Parts of first..last that are not covered by any of the given (inclusive) frame ranges."""
+
+    pieces = []
+    position = first
+
+    for start, stop in sorted(ranges):
+        if stop < position:
+            continue
+        if start > last:
+            break
+        if start > position:
+            pieces.append((position, start - 1))
+        position = stop + 1
+
+    if position <= last:
+        pieces.append((position, last))
+
+    return pieces
+
+
+class Checkpoints(object):
+    """Chunk outputs of a run (reconstruction/chunks/<key>), each with a marker file (<first>_<last>.done) that records
+    its completion. Outputs and markers are written to temporary files and renamed, so that shards running on several
+    machines (e.g. on NFS) never see partial chunks and never write to the same file."""
+
+    MARKER = ".done"
+
+    def __init__(self, output_directory, parameters):
+        self.output_format = parameters["output_format"]
+        self.columns = POINT_COLUMNS + (["search_gap"] if parameters["search_gap"] else [])
+        self.dtypes = POINT_DTYPES + (["f8"] if parameters["search_gap"] else [])
+
+        key = hashlib.sha1(json.dumps(parameters, sort_keys=True).encode("utf-8")).hexdigest()[:12]
+        self.directory = path.join(output_directory, "chunks", key)
+
+        if not path.exists(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                # Created concurrently by another machine:
+                pass
+
+        with open(path.join(self.directory, "parameters.json"), "w") as f:
+            json.dump(parameters, f, indent=2, sort_keys=True)
+
+    def completed(self):
+        """Maps the frame ranges of all completed chunks to their files (None for chunks without points)."""
+
+        done = {}
+        for marker in os.listdir(self.directory):
+            if not marker.endswith(self.MARKER):
+                continue
+
+            first, last = marker[:-len(self.MARKER)].split("_")
+            with open(path.join(self.directory, marker)) as f:
+                n_points, filename = f.read().strip().split(",")
+            done[(int(first), int(last))] = path.join(self.directory, filename) if filename else None
+
+        return done
+
+    def _temporary(self, target):
+        return "{0}.{1}.{2}.tmp".format(target, socket.gethostname(), os.getpid())
+
+    def write(self, first, last, output):
 
+        filename = ""
 
-def split(data, n):
-    frame_index = data.index.levels[1]
-    split_ranges = np.array_split(frame_index, n)
-    for s in split_ranges:
-        d = data.loc[pd.IndexSlice[:, s[0]:s[-1]], :]
-        yield d
+        if output.shape[0] > 0:
+            output = output.reset_index().set_index(["frame_number", "point_id"])
 
+            if self.output_format == "columns":
+                filename = "{0:010d}_{1:010d}.columns".format(first, last)
+            else:
+                filename = "{0:010d}_{1:010d}.csv".format(first, last)
 
-def init_child(write_lock):
-    tqdm.set_lock(write_lock)
+            target = path.join(self.directory, filename)
+            temporary = self._temporary(target)
 
+            if self.output_format == "columns":
+                write_table(temporary, output, sorted_by="frame_number")
+                if path.exists(target):
+                    shutil.rmtree(target)
+            else:
+                output.to_csv(temporary)
 
-def multi_reconstruct(data, rec, args):
-    write_lock = Lock()
-    pool = Pool(processes=args.cores, initializer=init_child, initargs=(write_lock,))
-    n_frames = data.index.levels[1]
-    result = pd.concat(pool.map(single_reconstruct, [(d, rec, args, idx) for idx, d in enumerate(split(data, args.cores))]))
-    pool.close()
+            os.rename(temporary, target)
 
-    return result
+        # Mark the chunk as completed:
+        marker = path.join(self.directory, "{0:010d}_{1:010d}{2}".format(first, last, self.MARKER))
+        temporary = self._temporary(marker)
+
+        with open(temporary, "w") as f:
+            f.write("{0},{1}\n".format(output.shape[0], filename))
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.rename(temporary, marker)
+
+    def todo(self, first, last, chunk_size):
+        """Chunks (or parts of chunks) of first..last that have not been completed yet. Only completed chunks that lie
+        within first..last count, as only those can be merged."""
+
+        done = [chunk for chunk in self.completed() if first <= chunk[0] and chunk[1] <= last]
+
+        pieces = []
+        for start, stop in grid_chunks(first, last, chunk_size):
+            pieces.extend(uncovered(start, stop, done))
+
+        return pieces
+
+    def merge(self, first, last, output_path):
+        """Concatenates completed chunks that tile first..last in order into the final output (preferring the
+        longest chunk where chunks of several runs overlap). Without any points, the output only has a header."""
+
+        done = self.completed()
+
+        filenames = []
+        position = first
+        while position <= last:
+            candidates = [chunk for chunk in done if chunk[0] == position and chunk[1] <= last]
+            if not candidates:
+                raise ValueError("Cannot merge, frames from {0} on have not been reconstructed!".format(position))
+
+            chunk = max(candidates, key=lambda chunk: chunk[1])
+            if done[chunk] is not None:
+                filenames.append(done[chunk])
+            position = chunk[1] + 1
+
+        if self.output_format == "columns":
+            if path.exists(table_path(output_path)):
+                shutil.rmtree(table_path(output_path))
+
+            writer = None
+            for filename in filenames:
+                reader = ColumnReader(filename)
+                if writer is None:
+                    writer = ColumnWriter(table_path(output_path), reader.columns,
+                                          dtypes=[reader.dtypes[name] for name in reader.columns],
+                                          sorted_by="frame_number")
+                writer.append(read_table(filename))
+
+            if writer is None:
+                writer = ColumnWriter(table_path(output_path), self.columns, dtypes=self.dtypes,
+                                      sorted_by="frame_number")
+            writer.close()
+            return
+
+        # CSV chunks are concatenated as text (keeping the header of the first one only):
+        with open(output_path, "wb") as sink:
+            if not filenames:
+                sink.write(",".join(self.columns) + "\n")
+
+            for idx, filename in enumerate(filenames):
+                with open(filename, "rb") as source:
+                    header = source.readline()
+                    if idx == 0:
+                        sink.write(header)
+                    shutil.copyfileobj(source, sink)
+
+
+def schedule(data, chunks, task_size):
+    """Splits chunks into tasks (chunk index, first, last) of at most task_size frames. The cost of matching grows
+    steeply with the number of detections, so tasks are estimated by the sum of squared detections per frame and
+    ordered by cost (most expensive first) within every chunk; chunks stay in order, so they complete one after the
+    other."""
+
+    frames, n = np.unique(data.index.get_level_values("frame_number").values, return_counts=True)
+    cumulative_cost = np.concatenate(([0], np.cumsum(n.astype(np.float64) ** 2)))
+
+    tasks = []
+    for chunk_idx, (first, last) in enumerate(chunks):
+        chunk_tasks = []
+        for start in range(first, last + 1, task_size):
+            stop = min(start + task_size - 1, last)
+            cost = cumulative_cost[np.searchsorted(frames, stop, side="right")] - \
+                cumulative_cost[np.searchsorted(frames, start, side="left")]
+            chunk_tasks.append((cost + stop - start + 1, start, stop))
+
+        tasks.extend((chunk_idx, start, stop) for _, start, stop in sorted(chunk_tasks, reverse=True))
+
+    return tasks
+
+
+def multi_reconstruct(data, cam_path, args, chunks, checkpoints):
+    """Reconstructs the given chunks in parallel. Chunks are split into small tasks that are handed out to idle
+    workers; finished tasks are put back in order and every chunk is stored as soon as all of its tasks are done.
+
+    Workers load the calibration (and compile the reconstruction) once and share the detections through a
+    temporary table, so tasks only consist of frame ranges."""
+
+    tasks = schedule(data, chunks, args.task_size)
+
+    n_tasks = np.bincount([chunk_idx for chunk_idx, _, _ in tasks], minlength=len(chunks))
+    parts = dict((chunk_idx, []) for chunk_idx in range(len(chunks)))
+
+    detections_path = tempfile.mkdtemp(prefix="detections_", dir=checkpoints.directory)
+    write_detections(data, MultiCameraSystem.from_pymvg_file(cam_path).get_names(), detections_path)
+
+    try:
+        pool = Pool(processes=args.cores, initializer=init_child, initargs=(cam_path, args, detections_path))
+
+        progress = tqdm(total=sum(last - first + 1 for first, last in chunks), unit="frames")
+        n_done = 0
+
+        for chunk_idx, first, last, output in pool.imap_unordered(single_reconstruct, tasks):
+            parts[chunk_idx].append((first, output))
+
+            if len(parts[chunk_idx]) == n_tasks[chunk_idx]:
+                outputs = [output for _, output in sorted(parts.pop(chunk_idx), key=lambda part: part[0])
+                           if output.shape[0] > 0]
+                checkpoints.write(chunks[chunk_idx][0], chunks[chunk_idx][1],
+                                  pd.concat(outputs) if outputs else pd.DataFrame())
+                n_done += 1
+
+            progress.set_postfix(chunks="{0}/{1}".format(n_done, len(chunks)))
+            progress.update(last - first + 1)
+
+        progress.close()
+
+        pool.close()
+        pool.join()
+    finally:
+        shutil.rmtree(detections_path)
 
 
 def main(args):
-    
+
+    if args.diagnostics:
+        print "Warning: --diagnostics is deprecated and has no effect (reconstruction errors are always written)"
+
+    # Compile the kernels (or load them from numba's cache) before any worker starts, so that workers only load them:
+    print "Compiled reconstruction kernels in {0:.2f} s".format(prebuild_kernels())
+    if args.warm_up:
+        return
+
     if not path.exists(args.data):
         raise ValueError("Data path does not exist!")
 
@@ -93,7 +415,7 @@ def main(args):
     camera_system = MultiCameraSystem.from_pymvg_file(cam_path)
 
     # Load data:
-    data = load_data(args.data, camera_system)
+    data = load_data(args.data, camera_system, tracking=args.tracking, frame_range=args.frame_range)
 
     # Filter by area:
     data = data[data.area > args.area_filter]
@@ -107,19 +429,28 @@ def main(args):
 
     data = data.reset_index().set_index(["camera_id", "frame_number"]).sort_index()
 
-    # Set up reconstruction:
-    rec = FastSeqH(camera_system, minimum_tracks=args.minimum_tracks)
-    
-    # Run:
-    output = multi_reconstruct(data, rec, args).reset_index().set_index(["frame_number", "point_id"])
-
-    # Save:
+    # Resume from the checkpoints of earlier (or concurrent) runs with the same parameters, calibration and inputs:
     output_directory = path.join(args.data, "reconstruction")
     if not path.exists(output_directory):
         os.mkdir(output_directory)
-    
-    output_path = path.join(output_directory, "points.csv")
-    output.to_csv(output_path)
+
+    parameters = dict((name, getattr(args, name)) for name in CHECKPOINT_PARAMETERS)
+    with open(cam_path, "rb") as f:
+        parameters["calibration"] = hashlib.sha1(f.read()).hexdigest()
+    parameters["detections"] = input_signature(args.data, camera_system.get_names(), tracking=args.tracking)
+    checkpoints = Checkpoints(output_directory, parameters)
+
+    todo = checkpoints.todo(a, b, args.chunk_size)
+
+    print "{0} chunks to reconstruct (checkpoints in {1})".format(len(todo), checkpoints.directory)
+
+    # Run:
+    if todo:
+        multi_reconstruct(data, cam_path, args, todo, checkpoints)
+
+    # Merge (by default only for complete sessions, shards are merged by a run without --frame-range):
+    if args.merge or (args.merge is None and args.frame_range is None):
+        checkpoints.merge(a, b, path.join(output_directory, "points.csv"))
 
 
 if __name__ == "__main__":
@@ -127,11 +458,31 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser("Reconstruction helper for triangulating from 2D to 3D")
 
     parser.add_argument("--data", action="store", type=str)
-    parser.add_argument("--diagnostics", action="store_true")
+    parser.add_argument("--tracking", action="store", type=str, default="tracking")
+    parser.add_argument("--output-format", action="store", type=str, default="csv", choices=["csv", "columns"])
+    parser.add_argument("--diagnostics", action="store_true",
+                        help="Deprecated and ignored: reconstruction errors are always written")
     parser.add_argument("--area-filter", action="store", type=float, default=0.0)
     parser.add_argument("--minimum-tracks", action="store", type=int, default=3)
     parser.add_argument("--cores", action="store", type=int, default=4)
     parser.add_argument("--frame-range", action="store", type=int, nargs=2)
+    parser.add_argument("--solver", action="store", type=str, default="numba",
+                        help="Assignment solver; solvers other than numba reconstruct frame by frame (slow)")
+    parser.add_argument("--search", action="store", type=str, default="exhaustive",
+                        choices=["exhaustive", "beam", "ranked", "count"])
+    parser.add_argument("--search-budget", action="store", type=int, default=None)
+    parser.add_argument("--search-gap", action="store_true")
+    parser.add_argument("--batch-size", action="store", type=int, default=2000)
+    parser.add_argument("--chunk-size", action="store", type=int, default=10000)
+    parser.add_argument("--task-size", action="store", type=int, default=500,
+                        help="Number of frames handed to a worker at a time")
+    parser.add_argument("--merge", action="store_true", default=None,
+                        help="Merge the chunks of --frame-range into points.csv (default: only without --frame-range)")
+    parser.add_argument("--no-merge", action="store_false", dest="merge")
+    parser.add_argument("--undistortion-cache", action="store", type=str,
+                        default=path.join(path.expanduser("~"), ".bruchpilot", "undistortion"))
+    parser.add_argument("--warm-up", action="store_true", help="Only compile the reconstruction kernels and exit")
 
     args = parser.parse_args()
+    check_search(args.search, args.search_budget)
     main(args)
@@ -0,0 +1,180 @@
+import sys
+from os import path
+import os
+import argparse
+from multiprocessing import Pool, cpu_count
+
+import numpy as np
+from tqdm import tqdm
+from yaml import load_all, SafeLoader
+
+sys.path.append("../../")
+from bruchpilot.storage.session import Session
+from bruchpilot.storage.columns import open_table_writer, read_any, table_path
+from bruchpilot.tracking.detection import Detector, roi_from_settings, TRACKING_COLUMNS, TRACKING_FORMAT, \
+    TRACKING_DTYPES
+
+
+# Session of the current worker (opened once per process):
+session = None
+
+
+def load_settings(data_path, settings_file=None):
+    """General and camera settings of a session (by default the copy of settings.yaml stored with the recording).
+    The calibration is taken from the session folder if it was copied there."""
+
+    if settings_file is None:
+        settings_file = path.join(data_path, "settings.yaml")
+
+    gsettings, camera_settings = list(load_all(open(settings_file), Loader=SafeLoader))
+
+    calibration = gsettings.get("current_calibration")
+    if calibration and path.exists(path.join(data_path, path.basename(calibration))):
+        gsettings["current_calibration"] = path.join(data_path, path.basename(calibration))
+
+    return gsettings, camera_settings
+
+
+def load_opto_intensity(data_path, camera):
+    """Frame numbers and opto intensities from the live tracking output (if any). Intensities only change between
+    frames, so the last known value is carried forward."""
+
+    live_path = path.join(data_path, "tracking", "{0}.csv".format(camera))
+    if not path.exists(live_path) and not path.isdir(table_path(live_path)):
+        return None
+
+    live = read_any(live_path, columns=["frame_number", "opto_intensity"]).drop_duplicates("frame_number")
+    live = live.sort_values("frame_number")
+
+    return live.frame_number.values, live.opto_intensity.values
+
+
+def lookup_opto_intensity(opto, frame_numbers):
+
+    if opto is None or opto[0].size == 0:
+        return np.zeros(frame_numbers.size)
+
+    idx = np.searchsorted(opto[0], frame_numbers, side="right") - 1
+    return np.where(idx >= 0, opto[1][np.maximum(idx, 0)], 0)
+
+
+def retrack_chunk(task):
+    """Detects targets in the recorded frames start..stop - 1 of a camera. The background model is trained on the
+    preceding warmup frames first, so that it has converged at the beginning of the chunk."""
+
+    camera, camera_settings, gsettings, start, stop, warmup = task
+
+    detector = Detector(gsettings, roi_from_settings(camera_settings, gsettings))
+    reader = session.reader(camera)
+    metadata = session.metadata[camera]
+
+    frame_numbers = metadata.frame_number.values
+    process_timestamps = metadata.process_timestamp.values
+    camera_timestamps = metadata.camera_timestamp.values
+
+    blocks = []
+
+    for n in range(max(0, start - warmup), stop):
+        centroids, areas, _ = detector.apply(reader.read(n))
+
+        if n < start or len(areas) == 0:
+            continue
+
+        k = len(areas)
+        blocks.append(np.column_stack((np.repeat(frame_numbers[n], k), np.repeat(process_timestamps[n], k),
+                                       np.repeat(camera_timestamps[n], k), centroids, areas, np.zeros((k, 2)))))
+
+    if not blocks:
+        return camera, np.zeros((0, len(TRACKING_COLUMNS)))
+
+    return camera, np.concatenate(blocks)
+
+
+def init_child(data_path, cache_dir):
+    global session
+    session = Session(data_path, cache_dir=cache_dir)
+
+
+def main(args):
+
+    if not path.exists(args.data):
+        raise ValueError("Data path does not exist!")
+
+    gsettings, camera_settings = load_settings(args.data, args.settings)
+
+    # Overrides:
+    if args.threshold is not None:
+        gsettings["background_subtraction_threshold"] = args.threshold
+    if args.alpha is not None:
+        gsettings["background_subtraction_alpha"] = args.alpha
+    if args.min_area is not None:
+        gsettings["blob_min_area"] = args.min_area
+    if args.max_area is not None:
+        gsettings["blob_max_area"] = args.max_area
+
+    # By default, warm up for five time constants of the background model:
+    warmup = args.warmup
+    if warmup is None:
+        warmup = int(np.ceil(5.0 / gsettings["background_subtraction_alpha"]))
+
+    # Opening all readers here also builds the AVI keyframe indices once, before the workers need them:
+    main_session = Session(args.data, cache_dir=args.index_cache)
+    cameras = args.cameras if args.cameras else [c for c in main_session.cameras if c in camera_settings]
+
+    tasks = []
+    for camera in cameras:
+        n_frames = main_session.n_frames(camera)
+        for start in range(0, n_frames, args.chunk_size):
+            tasks.append((camera, camera_settings[camera], gsettings, start, min(start + args.chunk_size, n_frames),
+                          warmup))
+
+    main_session.close()
+
+    output_directory = path.join(args.data, args.output)
+    if not path.exists(output_directory):
+        os.mkdir(output_directory)
+
+    table_format = args.format if args.format is not None else gsettings.get("tracking_format", "csv")
+
+    writers, opto = {}, {}
+    for camera in cameras:
+        writers[camera] = open_table_writer(path.join(output_directory, "{0}.csv".format(camera)), TRACKING_COLUMNS,
+                                            TRACKING_DTYPES, TRACKING_FORMAT, table_format=table_format,
+                                            sorted_by="frame_number")
+        opto[camera] = load_opto_intensity(args.data, camera)
+
+    # Chunks are handed out in order, so every file is written sequentially:
+    pool = Pool(processes=args.cores, initializer=init_child, initargs=(args.data, args.index_cache))
+
+    for camera, block in tqdm(pool.imap(retrack_chunk, tasks), total=len(tasks)):
+        if block.shape[0] > 0:
+            block[:, 6] = lookup_opto_intensity(opto[camera], block[:, 0])
+            writers[camera].append(block)
+
+    pool.close()
+    pool.join()
+
+    for writer in writers.values():
+        writer.close()
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser("Re-runs the 2D detection on the recorded frames of a session")
+
+    parser.add_argument("--data", action="store", type=str)
+    parser.add_argument("--settings", action="store", type=str, default=None)
+    parser.add_argument("--output", action="store", type=str, default="tracking_offline")
+    parser.add_argument("--format", action="store", type=str, default=None, choices=["csv", "columns"])
+    parser.add_argument("--cameras", action="store", type=str, nargs="+")
+    parser.add_argument("--threshold", action="store", type=int, default=None)
+    parser.add_argument("--alpha", action="store", type=float, default=None)
+    parser.add_argument("--min-area", action="store", type=int, default=None)
+    parser.add_argument("--max-area", action="store", type=int, default=None)
+    parser.add_argument("--cores", action="store", type=int, default=cpu_count())
+    parser.add_argument("--chunk-size", action="store", type=int, default=10000)
+    parser.add_argument("--warmup", action="store", type=int, default=None)
+    parser.add_argument("--index-cache", action="store", type=str, default=None)
+
+    args = parser.parse_args()
+    main(args)
@@ -12,12 +12,14 @@ from tqdm import tqdm
 from pymvg.multi_camera_system import MultiCameraSystem
 
 sys.path.append("../../")
-from bruchpilot.tracking.tracker import Tracker
+from bruchpilot.tracking.tracker import Tracker, FIELDNAMES, DTYPES
+from bruchpilot.storage.columns import ColumnWriter, read_any, table_path
 
 
-def load_data(data_path):
+def load_data(data_path, frame_range=None):
     data_path_full = path.join(data_path, "reconstruction", "points.csv")
-    data = pd.read_csv(data_path_full).set_index(["frame_number", "point_id"])
+    data = read_any(data_path_full, columns=["frame_number", "point_id", "x", "y", "z", "reconstruction_error"],
+                    frame_range=frame_range, index=["frame_number", "point_id"])
     return data
 
 
@@ -28,20 +30,30 @@ def main(args):
 
     output_path = path.join(args.data, "reconstruction", "tracked.csv")
 
-    storage_file = tempfile.NamedTemporaryFile(mode="wb", delete=False)
+    # Tables are written in place, CSV files through a temporary file:
+    if args.output_format == "columns":
+        storage_file = ColumnWriter(table_path(output_path), FIELDNAMES, dtypes=DTYPES, sorted_by="frame_number")
+    else:
+        storage_file = tempfile.NamedTemporaryFile(mode="wb", delete=False)
+
     tracker = Tracker(storage_file=storage_file, maximum_distance=args.maximum_distance,
-                      maximum_missed_frames=args.maximum_missed, dt=args.delta)
+                      maximum_missed_frames=args.maximum_missed, dt=args.delta,
+                      gating_threshold=args.gating_threshold, solver=args.solver,
+                      strict_assignment=args.strict_assignment)
 
-    print "Loading and filtering data (to temporary file {0})...".format(storage_file.name)
-    data = load_data(args.data)
+    print "Loading and filtering data..."
+    frame_range = None if args.range == [None, None] else args.range
+    data = load_data(args.data, frame_range=frame_range)
     data = data[data.reconstruction_error < args.maximum_reconstruction_error]
 
     print "Tracking..."
     tracker.process_batch(data, start=args.range[0], stop=args.range[1], pg_mode="terminal")
 
     storage_file.close()
-    copy2(storage_file.name, output_path)
-    os.remove(storage_file.name)
+
+    if args.output_format != "columns":
+        copy2(storage_file.name, output_path)
+        os.remove(storage_file.name)
 
 
 if __name__ == "__main__":
@@ -54,6 +66,12 @@ if __name__ == "__main__":
     parser.add_argument("--maximum-distance", action="store", type=float, default=1.0)
     parser.add_argument("--maximum-missed", action="store", type=int, default=20)
     parser.add_argument("--delta", action="store", type=float, default=0.01)
+    parser.add_argument("--gating-threshold", action="store", type=float, default=None)
+    parser.add_argument("--solver", action="store", type=str, default="scipy")
+    parser.add_argument("--strict-assignment", action="store_true",
+                        help="Exclude pairs beyond the maximum distance before the assignment and start new targets "
+                             "from all unassigned points")
+    parser.add_argument("--output-format", action="store", type=str, default="csv", choices=["csv", "columns"])
 
     args = parser.parse_args()
     main(args)
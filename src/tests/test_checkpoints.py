@@ -0,0 +1,66 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from os import path
+
+import pandas as pd
+
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), "..", "scripts", "postprocessing"))
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), ".."))
+from reconstruct import Checkpoints, input_signature
+
+CAMERAS = ["1", "2"]
+
+
+class CheckpointInputTest(unittest.TestCase):
+
+    def setUp(self):
+        self.data_path = tempfile.mkdtemp()
+        os.makedirs(path.join(self.data_path, "tracking"))
+        for name in CAMERAS:
+            self.write_detections(name, [10.0, 20.0])
+
+    def tearDown(self):
+        shutil.rmtree(self.data_path)
+
+    def write_detections(self, name, xs):
+        filename = path.join(self.data_path, "tracking", "Cam{0}.csv".format(name))
+        pd.DataFrame({"frame_number": range(len(xs)), "x": xs, "y": xs, "area": [5.0] * len(xs)}).to_csv(
+            filename, index=False)
+
+    def checkpoints(self):
+        parameters = {"output_format": "csv", "search_gap": False,
+                      "detections": input_signature(self.data_path, CAMERAS)}
+        return Checkpoints(path.join(self.data_path, "reconstruction"), parameters)
+
+    def test_unchanged_inputs_reuse_chunks(self):
+        self.checkpoints().write(0, 1, pd.DataFrame())
+        self.assertEqual(list(self.checkpoints().completed()), [(0, 1)])
+
+    def test_changed_inputs_invalidate_chunks(self):
+        before = self.checkpoints()
+        before.write(0, 1, pd.DataFrame())
+
+        # Rewritten detections (e.g. by retrack.py), with a different size:
+        self.write_detections("2", [10.0, 20.0, 30.0])
+
+        after = self.checkpoints()
+        self.assertNotEqual(before.directory, after.directory)
+        self.assertEqual(after.completed(), {})
+        self.assertEqual(after.todo(0, 1, 10), [(0, 1)])
+
+    def test_touched_inputs_invalidate_chunks(self):
+        before = self.checkpoints()
+        before.write(0, 1, pd.DataFrame())
+
+        # Same size, newer modification time:
+        filename = path.join(self.data_path, "tracking", "Cam1.csv")
+        os.utime(filename, (os.path.getatime(filename), os.path.getmtime(filename) + 10))
+
+        self.assertNotEqual(before.directory, self.checkpoints().directory)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,60 @@
+import sys
+import unittest
+from os import path
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), ".."))
+from bruchpilot.tracking.detection import BackgroundSubtractor, BlobDetector
+
+
+class BackgroundSubtractorTest(unittest.TestCase):
+
+    def test_mask_matches_float64_model(self):
+        """The float32 model gives the same masks as the previous float64 model, which truncated the background."""
+
+        rng = np.random.RandomState(1)
+        frames = np.clip(rng.normal(120, 20, (300, 48, 64)), 0, 255).astype(np.uint8)
+
+        subtractor = BackgroundSubtractor(0.02, 5)
+        subtractor.apply(frames[0])
+        mean = frames[0].astype("float64")
+
+        differences = 0
+        for frame in frames[1:]:
+            mask = subtractor.apply(frame)
+
+            cv2.accumulateWeighted(frame, mean, 0.02)
+            rect = cv2.subtract(mean.astype("uint8"), frame)
+            expected = cv2.threshold(rect, 5, 255, cv2.THRESH_BINARY)[1]
+
+            differences += np.count_nonzero(mask != expected)
+
+        # Float32 rounding may flip a pixel close to an integer background value now and then:
+        self.assertLessEqual(differences, 1e-5 * frames.size)
+
+
+class BlobDetectorTest(unittest.TestCase):
+
+    def test_single_pixel_speck_is_rejected_by_default(self):
+        mask = np.zeros((32, 32), dtype=np.uint8)
+        mask[5, 5] = 255
+        mask[20:23, 20:23] = 255
+
+        centroids, areas = BlobDetector().detect(mask)
+
+        self.assertEqual(areas.tolist(), [9])
+        np.testing.assert_allclose(centroids, [[21.0, 21.0]])
+
+    def test_minimum_area_of_one_keeps_specks(self):
+        mask = np.zeros((32, 32), dtype=np.uint8)
+        mask[5, 5] = 255
+
+        centroids, areas = BlobDetector(min_area=1).detect(mask)
+
+        self.assertEqual(areas.tolist(), [1])
+
+
+if __name__ == "__main__":
+    unittest.main()
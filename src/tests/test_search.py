@@ -0,0 +1,34 @@
+import sys
+import unittest
+from os import path
+
+import numpy as np
+
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), ".."))
+from bruchpilot.tracking.reconstruct_fast import check_search, search_matching, compiled_search_arguments, \
+    DEFAULT_BUDGETS
+
+
+class SearchArgumentTest(unittest.TestCase):
+
+    def test_budget_below_one_is_rejected(self):
+        for search in ["beam", "ranked"]:
+            for budget in [0, -1]:
+                self.assertRaises(ValueError, check_search, search, budget)
+                self.assertRaises(ValueError, search_matching, None, np.zeros((3, 2, 2)), None, 1.0, 1.0,
+                                  search=search, budget=budget)
+                self.assertRaises(ValueError, compiled_search_arguments, 3, search, budget)
+
+    def test_default_budget(self):
+        self.assertEqual(check_search("beam"), DEFAULT_BUDGETS["beam"])
+        self.assertEqual(compiled_search_arguments(3, "ranked", None)[2], DEFAULT_BUDGETS["ranked"])
+
+    def test_budget_is_ignored_without_budgeted_search(self):
+        self.assertEqual(check_search("exhaustive", 0), 0)
+
+    def test_unknown_search_mode(self):
+        self.assertRaises(ValueError, check_search, "random", 3)
+
+
+if __name__ == "__main__":
+    unittest.main()